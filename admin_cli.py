@@ -0,0 +1,462 @@
+"""Offline admin commands for the key inventory and JSON data, run without connecting to Discord
+
+Usage: python -m admin_cli <command> [options]   (python -m admin_cli --help for the list)
+"""
+from datetime import datetime, timezone
+import os
+import sys
+import json
+import time
+import itertools
+import random
+import asyncio
+import argparse
+import sqlite3
+import logging
+import tempfile
+import aiohttp
+from aiohttp import web
+from typing import Awaitable, Callable, List, Optional
+
+from storage import (
+    CONFIG, EXPORT_DATASETS, INVOICE_EXPORT_COLUMNS, KEY_FILE_MAX_KEY_BYTES, DataManager, JsonCodec, KeyManager,
+    KeyStore, backup_database, init_key_database, iter_key_file, key_validation_app, orjson, parse_export_range,
+    prune_backups, write_export
+)
+
+logger = logging.getLogger("admin_cli")
+
+def open_key_manager() -> KeyManager:
+    # Never release_stale_key_reservations() here: a running bot may own those reservations
+    init_key_database()
+    return KeyManager(KeyStore(CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH']))
+
+async def open_data_manager(store: KeyStore) -> DataManager:
+    # The bot may be running and appending to the journals, so leave the data files to it
+    data_manager = DataManager(store, read_only=True)
+    # Invoices, warnings, vouches and giveaways are read from SQLite; bring over any still in JSON
+    await data_manager.import_json_records()
+    return data_manager
+
+async def iter_file_chunks(path: str):
+    """Yield a file's bytes in 64 KiB chunks"""
+    with open(path, 'rb') as key_file:
+        while chunk := key_file.read(64 * 1024):
+            yield chunk
+
+async def cmd_import_keys(args) -> int:
+    km = open_key_manager()
+    try:
+        async def progress(added: int, duplicates: int):
+            print(f"  {added:,} added, {duplicates:,} duplicates so far", file=sys.stderr)
+
+        rejected = []
+        result = await km.import_keys(args.product, iter_key_file(iter_file_chunks(args.file), rejected),
+                                      progress=progress, duration_days=args.duration_days)
+        print(result['message'])
+        if rejected:
+            print(f"⚠️ Skipped {len(rejected):,} values that are not valid UTF-8 or longer than "
+                  f"{KEY_FILE_MAX_KEY_BYTES} bytes (lines {', '.join(map(str, rejected[:10]))}"
+                  f"{', ...' if len(rejected) > 10 else ''})", file=sys.stderr)
+        return 0 if result['success'] else 1
+    finally:
+        await km.close()
+
+async def cmd_export(args) -> int:
+    try:
+        since, until = parse_export_range(args.since, args.until)
+    except ValueError:
+        print("❌ Dates must be YYYY-MM-DD")
+        return 1
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    km = open_key_manager()
+    try:
+        if args.dataset == 'invoices':
+            rows = (await open_data_manager(km.store)).iter_invoice_rows(args.guild, since, until, args.product)
+            exported = await write_export(rows, INVOICE_EXPORT_COLUMNS, args.format, out)
+        else:
+            rows = km.iter_export_rows(args.dataset, since, until, args.product, args.include_archive)
+            exported = await write_export(rows, EXPORT_DATASETS[args.dataset]['columns'], args.format, out)
+        print(f"✅ Exported {exported:,} {args.dataset}", file=sys.stderr)
+        return 0
+    finally:
+        await km.close()
+        if out is not sys.stdout.buffer:
+            out.close()
+
+async def cmd_stock(args) -> int:
+    km = open_key_manager()
+    try:
+        await km.reconcile_stock()
+        available = await km.get_product_stock()
+        held = await km.get_held_stock()
+        for product_name in sorted(set(available) | set(held)):
+            print(f"{product_name}: {available.get(product_name, 0):,} available, {held.get(product_name, 0):,} held")
+        for guild_id, guild_slice in sorted(km.stock.slices.items()):
+            for product_name, count in sorted(guild_slice.items()):
+                print(f"  guild {guild_id} / {product_name}: {count:,} in slice")
+        if not available and not held:
+            print("No keys in stock")
+        return 0
+    finally:
+        await km.close()
+
+async def cmd_rebuild_aggregates(args) -> int:
+    km = open_key_manager()
+    try:
+        counts = await km.rebuild_purchase_aggregates()
+        print(f"✅ Rebuilt {counts['user_totals']:,} user totals and "
+              f"{counts['user_product_totals']:,} per-product totals")
+        return 0
+    finally:
+        await km.close()
+
+async def cmd_rebuild_rollups(args) -> int:
+    km = open_key_manager()
+    try:
+        # Invoices still in JSON must be in the table the rebuild reads
+        await open_data_manager(km.store)
+        counts = await km.rebuild_sales_rollups()
+        print(f"✅ Rebuilt {counts['sales_hourly']:,} hourly and {counts['sales_daily']:,} daily buckets, "
+              f"{counts['leaderboards']:,} leaderboard rows ({counts['invoices']:,} invoices)")
+        return 0
+    finally:
+        await km.close()
+
+async def cmd_import_json(args) -> int:
+    km = open_key_manager()
+    try:
+        imported = await DataManager(km.store, read_only=True).import_json_records()
+        for category, count in imported.items():
+            print(f"✅ {category}: {count:,} records")
+        if not imported:
+            print("Nothing left to import")
+        return 0
+    finally:
+        await km.close()
+
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+async def cmd_vacuum(args) -> int:
+    init_key_database()
+    for path in (CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH']):
+        before = _file_size(path) + _file_size(f"{path}-wal")
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA optimize;')
+        finally:
+            conn.close()
+        after = _file_size(path) + _file_size(f"{path}-wal")
+        print(f"✅ {path}: {before:,} -> {after:,} bytes")
+    return 0
+
+async def cmd_migrate(args) -> int:
+    init_key_database()
+    print(f"✅ {CONFIG['DATABASE_PATH']} is up to date")
+    return 0
+
+async def cmd_backup(args) -> int:
+    init_key_database()
+    os.makedirs(CONFIG['BACKUP_FOLDER'], exist_ok=True)
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
+
+    # sqlite3's online backup copies a consistent snapshot while the bot keeps writing
+    for path in (CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH']):
+        name = os.path.splitext(os.path.basename(path))[0]
+        backup_path = os.path.join(CONFIG['BACKUP_FOLDER'], f"{name}_{timestamp}.db")
+        backup_database(path, backup_path)
+        prune_backups(f"{name}_", ".db")
+        print(f"✅ {path} -> {backup_path}")
+
+    km = open_key_manager()
+    try:
+        data_manager = DataManager(km.store, read_only=True)
+    finally:
+        await km.close()
+    backup_path = os.path.join(CONFIG['BACKUP_FOLDER'], f"complete_backup_{timestamp}.json")
+    if not data_manager.save_data(backup_path, {"timestamp": timestamp, **await data_manager.snapshot_data()}):
+        print(f"❌ Data backup failed: {backup_path}")
+        return 1
+    prune_backups('complete_backup_', '.json')
+    print(f"✅ JSON data -> {backup_path}")
+    return 0
+
+def use_scratch_key_database(folder: str, product_name: str, key_count: int):
+    """Point CONFIG at a new key database in folder, stocked with key_count keys of product_name"""
+    CONFIG['DATABASE_PATH'] = os.path.join(folder, "product_keys.db")
+    CONFIG['ARCHIVE_DATABASE_PATH'] = os.path.join(folder, "product_keys_archive.db")
+    init_key_database()
+    conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO products (name, description) VALUES (?, '')", (product_name,))
+            conn.executemany("INSERT INTO keys (product_name, key_value) VALUES (?, ?)",
+                             ((product_name, f"{product_name}-{number:08d}") for number in range(key_count)))
+    finally:
+        conn.close()
+
+def legacy_claim(product_name: str, user_id: int, sequence: int):
+    """use_product_key as it was before the KeyStore: a new connection and SELECT, UPDATE, INSERT per claim"""
+    conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
+    conn.row_factory = sqlite3.Row
+    try:
+        row = conn.execute("SELECT id, key_value FROM keys WHERE product_name = ? AND used = FALSE LIMIT 1",
+                           (product_name,)).fetchone()
+        if not row:
+            return None
+        conn.execute("UPDATE keys SET used = TRUE, user_tag = ?, user_id = ?, date_used = CURRENT_TIMESTAMP WHERE id = ?",
+                     ("bench#0", user_id, row['id']))
+        conn.execute("INSERT INTO user_purchases (user_id, user_tag, product_name, amount_spent, transaction_id) "
+                     "VALUES (?, ?, ?, 0.0, ?)", (user_id, "bench#0", product_name, f"txn_bench_{sequence}"))
+        conn.commit()
+        return row['key_value']
+    finally:
+        conn.close()
+
+async def run_claims(claim: Callable[[int], Awaitable[Optional[str]]], count: int, concurrency: int) -> tuple:
+    """(seconds, delivered, duplicate deliveries, failed claims) for count claims, concurrency at a time"""
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def claim_one(sequence: int):
+        async with semaphore:
+            return await claim(sequence)
+    
+    started = time.perf_counter()
+    results = await asyncio.gather(*(claim_one(sequence) for sequence in range(count)), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    delivered = [result for result in results if isinstance(result, str)]
+    return elapsed, len(delivered), len(delivered) - len(set(delivered)), count - len(delivered)
+
+async def cmd_bench_claims(args) -> int:
+    product_name = "Bench Product"
+    loop = asyncio.get_running_loop()
+    print(f"{'claim path':<24} {'claims':>8} {'claims/s':>10} {'duplicates':>11} {'failed':>7}")
+    with tempfile.TemporaryDirectory() as folder:
+        for name in ("per-call connection", "KeyStore"):
+            path_folder = os.path.join(folder, name.replace(' ', '_'))
+            os.makedirs(path_folder)
+            use_scratch_key_database(path_folder, product_name, args.claims)
+            if name == "KeyStore":
+                km = KeyManager(KeyStore(CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH']))
+                try:
+                    results = await run_claims(
+                        lambda sequence: km.use_product_key(product_name, "bench#0", sequence % 1000),
+                        args.claims, args.concurrency)
+                finally:
+                    await km.close()
+            else:
+                results = await run_claims(
+                    lambda sequence: loop.run_in_executor(None, legacy_claim, product_name, sequence % 1000, sequence),
+                    args.claims, args.concurrency)
+            elapsed, delivered, duplicates, failed = results
+            print(f"{name:<24} {delivered:>8,} {delivered / elapsed:>10,.0f} {duplicates:>11,} {failed:>7,}")
+    return 0
+
+def legacy_validation_app() -> web.Application:
+    """/validate as a lookup in SQLite per request, the way loaders checked keys before the in-memory index"""
+    def lookup(key_value: str) -> bytes:
+        conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
+        try:
+            row = conn.execute("SELECT product_name FROM keys WHERE key_value = ? AND used = 1", (key_value,)).fetchone()
+        finally:
+            conn.close()
+        return json.dumps({"valid": row is not None, "product": row[0] if row else None}).encode()
+    
+    async def handle_validate_key(request: web.Request) -> web.Response:
+        key_value = request.query.get('key')
+        if not key_value:
+            return web.json_response({"error": "missing key"}, status=400)
+        body = await asyncio.get_running_loop().run_in_executor(None, lookup, key_value.strip())
+        return web.Response(body=body, content_type='application/json')
+    
+    app = web.Application()
+    app.router.add_get('/validate', handle_validate_key)
+    return app
+
+async def run_validations(app: web.Application, keys: List[str], concurrency: int) -> tuple:
+    """(seconds, p99 latency in ms, wrong answers) for one GET /validate per key, served by app on a free local port"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}/validate"
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, wrong = [], 0
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+            async def validate(key_value: str):
+                nonlocal wrong
+                async with semaphore:
+                    started = time.perf_counter()
+                    async with session.get(url, params={"key": key_value}) as response:
+                        answer = await response.json()
+                    latencies.append(time.perf_counter() - started)
+                    # Bench keys are stocked with a "-used-" marker when assigned
+                    wrong += answer.get("valid") != ("-used-" in key_value)
+            
+            started = time.perf_counter()
+            await asyncio.gather(*(validate(key_value) for key_value in keys))
+            elapsed = time.perf_counter() - started
+    finally:
+        await runner.cleanup()
+    latencies.sort()
+    return elapsed, latencies[int(len(latencies) * 0.99)] * 1000, wrong
+
+async def cmd_bench_validate(args) -> int:
+    product_name = "Bench Product"
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as folder:
+        use_scratch_key_database(folder, product_name, 0)
+        conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
+        try:
+            with conn:
+                conn.executemany("INSERT INTO keys (product_name, key_value, used, user_id) VALUES (?, ?, 1, ?)",
+                                 ((product_name, f"BENCH-used-{number:08d}", number) for number in range(args.keys)))
+        finally:
+            conn.close()
+        # Half the requests name assigned keys and half name keys nobody owns
+        keys = [f"BENCH-used-{rng.randrange(args.keys):08d}" if rng.random() < 0.5 else f"BENCH-free-{number:08d}"
+                for number in range(args.requests)]
+        
+        km = open_key_manager()
+        try:
+            started = time.perf_counter()
+            await km.load_used_key_index()
+            print(f"index of {args.keys:,} keys loaded in {time.perf_counter() - started:.2f}s")
+            print(f"{'validation path':<24} {'requests':>9} {'requests/s':>11} {'p99 ms':>8} {'wrong':>6}")
+            started = time.perf_counter()
+            wrong = sum(json.loads(km.used_keys.validate(key_value))["valid"] != ("-used-" in key_value)
+                        for key_value in keys)
+            elapsed = time.perf_counter() - started
+            print(f"{'index, in process':<24} {len(keys):>9,} {len(keys) / elapsed:>11,.0f} {'-':>8} {wrong:>6,}")
+            for name, app in (("SQLite per request", legacy_validation_app()),
+                              ("index over HTTP", key_validation_app(km.used_keys))):
+                elapsed, p99, wrong = await run_validations(app, keys, args.concurrency)
+                print(f"{name:<24} {len(keys):>9,} {len(keys) / elapsed:>11,.0f} {p99:>8.1f} {wrong:>6,}")
+            metrics = km.used_keys.metrics()
+            print(f"LRU hit rate {metrics['cache_hit_rate']:.0%}, Bloom negatives {metrics['bloom_negatives']:,}")
+        finally:
+            await km.close()
+    return 0
+
+def build_bench_dataset(target_bytes: int) -> dict:
+    """Invoices and vouches laid out like their old JSON files, about target_bytes of compact JSON"""
+    rng = random.Random(0)
+    products = ["Premium Access", "Lifetime License", "Monthly Key", "Starter Pack", "VIP Bundle"]
+    invoices, vouches, guild_ids = {}, {}, []
+    size = 0
+    for number in itertools.count(1):
+        if number % 500 == 1:
+            guild_ids.append(str(rng.randrange(10**17, 10**18)))
+        guild_id = rng.choice(guild_ids)
+        customer_id = rng.randrange(10**17, 10**18)
+        timestamp = 1_700_000_000 + number * 37
+        invoice = {
+            "invoice_id": f"INV-{number:08d}", "product": rng.choice(products),
+            "customer_id": customer_id, "customer_tag": f"customer{number % 50000}#0",
+            "processor_id": rng.randrange(10**17, 10**18), "processor_tag": f"staff{number % 40}#0",
+            "timestamp": timestamp, "guild_id": int(guild_id), "template_used": "post_purchase_action",
+            "amount": round(rng.uniform(1, 200), 2)
+        }
+        invoices.setdefault(guild_id, {})[invoice["invoice_id"]] = invoice
+        vouch = {
+            "product": invoice["product"], "rating": rng.randint(1, 5),
+            "experience": "Fast delivery, key worked first time. " * rng.randint(1, 4) + "Ünïcode ✅",
+            "supporter": invoice["processor_tag"],
+            "timestamp": datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+        }
+        user_vouches = vouches.setdefault(str(customer_id % 10**6), {"count": 0, "vouches": []})
+        user_vouches["count"] += 1
+        user_vouches["vouches"].append(vouch)
+        # The separators and keys of one record of each, close enough to size the whole dataset
+        size += len(json.dumps(invoice, ensure_ascii=False)) + len(json.dumps(vouch, ensure_ascii=False)) + 30
+        if size >= target_bytes:
+            return {"invoices": invoices, "vouches": vouches}
+
+async def cmd_bench_json(args) -> int:
+    dataset = build_bench_dataset(int(args.size_mb * 1024 * 1024))
+    backends = ['json'] + (['orjson'] if orjson is not None else [])
+    print(f"{'backend':<8} {'layout':<8} {'size':>12} {'encode+write':>13} {'read+decode':>12}")
+    with tempfile.TemporaryDirectory() as folder:
+        pretty_path = os.path.join(folder, "pretty.json")
+        for backend in backends:
+            for pretty in (False, True):
+                codec = JsonCodec(backend, pretty)
+                path = os.path.join(folder, f"{backend}_{'pretty' if pretty else 'compact'}.json")
+                started = time.perf_counter()
+                with open(path, "wb") as f:
+                    f.write(codec.dumps(dataset))
+                written = time.perf_counter() - started
+                started = time.perf_counter()
+                with open(path, "rb") as f:
+                    assert codec.loads(f.read())["vouches"].keys() == dataset["vouches"].keys()
+                read = time.perf_counter() - started
+                print(f"{backend:<8} {'pretty' if pretty else 'compact':<8} {os.path.getsize(path) / 1024 / 1024:>9.1f} MB "
+                      f"{written:>12.2f}s {read:>11.2f}s")
+                if pretty and backend == 'json':
+                    os.replace(path, pretty_path)
+        # Files written before the switch to compact output stay readable
+        for backend in backends:
+            started = time.perf_counter()
+            with open(pretty_path, "rb") as f:
+                JsonCodec(backend).loads(f.read())
+            print(f"{backend:<8} reads the old indented file in {time.perf_counter() - started:.2f}s")
+    return 0
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m admin_cli", description="Offline inventory and data tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_keys = commands.add_parser("import-keys", help="Stream keys from a .txt/.csv file into a product")
+    import_keys.add_argument("product")
+    import_keys.add_argument("file")
+    import_keys.add_argument("--duration-days", type=int, default=None,
+                             help="License length in days, counted from delivery")
+    import_keys.set_defaults(handler=cmd_import_keys)
+
+    export = commands.add_parser("export", help="Write purchases, keys or invoices as gzipped CSV/JSONL")
+    export.add_argument("dataset", choices=[*EXPORT_DATASETS, 'invoices'])
+    export.add_argument("output", help="Output .gz file ('-' for stdout)")
+    export.add_argument("--format", choices=['csv', 'jsonl'], default='csv')
+    export.add_argument("--since", default=None, help="First day to include (YYYY-MM-DD)")
+    export.add_argument("--until", default=None, help="Last day to include (YYYY-MM-DD)")
+    export.add_argument("--product", default=None, help="Only this product")
+    export.add_argument("--include-archive", action="store_true", help="Include archived purchases and keys")
+    export.add_argument("--guild", default=None, help="Only invoices from this guild ID")
+    export.set_defaults(handler=cmd_export)
+
+    commands.add_parser("stock", help="Recount and print stock per product").set_defaults(handler=cmd_stock)
+    commands.add_parser("rebuild-aggregates", help="Recompute per-user purchase totals from history").set_defaults(
+        handler=cmd_rebuild_aggregates)
+    commands.add_parser("rebuild-rollups", help="Recompute hourly/daily sales rollups from history").set_defaults(
+        handler=cmd_rebuild_rollups)
+    commands.add_parser("vacuum", help="Checkpoint, VACUUM and optimize both key databases").set_defaults(
+        handler=cmd_vacuum)
+    commands.add_parser("migrate", help="Apply pending key database migrations").set_defaults(handler=cmd_migrate)
+    commands.add_parser("import-json", help="Move invoices, warnings, vouches and giveaways from JSON into SQLite").set_defaults(
+        handler=cmd_import_json)
+    commands.add_parser("backup", help="Back up the key databases and JSON data").set_defaults(handler=cmd_backup)
+    bench_claims = commands.add_parser("bench-claims", help="Compare key claims per second before and after the KeyStore")
+    bench_claims.add_argument("--claims", type=int, default=5000, help="Keys claimed by each claim path")
+    bench_claims.add_argument("--concurrency", type=int, default=50, help="Claims in flight at once")
+    bench_claims.set_defaults(handler=cmd_bench_claims)
+    bench_validate = commands.add_parser("bench-validate", help="Compare /validate requests per second from SQLite and from the in-memory index")
+    bench_validate.add_argument("--keys", type=int, default=100000, help="Assigned keys in the index")
+    bench_validate.add_argument("--requests", type=int, default=20000, help="Requests sent to each validation path")
+    bench_validate.add_argument("--concurrency", type=int, default=50, help="Requests in flight at once")
+    bench_validate.set_defaults(handler=cmd_bench_validate)
+    bench_json = commands.add_parser("bench-json", help="Time each JSON backend and layout on generated invoices and vouches")
+    bench_json.add_argument("--size-mb", type=float, default=100, help="Approximate compact size of the dataset")
+    bench_json.set_defaults(handler=cmd_bench_json)
+    return parser
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    return asyncio.run(args.handler(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,22 +2,27 @@ from discord.ext import commands, tasks
 from discord import app_commands
 from datetime import datetime, timedelta, timezone
 import os
-import json
 import time
 import io
 import traceback
 import asyncio
 import random
 import re
+import tempfile
 import threading
-import sqlite3
-from contextlib import contextmanager
+import aiohttp
+from aiohttp import web
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from dotenv import load_dotenv
 import logging
-from typing import Optional, Dict, List, Union
+from typing import Optional, Dict, List, Union, AsyncIterator
 import discord
 from concurrent.futures import ThreadPoolExecutor
+from storage import (
+    CONFIG as STORAGE_CONFIG, EXPORT_DATASETS, INVOICE_EXPORT_COLUMNS, KEY_FILE_MAX_KEY_BYTES, DataManager,
+    KeyManager, KeyStore, backup_database, id_generator, init_key_database, iter_key_file, key_validation_app,
+    parse_export_range, prune_backups, release_stale_key_reservations, write_export
+)
 
 # TARGET_VOUCH_CHANNEL_ID = 1413262309106782268  # Removed - now using smart detection 
 
@@ -83,10 +88,19 @@ CATEGORIES = {
     'STATS': "📊 Server Stats"
 }
 CONFIG = {
-    'DATABASE_PATH': "product_keys.db",
-    'BACKUP_FOLDER': "backups",
-    'MAX_BACKUPS': 5,
+    **STORAGE_CONFIG,  # Database, inventory and backup settings live in storage.py
+    'ARCHIVE_AFTER_DAYS': 90,  # Age at which used keys and purchases are archived; 0 disables the daily run
     'BACKUP_INTERVAL_HOURS': 6,
+    'KEY_IMPORT_PROGRESS_SECONDS': 3,  # Minimum gap between import progress edits
+    'STOCK_RECONCILE_MINUTES': 10,  # How often the in-memory stock counters are checked against SQLite
+    'KEY_HOLD_MINUTES': 10,  # How long /confirm_payment holds a key for the customer
+    'LICENSE_NOTICE_HOURS': 72,  # DM customers this long before a timed license expires
+    'TIER_SYNC_HOURS': 6,  # How often every guild's customer tier roles are reconciled with purchases
+    'TIER_SYNC_EDITS_PER_SECOND': 2,  # Pace of role edits from the tier worker, well under Discord's limits
+    'SALES_HOURLY_RETENTION_DAYS': 30,  # Hourly buckets and weekly leaderboards older than this are dropped
+    'KEY_VALIDATION_HOST': os.environ.get("KEY_VALIDATION_HOST", "127.0.0.1"),
+    'KEY_VALIDATION_PORT': int(os.environ.get("KEY_VALIDATION_PORT", 8081)),  # 0 disables the /validate endpoint
+    'KEY_VALIDATION_TOKEN': os.environ.get("KEY_VALIDATION_TOKEN"),  # Bearer token loaders must send, if set
     'MAIN_COLOR': 0x028DF3,  # Custom Blue Color
     'SUCCESS_COLOR': 0x00FF7F,  # Spring Green
     'ERROR_COLOR': 0xFF4444,    # Red
@@ -393,7 +407,7 @@ async def setup_server(interaction: discord.Interaction):
                     if guild_id not in data_manager.data['ticket_config']:
                         data_manager.data['ticket_config'][guild_id] = {}
                     data_manager.data['ticket_config'][guild_id]['support_role_id'] = new_role.id
-                    data_manager.save_category_data('ticket_config')
+                    data_manager.save_category_data('ticket_config', guild_id)
                     
             except discord.Forbidden:
                 view.failed_tasks.append(f"Failed to create: {role_name}")
@@ -558,13 +572,13 @@ async def setup_server(interaction: discord.Interaction):
                             if guild_id not in data_manager.data['stats_channels']:
                                 data_manager.data['stats_channels'][guild_id] = {}
                             data_manager.data['stats_channels'][guild_id]['member_channel'] = new_channel.id
-                            data_manager.save_category_data('stats_channels')
+                            data_manager.save_category_data('stats_channels', guild_id)
                         elif 'Bots' in channel_name:
                             guild_id = str(guild.id)
                             if guild_id not in data_manager.data['stats_channels']:
                                 data_manager.data['stats_channels'][guild_id] = {}
                             data_manager.data['stats_channels'][guild_id]['bot_channel'] = new_channel.id
-                            data_manager.save_category_data('stats_channels')
+                            data_manager.save_category_data('stats_channels', guild_id)
                     
                     created_items['channels'].append(channel_name)
                     view.completed_tasks.append(f"Created #{channel_name}")
@@ -610,7 +624,7 @@ async def setup_server(interaction: discord.Interaction):
             if guild_id not in data_manager.data.get('log_config', {}):
                 data_manager.data['log_config'][guild_id] = {}
             data_manager.data['log_config'][guild_id]['admin_role_id'] = admin_role.id if admin_role else None
-            data_manager.save_category_data('log_config')
+            data_manager.save_category_data('log_config', guild_id)
             
             view.completed_tasks.append(f"Created private category: {log_category_name}")
         except discord.Forbidden:
@@ -1247,335 +1261,36 @@ class ConfirmDeleteView(discord.ui.View):
         )
         await interaction.response.edit_message(embed=embed, view=None)
 
-# === SQLite Key Management System ===
-def init_key_database():
-    conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
-    cursor = conn.cursor()
-    
-    # Products table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Keys table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS keys (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_name TEXT NOT NULL,
-            key_value TEXT NOT NULL UNIQUE,
-            used BOOLEAN DEFAULT FALSE,
-            user_tag TEXT DEFAULT NULL,
-            user_id INTEGER DEFAULT NULL,
-            date_used TIMESTAMP DEFAULT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (product_name) REFERENCES products(name)
-        )
-    ''')
-    
-    # User purchases tracking
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_purchases (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            user_tag TEXT NOT NULL,
-            product_name TEXT NOT NULL,
-            amount_spent REAL DEFAULT 0.0,
-            purchase_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            transaction_id TEXT UNIQUE
-        )
-    ''')
-    
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_keys_product ON keys(product_name);')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_keys_used ON keys(used);')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_keys_user ON keys(user_id);')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_purchases_user ON user_purchases(user_id);')
-    
-    conn.commit()
-    conn.close()
-    logger.info("✅ SQLite key database initialized")
-
-@contextmanager
-def get_db_connection():
-    conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
-
-class KeyManager:
-    @staticmethod
-    async def add_product(product_name: str, description: str = "") -> bool:
-        def sync_add():
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT OR IGNORE INTO products (name, description) VALUES (?, ?)",
-                    (product_name.strip(), description)
-                )
-                conn.commit()
-                return cursor.rowcount > 0
-        
-        try:
-            return await bot.loop.run_in_executor(None, sync_add)
-        except Exception as e:
-            logger.error(f"❌ Error creating product '{product_name}': {e}")
-            return False
-
-    @staticmethod
-    async def add_keys_to_product(product_name: str, keys: List[str]) -> Dict[str, Union[bool, str, int]]:
-        def sync_add():
-            if not keys:
-                return {"success": False, "message": "No keys provided", "added": 0, "duplicates": 0}
-        
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            # Ensure product exists first - sync call within executor
-            cursor.execute("INSERT OR IGNORE INTO products (name, description) VALUES (?, ?)", 
-                          (product_name.strip(), ""))
-            
-            added_count = 0
-            duplicate_count = 0
-            
-            for key in keys:
-                key = key.strip()
-                if not key:
-                    continue
-                try:
-                    cursor.execute(
-                        "INSERT INTO keys (product_name, key_value) VALUES (?, ?)",
-                        (product_name.strip(), key)
-                    )
-                    added_count += 1
-                except sqlite3.IntegrityError:
-                    duplicate_count += 1
-                    logger.warning(f"Duplicate key skipped for {product_name}: {key[:10]}...")
-            
-            conn.commit()
-            result_msg = f"Added {added_count} keys to {product_name}"
-            if duplicate_count > 0:
-                result_msg += f" ({duplicate_count} duplicates skipped)"
-            logger.info(f"✅ {result_msg}")
-            return {"success": True, "message": result_msg, "added": added_count, "duplicates": duplicate_count}
-    
-        try:
-            return await bot.loop.run_in_executor(None, sync_add)
-        except Exception as e:
-            logger.error(f"❌ Error adding keys to {product_name}: {e}")
-            return {"success": False, "message": f"Database error: {str(e)}", "added": 0, "duplicates": 0}
-    
-    @staticmethod
-    async def use_product_key(product_name: str, user_tag: str, user_id: int, amount_spent: float = 0.0) -> Optional[str]:
-        def sync_use():
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT id, key_value FROM keys 
-                    WHERE product_name = ? AND used = FALSE 
-                    LIMIT 1
-                ''', (product_name.strip(),))
-                result = cursor.fetchone()
-                if not result:
-                    return None
-                
-                key_id, key_value = result['id'], result['key_value']
-                cursor.execute('''
-                    UPDATE keys 
-                    SET used = TRUE, user_tag = ?, user_id = ?, date_used = CURRENT_TIMESTAMP 
-                    WHERE id = ?
-                ''', (user_tag, user_id, key_id))
-                
-                # Add to purchase history
-                transaction_id = f"txn_{user_id}_{int(datetime.now().timestamp())}"
-                cursor.execute('''
-                    INSERT INTO user_purchases (user_id, user_tag, product_name, amount_spent, transaction_id)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, user_tag, product_name, amount_spent, transaction_id))
-                
-                conn.commit()
-                return key_value
-        
-        try:
-            return await bot.loop.run_in_executor(None, sync_use)
-        except Exception as e:
-            logger.error(f"❌ Error using key for {product_name}: {e}")
-            return None
-    
-    @staticmethod
-    async def get_product_stock(product_name: str = None) -> Union[int, Dict[str, int]]:
-        def sync_get():
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                if product_name:
-                    cursor.execute('''
-                        SELECT COUNT(*) as count FROM keys 
-                        WHERE product_name = ? AND used = FALSE
-                    ''', (product_name.strip(),))
-                    result = cursor.fetchone()
-                    return result['count'] if result else 0
-                else:
-                    cursor.execute('''
-                        SELECT product_name, COUNT(*) as count FROM keys 
-                        WHERE used = FALSE 
-                        GROUP BY product_name
-                        ORDER BY product_name
-                    ''')
-                    results = cursor.fetchall()
-                    return {row['product_name']: row['count'] for row in results}
-        
-        try:
-            return await bot.loop.run_in_executor(None, sync_get)
-        except Exception as e:
-            logger.error(f"❌ Error getting stock: {e}")
-            return {} if not product_name else 0
-    
-    @staticmethod
-    async def get_user_purchases_detailed(user_id: int) -> Dict:
-        def sync_get():
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT product_name, COUNT(*) as count, SUM(amount_spent) as total_spent,
-                           MAX(purchase_date) as last_purchase
-                    FROM user_purchases 
-                    WHERE user_id = ? 
-                    GROUP BY product_name
-                    ORDER BY last_purchase DESC
-                ''', (user_id,))
-                purchases = cursor.fetchall()
-                
-                cursor.execute('''
-                    SELECT COUNT(*) as total_purchases, SUM(amount_spent) as lifetime_spent
-                    FROM user_purchases 
-                    WHERE user_id = ?
-                ''', (user_id,))
-                totals = cursor.fetchone()
-                
-                return {
-                    "purchases": [dict(row) for row in purchases],
-                    "total_purchases": totals['total_purchases'] or 0,
-                    "lifetime_spent": totals['lifetime_spent'] or 0.0
-                }
-        
-        try:
-            return await bot.loop.run_in_executor(None, sync_get)
-        except Exception as e:
-            logger.error(f"❌ Error getting purchases for user {user_id}: {e}")
-            return {"purchases": [], "total_purchases": 0, "lifetime_spent": 0.0}
-
 # Initialize database
 init_key_database()
-key_manager = KeyManager()
-
-class DataManager:
-    def __init__(self):
-        self.data_files = {
-            'warnings': 'warnings.json',
-            'auto_roles': 'auto_roles.json',
-            'afk': 'afk_status.json',
-            'giveaways': 'giveaways.json',
-            'templates': 'templates.json',
-            'vouches': 'vouch_data.json',
-            'welcome': 'welcome_config.json',
-            'verification': 'verification_config.json',
-            'stats_channels': 'stats_channels.json',
-            'dashboard': 'dashboard_config.json',
-            'user_profiles': 'user_profiles.json',
-            'ticket_config': 'ticket_config.json',
-            'dm_templates': 'dm_templates.json',
-            'invoices': 'invoices.json',
-            'invoice_templates': 'invoice_templates.json',
-            'branding': 'branding.json',
-            'log_config': 'log_config.json'
-        }
-        self.data = {}
-        self.load_all_data()
-
-        # FIX: Better branding initialization
-        self.initialize_branding()
-
-    def initialize_branding(self):
-        """Ensure branding data has all required keys"""
-        default_branding = {
-            'logo_url': "https://media.discordapp.net/attachments/1162388547211370526/1403113823837225082/Copilot_20250805_220724.png?ex=68b7fd54&is=68b6abd4&hm=697f9370d16228dce734cea688dc39c3301bdcd4435bd4e15093b573a18f84b8&=&format=webp&quality=lossless&width=525&height=350",
-            'banner_url': "https://media.discordapp.net/attachments/1162388547211370526/1403113823837225082/Copilot_20250805_220724.png?ex=68b7fd54&is=68b6abd4&hm=697f9370d16228dce734cea688dc39c3301bdcd4435bd4e15093b573a18f84b8&=&format=webp&quality=lossless&width=525&height=350",
-            'primary_color': CONFIG['MAIN_COLOR'],
-            'company_name': "NorthernHub",
-            'footer_text': "NorthernHub • Premium Trusted Service"
-        }
-        
-        # Initialize branding if it doesn't exist or is missing keys
-        if 'branding' not in self.data or not isinstance(self.data['branding'], dict):
-            self.data['branding'] = default_branding.copy()
-            self.save_category_data('branding')
-        else:
-            # Check if all required keys exist, add missing ones
-            updated = False
-            for key, default_value in default_branding.items():
-                if key not in self.data['branding']:
-                    self.data['branding'][key] = default_value
-                    updated = True
-            
-            if updated:
-                self.save_category_data('branding')
+release_stale_key_reservations()
+key_manager = KeyManager(KeyStore(CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH']))
 
-    def load_all_data(self):
-        for key, filename in self.data_files.items():
-            self.data[key] = self.load_data(filename, {})
+# --- KEY VALIDATION ENDPOINT ---
+validation_runner: Optional[web.AppRunner] = None
 
-    def load_data(self, filename: str, default_value=None) -> dict:
-        if default_value is None:
-            default_value = {}
-            
-        if not os.path.exists(filename):
-            logger.info(f"Creating new data file: {filename}")
-            self.save_data(filename, default_value)
-            return default_value
-            
-        try:
-            with open(filename, "r", encoding='utf-8') as f:
-                data = json.load(f)
-                logger.info(f"Successfully loaded {filename}")
-                return data
-        except (json.JSONDecodeError, FileNotFoundError) as e:
-            logger.error(f"Error loading {filename}: {e}. Using default value.")
-            if os.path.exists(filename):
-                backup_name = f"{filename}.corrupted.{int(datetime.now().timestamp())}"
-                os.rename(filename, backup_name)
-                logger.info(f"Backed up corrupted file to {backup_name}")
-            return default_value
-
-    def save_data(self, filename: str, data: dict) -> bool:
-        try:
-            temp_filename = f"{filename}.temp"
-            with open(temp_filename, "w", encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            
-            if os.path.exists(filename):
-                os.replace(temp_filename, filename)
-            else:
-                os.rename(temp_filename, filename)
-            
-            return True
-        except Exception as e:
-            logger.error(f"Error saving {filename}: {e}")
-            if os.path.exists(temp_filename):
-                os.remove(temp_filename)
-            return False
+async def start_key_validation_server():
+    global validation_runner
+    if validation_runner is not None or not CONFIG['KEY_VALIDATION_PORT']:
+        return
+    app = key_validation_app(key_manager.used_keys, CONFIG['KEY_VALIDATION_TOKEN'])
+    validation_runner = web.AppRunner(app, access_log=None)
+    await validation_runner.setup()
+    try:
+        await web.TCPSite(validation_runner, CONFIG['KEY_VALIDATION_HOST'], CONFIG['KEY_VALIDATION_PORT']).start()
+        logger.info(f"✅ Key validation endpoint on {CONFIG['KEY_VALIDATION_HOST']}:{CONFIG['KEY_VALIDATION_PORT']}")
+        await key_manager.load_used_key_index()
+    except Exception as e:
+        logger.error(f"❌ Failed to start key validation endpoint: {e}")
 
-    def save_category_data(self, category: str):
-        if category in self.data_files:
-            filename = self.data_files[category]
-            return self.save_data(filename, self.data[category])
-        return False
+async def stop_key_validation_server():
+    global validation_runner
+    if validation_runner is not None:
+        await validation_runner.cleanup()
+        validation_runner = None
 
 # Initialize data manager
-data_manager = DataManager()
+data_manager = DataManager(key_manager.store, CONFIG['MAIN_COLOR'])
 
 
 
@@ -1601,6 +1316,17 @@ def initialize_default_templates():
 
 initialize_default_templates()
 # --- UTILITY FUNCTIONS ---
+KEY_FILE_EXTENSIONS = ('.txt', '.csv')
+
+async def iter_attachment_keys(attachment: discord.Attachment, rejected: List[int]) -> AsyncIterator[str]:
+    """Stream keys out of a .txt/.csv attachment without buffering the whole file; line numbers of
+    values that could not be read are appended to rejected"""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            async for value in iter_key_file(response.content.iter_chunked(64 * 1024), rejected):
+                yield value
+
 
 
 async def find_vouch_channel(guild: discord.Guild) -> Optional[discord.TextChannel]:
@@ -1915,6 +1641,118 @@ def get_next_tier_amount(total_spent: float) -> float:
         return 1000.0
     else:
         return float('inf')  # Max tier - use inf to indicate no next tier
+
+class TierEngine:
+    """Customer tier roles: role IDs cached per guild, role diffs applied by one paced worker"""
+
+    def __init__(self):
+        self.tier_names = list(REQUIRED_ROLES['customer_tiers'])
+        self.role_ids: Dict[int, Dict[str, int]] = {}
+        # (guild_id, member_id) -> wanted tier; the queue holds each key once
+        self.pending: Dict[tuple, Optional[str]] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.applied = 0
+        self.failed = 0
+
+    def tier_roles(self, guild: discord.Guild) -> Dict[str, discord.Role]:
+        cached = self.role_ids.get(guild.id)
+        if cached is not None:
+            roles = {tier: guild.get_role(role_id) for tier, role_id in cached.items()}
+            if all(roles.values()):
+                return roles
+        
+        # Setup creates "💎 Diamond Customer"; older servers may use the name without the emoji
+        by_name = {role.name: role for role in guild.roles}
+        roles = {}
+        for tier in self.tier_names:
+            role = by_name.get(tier) or by_name.get(tier.split(" ", 1)[1])
+            if role:
+                roles[tier] = role
+        self.role_ids[guild.id] = {tier: role.id for tier, role in roles.items()}
+        return roles
+
+    def target_roles(self, member: discord.Member, tier: Optional[str],
+                     roles: Dict[str, discord.Role]) -> Optional[List[discord.Role]]:
+        """The member's roles with only the wanted tier role, or None when nothing would change"""
+        current = [role for role in member.roles if not role.is_default()]
+        tier_role_ids = {role.id for role in roles.values()}
+        target = [role for role in current if role.id not in tier_role_ids]
+        if tier in roles:
+            target.append(roles[tier])
+        if {role.id for role in target} == {role.id for role in current}:
+            return None
+        return target
+
+    async def apply(self, member: discord.Member, tier: Optional[str], reason: str = "Customer tier update") -> bool:
+        """Set the member's tier role in a single role edit; returns whether anything changed"""
+        target = self.target_roles(member, tier, self.tier_roles(member.guild))
+        if target is None:
+            return False
+        
+        for attempt in range(3):
+            try:
+                await member.edit(roles=target, reason=reason)
+                self.applied += 1
+                return True
+            except discord.RateLimited as e:
+                await asyncio.sleep(e.retry_after)
+            except discord.Forbidden:
+                logger.warning(f"Failed to update tier roles for {member.name}")
+                break
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    logger.error(f"❌ Tier role update for {member.name} failed: {e}")
+                    break
+                await asyncio.sleep(5 * (attempt + 1))
+        self.failed += 1
+        return False
+
+    def enqueue(self, member: discord.Member, tier: Optional[str]):
+        key = (member.guild.id, member.id)
+        if key not in self.pending:
+            if self.queue is None:
+                self.queue = asyncio.Queue()
+            self.queue.put_nowait(key)
+        self.pending[key] = tier
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            key = await self.queue.get()
+            tier = self.pending.pop(key, None)
+            guild = bot.get_guild(key[0])
+            member = guild.get_member(key[1]) if guild else None
+            # Re-diffed against the member's roles now, so edits made since the sync are respected
+            if member and await self.apply(member, tier, reason="Customer tier sync"):
+                await asyncio.sleep(1 / CONFIG['TIER_SYNC_EDITS_PER_SECOND'])
+
+    async def sync(self, guilds: List[discord.Guild], dry_run: bool = False) -> Dict[str, int]:
+        """Diff every customer's tier against their roles in the guilds and queue only the changes"""
+        guilds = [guild for guild in guilds if self.tier_roles(guild)]
+        lapsed = {guild.id: await key_manager.get_lapsed_customers(guild.id) for guild in guilds}
+        summary = {"customers": 0, "changes": 0, "unchanged": 0}
+        if not guilds:
+            return summary
+        
+        async for user_id, lifetime_spent in key_manager.iter_lifetime_spend():
+            tier = get_customer_tier(lifetime_spent)[0]
+            for guild in guilds:
+                member = guild.get_member(user_id)
+                if not member:
+                    continue
+                wanted = None if user_id in lapsed[guild.id] else tier
+                summary["customers"] += 1
+                if self.target_roles(member, wanted, self.tier_roles(guild)) is None:
+                    summary["unchanged"] += 1
+                    continue
+                summary["changes"] += 1
+                if not dry_run:
+                    self.enqueue(member, wanted)
+        return summary
+
+tier_engine = TierEngine()
     
 def get_branding_data():
     """Safely get branding data with fallbacks"""
@@ -1943,79 +1781,38 @@ def get_branding_data():
 
 # Function to calculate invoice statistics
 async def calculate_invoice_stats(guild_id: str) -> dict:
-    """Calculate invoice statistics for a guild"""
-    if guild_id not in data_manager.data['invoices']:
-        return {
-            "total_invoices": 0,
-            "total_revenue": 0,
-            "avg_invoice_value": 0,
-            "invoices_this_month": 0,
-            "revenue_this_month": 0,
-            "top_products": [],
-            "top_customers": []
-        }
-    
-    invoices = data_manager.data['invoices'][guild_id].values()
-    
-    # Basic stats
-    total_invoices = len(invoices)
-    total_revenue = sum(invoice.get('amount', 0) for invoice in invoices)
-    avg_invoice_value = total_revenue / total_invoices if total_invoices > 0 else 0
-    
-    # Time-based stats
-    now = datetime.now()
-    this_month_start = datetime(now.year, now.month, 1, 0, 0, 0)
-    this_month_timestamp = int(this_month_start.timestamp())
-    
-    invoices_this_month = sum(1 for invoice in invoices if invoice.get('timestamp', 0) >= this_month_timestamp)
-    revenue_this_month = sum(invoice.get('amount', 0) for invoice in invoices if invoice.get('timestamp', 0) >= this_month_timestamp)
-    
-    # Product stats
-    product_sales = {}
-    for invoice in invoices:
-        product = invoice.get('product')
-        if product:
-            if product not in product_sales:
-                product_sales[product] = {"count": 0, "revenue": 0}
-            product_sales[product]["count"] += 1
-            product_sales[product]["revenue"] += invoice.get('amount', 0)
-    
-    top_products = sorted(
-        [{"name": k, "count": v["count"], "revenue": v["revenue"]} for k, v in product_sales.items()],
-        key=lambda x: x["revenue"],
-        reverse=True
-    )[:5]
-    
-    # Customer stats
-    customer_purchases = {}
-    for invoice in invoices:
-        customer_id = invoice.get('customer_id')
-        if customer_id:
-            if customer_id not in customer_purchases:
-                customer_purchases[customer_id] = {
-                    "count": 0, 
-                    "revenue": 0, 
-                    "tag": invoice.get('customer_tag', f"User {customer_id}")
-                }
-            customer_purchases[customer_id]["count"] += 1
-            customer_purchases[customer_id]["revenue"] += invoice.get('amount', 0)
-    
-    top_customers = sorted(
-        [{"id": k, "tag": v["tag"], "count": v["count"], "revenue": v["revenue"]} for k, v in customer_purchases.items()],
-        key=lambda x: x["revenue"],
-        reverse=True
-    )[:5]
+    """Calculate invoice statistics for a guild from the sales rollups"""
+    month_start = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    summary = await key_manager.get_sales_summary(int(guild_id), 'invoice', month_start.timestamp())
     
+    total_invoices = summary['count']
+    total_revenue = summary['revenue']
     return {
         "total_invoices": total_invoices,
         "total_revenue": total_revenue,
-        "avg_invoice_value": avg_invoice_value,
-        "invoices_this_month": invoices_this_month,
-        "revenue_this_month": revenue_this_month,
-        "top_products": top_products,
-        "top_customers": top_customers
+        "avg_invoice_value": total_revenue / total_invoices if total_invoices > 0 else 0,
+        "invoices_this_month": summary['recent_count'],
+        "revenue_this_month": summary['recent_revenue'],
+        "top_products": [
+            {"name": product['member'], "count": product['count'], "revenue": product['revenue']}
+            for product in summary['top_products']
+        ],
+        "top_customers": [
+            {"id": int(customer['member']), "tag": customer['label'] or f"User {customer['member']}",
+             "count": customer['count'], "revenue": customer['revenue']}
+            for customer in summary['top_customers']
+        ]
     }
 
+async def backfill_sales_rollups():
+    """Build the sales rollups from existing purchases and invoices the first time they are empty"""
+    try:
+        if await key_manager.has_sales_rollups():
+            return
+        await key_manager.rebuild_sales_rollups()
+    except Exception as e:
+        logger.error(f"❌ Sales rollup backfill failed: {e}")
+
 # Add this after the get_branding_data() function (around line 800-900)
 
 async def setup_bot_permissions(guild):
@@ -2290,7 +2087,7 @@ class DMTemplateModal(discord.ui.Modal, title="Create DM Template"):
             'created_at': datetime.now().isoformat()
         }
         
-        data_manager.save_category_data('dm_templates')
+        data_manager.save_category_data('dm_templates', guild_id)
         await interaction.response.send_message(f"✅ DM template `{self.template_name.value}` created successfully!", ephemeral=True)
 
 class TicketTranscriptModal(discord.ui.Modal, title="Close Ticket & Transcript Options"):
@@ -2466,7 +2263,7 @@ class InvoiceTemplateModal(discord.ui.Modal, title="Create Invoice Template"):
             'created_at': datetime.now().isoformat()
         }
         
-        data_manager.save_category_data('invoice_templates')
+        data_manager.save_category_data('invoice_templates', guild_id)
         
         # Show preview
         title = self.embed_title.value.replace("{invoice_id}", "12345").replace("{product}", "Sample Product")
@@ -2651,9 +2448,6 @@ async def set_vouch_channel(interaction: discord.Interaction, channel: discord.T
     
     # Store the channel ID in the data manager
     guild_id = str(interaction.guild.id)
-    if 'vouch_config' not in data_manager.data:
-        data_manager.data['vouch_config'] = {}
-    
     data_manager.data['vouch_config'][guild_id] = {
         'channel_id': channel.id,
         'channel_name': channel.name,
@@ -2661,7 +2455,7 @@ async def set_vouch_channel(interaction: discord.Interaction, channel: discord.T
         'set_at': datetime.now().isoformat()
     }
     
-    data_manager.save_data('vouch_config.json', data_manager.data['vouch_config'])
+    data_manager.save_category_data('vouch_config', guild_id)
     
     embed = create_embed(
         "✅ Vouch Channel Set",
@@ -2796,19 +2590,13 @@ class EnhancedVouchModal(discord.ui.Modal):  # ✅ Correct class definition
             return
 
         # Store vouch data
-        user_id = str(interaction.user.id)
-        if user_id not in data_manager.data['vouches']:
-            data_manager.data['vouches'][user_id] = {"count": 0, "vouches": []}
-        
-        data_manager.data['vouches'][user_id]["count"] += 1
-        data_manager.data['vouches'][user_id]["vouches"].append({
+        vouch_count = await data_manager.add_vouch(interaction.user.id, {
             "product": self.product_input.value,
             "rating": rating,
             "experience": self.experience_input.value,
             "supporter": self.supporter_input.value,
             "timestamp": datetime.now().isoformat()
-        })
-        data_manager.save_category_data('vouches')
+        }, interaction.guild.id if interaction.guild else None)
 
         # Create vouch embed
         stars = "⭐" * rating
@@ -2819,7 +2607,7 @@ class EnhancedVouchModal(discord.ui.Modal):  # ✅ Correct class definition
             thumbnail=interaction.user.display_avatar.url,
             fields=[
                 ("💭 Experience", f"```{self.experience_input.value}```", False),
-                ("📊 Total Reviews", f"{data_manager.data['vouches'][user_id]['count']}", True),
+                ("📊 Total Reviews", f"{vouch_count}", True),
                 ("📅 Date", f"<t:{int(datetime.now().timestamp())}:R>", True)
             ]
         )
@@ -3235,11 +3023,21 @@ class CreateTicketDirectButton(discord.ui.Button):
 
 # --- KEY DELIVERY SYSTEM ---
 class EnhancedDeliverKeyView(discord.ui.View):
-    def __init__(self, user, product, amount_spent=0.0):
-        super().__init__(timeout=300)
+    def __init__(self, user, product, amount_spent=0.0, hold_token=None, owns_hold=False):
+        # Lives as long as the key hold, so the button never outlasts the key it delivers
+        super().__init__(timeout=CONFIG['KEY_HOLD_MINUTES'] * 60)
         self.user = user
         self.product = product
         self.amount_spent = amount_spent
+        self.hold_token = hold_token
+        # A repeat confirmation reuses the customer's hold; only the view that placed it releases it
+        self.owns_hold = owns_hold
+
+    async def on_timeout(self):
+        if self.hold_token and self.owns_hold:
+            # A later confirmation may have extended the hold; the expiry sweep frees it after that
+            await key_manager.release_hold(self.hold_token, only_expired=True)
+            self.hold_token = None
 
     @discord.ui.button(label="Deliver Key", style=discord.ButtonStyle.success, emoji="🔑")
     async def deliver_key(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -3251,8 +3049,8 @@ class EnhancedDeliverKeyView(discord.ui.View):
         await interaction.response.edit_message(view=self)
         
         # Check stock
-        stock = await key_manager.get_product_stock(self.product)
-        if stock <= 0:
+        stock = await key_manager.get_product_stock(self.product, interaction.guild.id)
+        if stock <= 0 and not self.hold_token:
             embed = create_embed(
                 "❌ No Keys Available", 
                 f"No available keys found for **{self.product}**.", 
@@ -3263,7 +3061,14 @@ class EnhancedDeliverKeyView(discord.ui.View):
 
         # Deliver key
         user_tag = f"{self.user.name}#{self.user.discriminator}"
-        key = await key_manager.use_product_key(self.product, user_tag, self.user.id, self.amount_spent)
+        key = None
+        if self.hold_token:
+            key = await key_manager.claim_held_key(self.hold_token, user_tag, self.user.id, self.amount_spent,
+                                                   guild_id=interaction.guild.id)
+            self.hold_token = None
+        if not key:
+            key = await key_manager.use_product_key(self.product, user_tag, self.user.id, self.amount_spent,
+                                                    guild_id=interaction.guild.id)
         
         if not key:
             embed = create_embed(
@@ -3274,9 +3079,9 @@ class EnhancedDeliverKeyView(discord.ui.View):
             await interaction.edit_original_response(embed=embed, view=None)
             return
 
-        # Get user's purchase data for tier calculation
-        purchase_data = await key_manager.get_user_purchases_detailed(self.user.id)
-        tier_name, tier_color = get_customer_tier(purchase_data['lifetime_spent'])
+        # Get user's purchase totals for tier calculation
+        purchase_totals = await key_manager.get_user_totals(self.user.id)
+        tier_name, tier_color = get_customer_tier(purchase_totals['lifetime_spent'])
 
         # Get DM template
         guild_id = str(interaction.guild.id)
@@ -3314,28 +3119,10 @@ class EnhancedDeliverKeyView(discord.ui.View):
         # Update user roles based on tier
         member = interaction.guild.get_member(self.user.id)
         if member:
-            try:
-                # Remove old tier roles and add new one
-                tier_roles = ["Diamond Customer", "Platinum Customer", "Gold Customer", "Silver Customer", "Bronze Customer", "New Customer"]
-                roles_to_remove = []
-                for role_name in tier_roles:
-                    role = discord.utils.get(interaction.guild.roles, name=role_name)
-                    if role and role in member.roles:
-                        roles_to_remove.append(role)
-                if roles_to_remove:
-                    await member.remove_roles(*roles_to_remove, reason="Tier update")
-                
-                # Add appropriate tier role
-                tier_role_name = tier_name.split(" ", 1)[1]  # Remove emoji
-                tier_role = discord.utils.get(interaction.guild.roles, name=tier_role_name)
-                if tier_role:
-                    await member.add_roles(tier_role, reason="Customer tier assignment")
-                
-            except discord.Forbidden:
-                logger.warning(f"Failed to update roles for {member.name}")
+            await tier_engine.apply(member, tier_name, reason="Customer tier assignment")
 
         # Create success response
-        remaining_stock = await key_manager.get_product_stock(self.product)
+        remaining_stock = await key_manager.get_product_stock(self.product, interaction.guild.id)
         
         success_embed = create_embed(
             "✅ Key Delivered Successfully",
@@ -3373,7 +3160,7 @@ class PostPurchaseActionsView(discord.ui.View):
             return
         
         # Generate invoice number and timestamp
-        invoice_num = random.randint(10000, 99999)
+        invoice_num = id_generator.next_id()
         timestamp = int(datetime.now().timestamp())
         
         # Get branding data safely
@@ -3394,14 +3181,7 @@ class PostPurchaseActionsView(discord.ui.View):
         }
         
         # Save to data storage
-        guild_id = str(interaction.guild.id)
-        if guild_id not in data_manager.data.get('invoices', {}):
-            if 'invoices' not in data_manager.data:
-                data_manager.data['invoices'] = {}
-            data_manager.data['invoices'][guild_id] = {}
-        
-        data_manager.data['invoices'][guild_id][str(invoice_num)] = invoice_data
-        data_manager.save_category_data('invoices')
+        await data_manager.add_invoice(invoice_data)
         
         # Create invoice embed
         invoice_embed = create_embed(
@@ -3487,30 +3267,19 @@ class GiveawayEntryView(discord.ui.View):
 
     @discord.ui.button(label="Enter Giveaway", style=discord.ButtonStyle.success, emoji="🎁")
     async def enter_giveaway(self, interaction: discord.Interaction, button: discord.ui.Button):
-        guild_id_str = str(interaction.guild.id)
-        
-        # Since the view is persistent, we might need to look up the giveaway by message_id
-        giveaway_data = data_manager.data['giveaways'].get(guild_id_str, {})
-        giveaway = None
-        for msg_id, gw_info in giveaway_data.items():
-            if gw_info.get("giveaway_id") == self.giveaway_id:
-                giveaway = gw_info
-                break
-
-        if not giveaway:
+        # The view is persistent, so the giveaway is looked up by its ID rather than the message
+        result = await data_manager.enter_giveaway(interaction.guild.id, self.giveaway_id, interaction.user.id)
+        if result is None:
             await interaction.response.send_message("❌ This giveaway is no longer active.", ephemeral=True)
             return
         
-        if interaction.user.id in giveaway["entries"]:
+        entered, entry_count = result
+        if not entered:
             await interaction.response.send_message("⚠️ You are already entered in this giveaway!", ephemeral=True)
             return
         
-        # Add entry
-        giveaway["entries"].append(interaction.user.id)
-        data_manager.save_category_data('giveaways')
-        
         # Update the button label within the view before sending the edit request
-        button.label = f"Enter Giveaway ({len(giveaway['entries'])})"
+        button.label = f"Enter Giveaway ({entry_count})"
         
         await interaction.response.edit_message(view=self)
         await interaction.followup.send("🎉 You've successfully entered the giveaway! Good luck!", ephemeral=True)
@@ -3573,12 +3342,7 @@ async def end_giveaway_logic(guild: discord.Guild, giveaway_info: dict):
             await message.edit(embed=end_embed, view=None)
 
         # Cleanup
-        guild_id_str = str(guild.id)
-        giveaway_message_id = str(giveaway_info['message_id'])
-        if (guild_id_str in data_manager.data['giveaways'] and 
-            giveaway_message_id in data_manager.data['giveaways'][guild_id_str]):
-            del data_manager.data['giveaways'][guild_id_str][giveaway_message_id]
-            data_manager.save_category_data('giveaways')
+        await data_manager.delete_giveaway(guild.id, giveaway_info['message_id'])
 
     except Exception as e:
         logger.error(f"Error ending giveaway: {e}")
@@ -3619,24 +3383,11 @@ async def check_temp_bans():
 async def check_giveaways():
     current_time = datetime.now(timezone.utc)
     
-    all_giveaways = data_manager.data['giveaways'].copy()
-
-    for guild_id_str, giveaways in all_giveaways.items():
-        guild = bot.get_guild(int(guild_id_str))
+    for giveaway_info in await data_manager.get_due_giveaways(current_time.timestamp()):
+        guild = bot.get_guild(giveaway_info['guild_id'])
         if not guild:
             continue
-            
-        expired_giveaways = []
-        for message_id, giveaway_info in giveaways.items():
-            try:
-                end_time = datetime.fromisoformat(giveaway_info['end_time'])
-                if current_time >= end_time:
-                    expired_giveaways.append(giveaway_info)
-            except (ValueError, KeyError):
-                expired_giveaways.append(giveaway_info)
-        
-        for giveaway_info in expired_giveaways:
-            await end_giveaway_logic(guild, giveaway_info)
+        await end_giveaway_logic(guild, giveaway_info)
 
 @tasks.loop(hours=CONFIG['BACKUP_INTERVAL_HOURS'])
 async def backup_data_task():
@@ -3659,12 +3410,18 @@ async def backup_data_task():
         backup_data = {
             "timestamp": timestamp,
             "bot_info": {"guild_count": len(bot.guilds), "user_count": len(bot.users)},
-            **data_manager.data
+            **await data_manager.snapshot_data()
         }
         
         backup_path = os.path.join(CONFIG['BACKUP_FOLDER'], f"complete_backup_{timestamp}.json")
         success = data_manager.save_data(backup_path, backup_data)
         
+        # Invoices, warnings, vouches and giveaways are in the key database, not data_manager.data
+        name = os.path.splitext(os.path.basename(CONFIG['DATABASE_PATH']))[0]
+        await asyncio.to_thread(backup_database, CONFIG['DATABASE_PATH'],
+                                os.path.join(CONFIG['BACKUP_FOLDER'], f"{name}_{timestamp}.db"))
+        prune_backups(f"{name}_", ".db")
+        
         if success:
             logger.info(f"✅ Data backup complete at {timestamp}")
         else:
@@ -3673,6 +3430,142 @@ async def backup_data_task():
     except Exception as e:
         logger.error(f"❌ Failed to perform data backup: {e}")
 
+@tasks.loop(minutes=CONFIG['STOCK_RECONCILE_MINUTES'])
+async def reconcile_stock_cache():
+    """Catch stock changes made outside this process (manual edits, other tools)"""
+    try:
+        await key_manager.reconcile_stock()
+    except Exception as e:
+        logger.error(f"❌ Stock cache reconcile failed: {e}")
+
+@tasks.loop(seconds=30)
+async def sweep_key_holds():
+    """Return expired payment holds to stock"""
+    try:
+        await key_manager.release_expired_holds()
+    except Exception as e:
+        logger.error(f"❌ Key hold sweep failed: {e}")
+
+# Upper bound on one scheduler sleep, so edits made outside the bot are still picked up
+LICENSE_SCHEDULER_MAX_SLEEP = 6 * 3600
+license_scheduler_task: Optional[asyncio.Task] = None
+
+async def send_license_notice(license_info: Dict) -> bool:
+    """DM an expiry notice; False when Discord failed in a way worth retrying later"""
+    user = bot.get_user(license_info['user_id'])
+    try:
+        user = user or await bot.fetch_user(license_info['user_id'])
+        await user.send(embed=create_embed(
+            "⏰ License Expiring Soon",
+            f"Your **{license_info['product_name']}** license expires <t:{license_info['expires_at']}:R>.\n"
+            f"Open a ticket to renew before it runs out.",
+            CONFIG['WARNING_COLOR']
+        ))
+    except (discord.Forbidden, discord.NotFound):
+        logger.warning(f"⚠️ Could not DM expiry notice to user {license_info['user_id']}")
+    except discord.HTTPException as e:
+        logger.error(f"❌ Expiry notice to user {license_info['user_id']} failed, will retry: {e}")
+        return False
+    return True
+
+async def end_license(license_info: Dict):
+    user = bot.get_user(license_info['user_id'])
+    try:
+        user = user or await bot.fetch_user(license_info['user_id'])
+        await user.send(embed=create_embed(
+            "❌ License Expired",
+            f"Your **{license_info['product_name']}** license has expired. Open a ticket to renew it.",
+            CONFIG['ERROR_COLOR']
+        ))
+    except (discord.Forbidden, discord.NotFound):
+        logger.warning(f"⚠️ Could not DM expiry to user {license_info['user_id']}")
+    except discord.HTTPException as e:
+        logger.error(f"❌ Expiry DM to user {license_info['user_id']} failed: {e}")
+    
+    # Customers keep their tier roles while any other license in the guild is still running
+    guild = bot.get_guild(license_info['license_guild_id']) if license_info['license_guild_id'] else None
+    member = guild.get_member(license_info['user_id']) if guild else None
+    if not member or license_info['still_licensed']:
+        return
+    # Lifetime keys keep the tier their purchases earned; only license-only customers lose it
+    tier = None
+    if license_info['lifetime_customer']:
+        tier = get_customer_tier((await key_manager.get_user_totals(member.id))['lifetime_spent'])[0]
+    await tier_engine.apply(member, tier, reason=f"{license_info['product_name']} license expired")
+
+async def license_expiry_scheduler():
+    """Sleep until the next license notice or expiry instead of polling"""
+    await bot.wait_until_ready()
+    notice_seconds = CONFIG['LICENSE_NOTICE_HOURS'] * 3600
+    
+    while not bot.is_closed():
+        # Clear before reading the schedule so a claim landing meanwhile still wakes us
+        key_manager.license_started.clear()
+        retry_notices = False
+        try:
+            # A notice is marked only once it is sent, so a failed DM is tried again on a later pass
+            for license_info in await key_manager.get_due_license_notices(notice_seconds):
+                try:
+                    if await send_license_notice(license_info):
+                        await key_manager.mark_license_notified(license_info['id'])
+                    else:
+                        retry_notices = True
+                except Exception as e:
+                    logger.error(f"❌ Expiry notice for key {license_info['id']} failed: {e}")
+                    retry_notices = True
+            # Expired licenses are already deactivated; one failed DM or role edit must not skip the rest
+            for license_info in await key_manager.expire_licenses():
+                try:
+                    await end_license(license_info)
+                except Exception as e:
+                    logger.error(f"❌ Ending license for key {license_info['id']} failed: {e}")
+            next_event = await key_manager.next_license_event(notice_seconds)
+            if retry_notices:
+                # Unsent notices keep the next event in the past; back off instead of spinning
+                next_event = max(next_event or 0, time.time() + 60)
+        except Exception as e:
+            logger.error(f"❌ License expiry scheduler failed: {e}")
+            next_event = time.time() + 60
+        
+        sleep_for = LICENSE_SCHEDULER_MAX_SLEEP
+        if next_event is not None:
+            sleep_for = min(max(next_event - time.time(), 0), LICENSE_SCHEDULER_MAX_SLEEP)
+        try:
+            await asyncio.wait_for(key_manager.license_started.wait(), timeout=sleep_for)
+        except asyncio.TimeoutError:
+            pass
+
+@tasks.loop(hours=CONFIG['TIER_SYNC_HOURS'])
+async def sync_customer_tiers():
+    """Reconcile customer tier roles in every guild with lifetime spend"""
+    try:
+        summary = await tier_engine.sync(bot.guilds)
+        if summary['changes']:
+            logger.info(f"✅ Tier sync queued {summary['changes']} role updates "
+                        f"({summary['unchanged']} customers already correct)")
+    except Exception as e:
+        logger.error(f"❌ Tier sync failed: {e}")
+
+@tasks.loop(hours=24)
+async def prune_sales_rollups():
+    """Drop hourly sales buckets and weekly leaderboards past their retention"""
+    try:
+        pruned = await key_manager.prune_hourly_rollups(CONFIG['SALES_HOURLY_RETENTION_DAYS'])
+        if pruned:
+            logger.info(f"♻️ Pruned {pruned} old hourly sales buckets and weekly leaderboard rows")
+    except Exception as e:
+        logger.error(f"❌ Sales rollup prune failed: {e}")
+
+@tasks.loop(hours=24)
+async def archive_old_key_records():
+    """Keep the hot key and purchase tables small by moving old rows to the archive database"""
+    if CONFIG['ARCHIVE_AFTER_DAYS'] <= 0:
+        return
+    try:
+        await key_manager.archive_old_records(CONFIG['ARCHIVE_AFTER_DAYS'])
+    except Exception as e:
+        logger.error(f"❌ Key archive run failed: {e}")
+
 @tasks.loop(minutes=15)
 async def update_stats_channels():
     """Update server statistics channels"""
@@ -3719,6 +3612,7 @@ async def on_ready():
     # Start web server for hosting platforms
     web_server_thread = threading.Thread(target=web_server, daemon=True)
     web_server_thread.start()
+    await start_key_validation_server()
     bot.start_time = datetime.now()
 
     print(f"✅ {bot.user} is now online!")
@@ -3731,9 +3625,8 @@ async def on_ready():
     bot.add_view(CustomerVouchView(user=None, product=None)) # Register with dummy data
     
     # Re-register persistent giveaway views from storage
-    for guild_id_str, giveaways in data_manager.data['giveaways'].items():
-        for msg_id, gw_info in giveaways.items():
-            bot.add_view(GiveawayEntryView(gw_info['giveaway_id']))
+    for giveaway_id in await data_manager.get_giveaway_ids():
+        bot.add_view(GiveawayEntryView(giveaway_id))
 
     # Sync slash commands
     try:
@@ -3768,6 +3661,20 @@ async def on_ready():
         backup_data_task.start()
     if not update_stats_channels.is_running():
         update_stats_channels.start()
+    if not reconcile_stock_cache.is_running():
+        reconcile_stock_cache.start()
+    if not archive_old_key_records.is_running():
+        archive_old_key_records.start()
+    if not prune_sales_rollups.is_running():
+        prune_sales_rollups.start()
+    if not sync_customer_tiers.is_running():
+        sync_customer_tiers.start()
+    await backfill_sales_rollups()
+    if not sweep_key_holds.is_running():
+        sweep_key_holds.start()
+    global license_scheduler_task
+    if license_scheduler_task is None or license_scheduler_task.done():
+        license_scheduler_task = asyncio.create_task(license_expiry_scheduler())
     print("🔄 All background tasks started successfully")
 
 @bot.event
@@ -3792,6 +3699,19 @@ async def on_guild_join(guild):
     except Exception as e:
         print(f"❌ Sync error for {guild.name}: {e}")
 
+@bot.event
+async def on_guild_role_create(role):
+    tier_engine.role_ids.pop(role.guild.id, None)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    if before.name != after.name:
+        tier_engine.role_ids.pop(after.guild.id, None)
+
+@bot.event
+async def on_guild_role_delete(role):
+    tier_engine.role_ids.pop(role.guild.id, None)
+
 @bot.event
 async def on_member_join(member):
     guild = member.guild
@@ -3854,8 +3774,8 @@ async def on_message(message):
 
     # AFK system: remove status on message
     if user_id_str in data_manager.data['afk']:
-        afk_reason = data_manager.data['afk'].pop(user_id_str)
-        data_manager.save_category_data('afk')
+        afk_reason = data_manager.data['afk'][user_id_str]
+        data_manager.delete_record('afk', [user_id_str])
         try:
             await message.channel.send(f"✅ Welcome back, {message.author.mention}! Removed AFK status: `{afk_reason}`", delete_after=10)
         except discord.Forbidden:
@@ -5051,7 +4971,7 @@ async def setup_logs(interaction: discord.Interaction, admin_role: discord.Role)
     if guild_id not in data_manager.data.get('log_config', {}):
         data_manager.data['log_config'][guild_id] = {}
     data_manager.data['log_config'][guild_id]['admin_role_id'] = admin_role.id
-    data_manager.save_category_data('log_config')
+    data_manager.save_category_data('log_config', guild_id)
     
     # Find and move all existing log channels
     log_channel_names = [
@@ -5145,34 +5065,22 @@ async def view_invoices(interaction: discord.Interaction, user: discord.Member =
     await interaction.response.defer(ephemeral=True)
     
     target_user = user or interaction.user
-    guild_id = str(interaction.guild.id)
-    
-    if guild_id not in data_manager.data['invoices']:
-        await interaction.followup.send(f"❌ No invoices found for this server.", ephemeral=True)
-        return
-    
-    # Find all invoices for the user
-    user_invoices = []
-    for invoice_id, invoice_data in data_manager.data['invoices'][guild_id].items():
-        if invoice_data.get('customer_id') == target_user.id:
-            user_invoices.append(invoice_data)
     
+    # Newest first, straight from the (guild_id, customer_id, timestamp) index
+    invoice_count, user_invoices = await data_manager.get_customer_invoices(interaction.guild.id, target_user.id, 10)
     if not user_invoices:
         await interaction.followup.send(f"❌ No invoices found for {target_user.mention}.", ephemeral=True)
         return
     
-    # Sort by timestamp (newest first)
-    user_invoices.sort(key=lambda x: x.get('timestamp', 0), reverse=True)
-    
     embed = create_embed(
         f"📄 Invoices for {target_user.display_name}",
-        f"Found {len(user_invoices)} invoices for this user.",
+        f"Found {invoice_count} invoices for this user.",
         CONFIG['MAIN_COLOR'],
         thumbnail=target_user.display_avatar.url
     )
     
     # Add most recent 10 invoices
-    for invoice in user_invoices[:10]:
+    for invoice in user_invoices:
         embed.add_field(
             name=f"Invoice #{invoice['invoice_id']}",
             value=f"**Product:** {invoice['product']}\n**Date:** <t:{invoice['timestamp']}:F>\n**Processed by:** <@{invoice['processor_id']}>",
@@ -5201,7 +5109,7 @@ async def generate_invoice_command(
     
     try:
         # Generate invoice number and timestamp
-        invoice_num = random.randint(10000, 99999)
+        invoice_num = id_generator.next_id()
         timestamp = int(datetime.now().timestamp())
         
         # Get template data
@@ -5264,11 +5172,7 @@ async def generate_invoice_command(
         }
         
         # Save to data storage
-        if guild_id not in data_manager.data['invoices']:
-            data_manager.data['invoices'][guild_id] = {}
-        
-        data_manager.data['invoices'][guild_id][str(invoice_num)] = invoice_data
-        data_manager.save_category_data('invoices')
+        await data_manager.add_invoice(invoice_data)
         
         # Send invoice to DM
         dm_status = "❌ Could not send to DMs"
@@ -5407,7 +5311,7 @@ async def setup_ticket_support_role(interaction: discord.Interaction, role: disc
         data_manager.data['ticket_config'][guild_id] = {}
     
     data_manager.data['ticket_config'][guild_id]['support_role_id'] = role.id
-    data_manager.save_category_data('ticket_config')
+    data_manager.save_category_data('ticket_config', guild_id)
     
     embed = create_embed(
         "✅ Support Role Configured",
@@ -5449,8 +5353,16 @@ async def delete_product_template_autocomplete(
 )
 @app_commands.checks.has_permissions(administrator=True)
 async def confirm_payment(interaction: discord.Interaction, user: discord.User, product: str, amount: float = 0.0, template: str = "default"):
+    # The hold and stock reads wait on the key database; acknowledge before Discord's 3 second deadline
+    await interaction.response.defer(ephemeral=True)
+    
+    # Hold a key so another ticket can't take it before delivery
+    hold = await key_manager.hold_key(product, user.id, CONFIG['KEY_HOLD_MINUTES'], interaction.guild.id)
+    hold_token, hold_expires, hold_is_new = hold if hold else (None, None, False)
+    
     # Get the stock count FIRST
-    stock = await key_manager.get_product_stock(product)
+    stock = await key_manager.get_product_stock(product, interaction.guild.id)
+    held = await key_manager.get_held_stock(product)
     
     embed = create_embed(
         "🔑 Payment Confirmation & Key Delivery",
@@ -5458,14 +5370,15 @@ async def confirm_payment(interaction: discord.Interaction, user: discord.User,
         CONFIG['MAIN_COLOR'],
         fields=[
             # Now use the variable, not the coroutine
-            ("📦 Product Stock", f"{stock} keys available", True),
+            ("📦 Product Stock", f"{stock} keys available\n{held} held", True),
             ("💰 Amount", f"${amount:.2f}", True),
-            ("🎯 Template", template, True)
+            ("🎯 Template", template, True),
+            ("🔒 Key Hold", f"Held until <t:{int(hold_expires)}:t>" if hold_token else "⚠️ No key available to hold", True)
         ]
     )
     
-    view = EnhancedDeliverKeyView(user, product, amount)
-    await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
+    view = EnhancedDeliverKeyView(user, product, amount, hold_token, owns_hold=hold_is_new)
+    await interaction.followup.send(embed=embed, view=view, ephemeral=True)
 
 @bot.tree.command(name="setup_dm_template", description="Create a custom DM template for key delivery")
 @app_commands.checks.has_permissions(administrator=True)
@@ -5479,19 +5392,20 @@ async def check_keys(interaction: discord.Interaction, product: str = None):
     await interaction.response.defer(ephemeral=True)
     
     if product:
-        stock = await key_manager.get_product_stock(product)
+        stock = await key_manager.get_product_stock(product, interaction.guild.id)
+        held = await key_manager.get_held_stock(product)
         status_emoji = "✅" if stock > 10 else "⚠️" if stock > 0 else "❌"
         status_text = "Good Stock" if stock > 10 else "Low Stock" if stock > 0 else "OUT OF STOCK"
         color = CONFIG['SUCCESS_COLOR'] if stock > 10 else CONFIG['WARNING_COLOR'] if stock > 0 else CONFIG['ERROR_COLOR']
         
         embed = create_embed(
             f"{status_emoji} Stock Report: {product}",
-            f"**Available Keys:** {stock}\n**Status:** {status_text}",
+            f"**Available Keys:** {stock}\n**Held for Payments:** {held}\n**Status:** {status_text}",
             color,
             fields=[("⏰ Last Updated", f"<t:{int(datetime.now().timestamp())}:R>", True)]
         )
     else:
-        all_stock = await key_manager.get_product_stock()
+        all_stock = await key_manager.get_product_stock(guild_id=interaction.guild.id)
         embed = create_embed(
             "📦 Complete Stock Overview",
             f"Total products: {len(all_stock)}" if all_stock else "No products in database",
@@ -5511,23 +5425,425 @@ async def check_keys(interaction: discord.Interaction, product: str = None):
     
     await interaction.followup.send(embed=embed, ephemeral=True)
 
-@bot.tree.command(name="add_keys", description="Add license keys to a product")
-@app_commands.describe(product="Product name", keys="Comma-separated keys")
+@bot.tree.command(name="key_metrics", description="Show key store cache, pool and writer metrics")
 @app_commands.checks.has_permissions(administrator=True)
-async def add_keys(interaction: discord.Interaction, product: str, keys: str):
+async def key_metrics(interaction: discord.Interaction):
+    stock_metrics = key_manager.stock.metrics()
+    pool_metrics = key_manager.pool.metrics()
+    writer = key_manager.store.writer
+    validation_metrics = key_manager.used_keys.metrics()
+    analytics_metrics = key_manager.store.analytics.metrics()
+    last_reconciled = (
+        f"<t:{int(datetime.fromisoformat(stock_metrics['last_reconciled']).timestamp())}:R>"
+        if stock_metrics['last_reconciled'] else "Never"
+    )
+    
+    embed = create_embed(
+        "📈 Key Store Metrics",
+        "Stock cache, reservation pool, writer and read pool statistics since the bot started",
+        CONFIG['MAIN_COLOR'],
+        fields=[
+            ("📦 Stock Cache",
+             f"**Products:** {stock_metrics['products']}\n"
+             f"**Guild Slices:** {stock_metrics['guild_slices']}\n"
+             f"**Held Keys:** {stock_metrics['held']}\n"
+             f"**Hits:** {stock_metrics['hits']}\n"
+             f"**Misses:** {stock_metrics['misses']}\n"
+             f"**Hit Rate:** {stock_metrics['hit_rate']:.1%}", True),
+            ("🔄 Reconciliation",
+             f"**Runs:** {stock_metrics['reconciles']}\n"
+             f"**Drift Corrections:** {stock_metrics['drift_corrections']}\n"
+             f"**Last Drift:** {stock_metrics['last_drift']} keys\n"
+             f"**Last Run:** {last_reconciled}", True),
+            ("⚡ Reservation Pool",
+             f"**Hot Products:** {pool_metrics['products']}\n"
+             f"**Reserved Keys:** {pool_metrics['reserved']}\n"
+             f"**Pending Writes:** {pool_metrics['pending']}\n"
+             f"**Hit Rate:** {pool_metrics['hit_rate']:.1%}", True),
+            ("✍️ Writer Thread",
+             f"**Queue Depth:** {writer.queue_depth()}\n"
+             f"**Commits:** {writer.batches}\n"
+             f"**Operations:** {writer.operations}\n"
+             f"**Avg / Max Batch:** {writer.operations / max(writer.batches, 1):.1f} / {writer.largest_batch}", True),
+            ("🔎 Key Validation",
+             f"**Indexed Keys:** {validation_metrics['keys']} ({validation_metrics['expired']} expired)\n"
+             f"**Lookups:** {validation_metrics['lookups']}\n"
+             f"**Cache Hit Rate:** {validation_metrics['cache_hit_rate']:.1%}\n"
+             f"**Bloom Negatives:** {validation_metrics['bloom_negatives']}", True),
+            ("📊 Read Pools",
+             f"**Delivery Reader In Flight:** {key_manager.store.reader_in_flight}\n"
+             f"**Analytics Active:** {analytics_metrics['active']} / {analytics_metrics['size']}\n"
+             f"**Analytics Queue Depth:** {analytics_metrics['waiting']} (peak {analytics_metrics['peak_waiting']})\n"
+             f"**Analytics Queries:** {analytics_metrics['completed']} "
+             f"(avg wait {analytics_metrics['avg_wait_ms']:.1f} ms)", True)
+        ]
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="sales_trend", description="Show sales over recent hours or days")
+@app_commands.describe(period="Time range to chart", source="Key deliveries or invoices")
+@app_commands.choices(
+    period=[
+        app_commands.Choice(name="Last 24 hours", value="hourly"),
+        app_commands.Choice(name="Last 14 days", value="daily")
+    ],
+    source=[
+        app_commands.Choice(name="🔑 Key Purchases", value="purchase"),
+        app_commands.Choice(name="📄 Invoices", value="invoice")
+    ]
+)
+@app_commands.checks.has_permissions(administrator=True)
+async def sales_trend(interaction: discord.Interaction, period: str = "daily", source: str = "invoice"):
     await interaction.response.defer(ephemeral=True)
     
-    key_list = [key.strip() for key in keys.split(",") if key.strip()]
+    periods = 24 if period == "hourly" else 14
+    trend = await key_manager.get_sales_trend(interaction.guild.id, source, period, periods)
+    peak = max((revenue for _, _, revenue in trend), default=0) or 1
+    label_format = "%H:00" if period == "hourly" else "%m-%d"
+    lines = [
+        f"`{datetime.fromtimestamp(bucket, timezone.utc).strftime(label_format)}` "
+        f"{'█' * round(revenue / peak * 10) or '·'} {count} · ${revenue:,.2f}"
+        for bucket, count, revenue in trend
+    ]
     
-    if not key_list:
-        await interaction.followup.send("❌ No valid keys provided.", ephemeral=True)
+    embed = create_embed(
+        f"📈 Sales Trend ({'24 hours' if period == 'hourly' else '14 days'}, UTC)",
+        "\n".join(lines),
+        CONFIG['MAIN_COLOR'],
+        fields=[
+            ("🧾 Sales", f"{sum(count for _, count, _ in trend):,}", True),
+            ("💰 Revenue", f"${sum(revenue for _, _, revenue in trend):,.2f}", True)
+        ]
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="sync_tiers", description="Bring every customer's tier role in line with their spending")
+@app_commands.describe(dry_run="Only count the role changes that would be made")
+@app_commands.checks.has_permissions(administrator=True)
+async def sync_tiers(interaction: discord.Interaction, dry_run: bool = False):
+    await interaction.response.defer(ephemeral=True)
+    
+    if not tier_engine.tier_roles(interaction.guild):
+        await interaction.followup.send("❌ No customer tier roles found. Run the server setup to create them.",
+                                        ephemeral=True)
         return
+    try:
+        summary = await tier_engine.sync([interaction.guild], dry_run=dry_run)
+    except Exception as e:
+        logger.error(f"❌ Tier sync failed in {interaction.guild.name}: {e}")
+        await interaction.followup.send(f"❌ Tier sync failed: {str(e)}", ephemeral=True)
+        return
+    
+    seconds = summary['changes'] / CONFIG['TIER_SYNC_EDITS_PER_SECOND']
+    embed = create_embed(
+        "🏷️ Tier Sync (Dry Run)" if dry_run else "🏷️ Tier Sync Started",
+        "Role changes were counted but not applied." if dry_run else
+        f"Role updates are applied in the background, about {int(seconds // 60)}m {int(seconds % 60)}s in total.",
+        CONFIG['MAIN_COLOR'] if dry_run else CONFIG['SUCCESS_COLOR'],
+        fields=[
+            ("👥 Customers", f"{summary['customers']:,}", True),
+            ("🔄 Changes", f"{summary['changes']:,}", True),
+            ("✅ Already Correct", f"{summary['unchanged']:,}", True)
+        ]
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="leaderboard", description="Show the top spenders, products or invoice processors")
+@app_commands.describe(board="Which leaderboard", window="Time window", source="Key deliveries or invoices")
+@app_commands.choices(
+    board=[
+        app_commands.Choice(name="💰 Top Spenders", value="spenders"),
+        app_commands.Choice(name="📦 Top Products", value="products"),
+        app_commands.Choice(name="🧾 Top Processors", value="processors")
+    ],
+    window=[
+        app_commands.Choice(name="All Time", value="all"),
+        app_commands.Choice(name="This Month", value="month"),
+        app_commands.Choice(name="This Week", value="week")
+    ],
+    source=[
+        app_commands.Choice(name="📄 Invoices", value="invoice"),
+        app_commands.Choice(name="🔑 Key Purchases", value="purchase")
+    ]
+)
+@app_commands.checks.has_permissions(administrator=True)
+async def leaderboard(interaction: discord.Interaction, board: str = "spenders", window: str = "all",
+                      source: str = "invoice"):
+    await interaction.response.defer(ephemeral=True)
     
-    if len(key_list) > 100:
-        await interaction.followup.send("❌ Maximum 100 keys per command.", ephemeral=True)
+    entries = await key_manager.get_leaderboard(interaction.guild.id, source, board, window, top=10)
+    medals = ["🥇", "🥈", "🥉"]
+    lines = []
+    for rank, entry in enumerate(entries):
+        if board == "products":
+            name = f"**{entry['member']}**"
+        else:
+            name = f"<@{entry['member']}>"
+        unit = "sales" if board == "products" else ("invoices" if board == "processors" else "purchases")
+        lines.append(f"{medals[rank] if rank < 3 else f'`{rank + 1}.`'} {name} - ${entry['revenue']:,.2f} "
+                     f"({entry['count']} {unit})")
+    
+    if not lines:
+        lines = ["No sales recorded for this window yet" if board != "processors" or source == "invoice"
+                 else "Key purchases have no processor; choose the invoice source"]
+    window_names = {"all": "All Time", "month": "This Month (UTC)", "week": "This Week (UTC)"}
+    embed = create_embed(
+        f"🏆 {board.title()} Leaderboard - {window_names[window]}",
+        "\n".join(lines),
+        CONFIG['MAIN_COLOR']
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="rebuild_rollups", description="Recompute sales rollups from purchase history and invoices")
+@app_commands.checks.has_permissions(administrator=True)
+async def rebuild_rollups(interaction: discord.Interaction):
+    # The rollups cover every guild, so a guild admin alone is not enough
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("❌ Only the bot owner can rebuild sales rollups.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    
+    try:
+        counts = await key_manager.rebuild_sales_rollups()
+    except Exception as e:
+        logger.error(f"❌ Sales rollup rebuild failed: {e}")
+        await interaction.followup.send(f"❌ Rebuild failed: {str(e)}", ephemeral=True)
+        return
+    
+    embed = create_embed(
+        "♻️ Sales Rollups Rebuilt",
+        f"Recomputed from purchase history and **{counts['invoices']:,}** invoices",
+        CONFIG['SUCCESS_COLOR'],
+        fields=[
+            ("🕐 Hourly Buckets", f"{counts['sales_hourly']:,}", True),
+            ("📅 Daily Buckets", f"{counts['sales_daily']:,}", True),
+            ("🏆 Leaderboard Rows", f"{counts['leaderboards']:,}", True)
+        ]
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="guild_quota", description="Allocate a fixed share of a product's keys to a guild")
+@app_commands.describe(
+    product="Product name",
+    quota="Keys to keep allocated to the guild (0 returns them to the shared pool)",
+    guild_id="Guild to allocate to (defaults to this server)"
+)
+@app_commands.checks.has_permissions(administrator=True)
+async def guild_quota(interaction: discord.Interaction, product: str, quota: app_commands.Range[int, 0, 100000],
+                      guild_id: str = None):
+    # Quotas move keys between guilds, so a guild admin alone is not enough
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("❌ Only the bot owner can allocate shared inventory.", ephemeral=True)
         return
     
-    result = await key_manager.add_keys_to_product(product, key_list)
+    target_guild_id = int(guild_id) if guild_id and guild_id.isdigit() else interaction.guild.id
+    await interaction.response.defer(ephemeral=True)
+    
+    try:
+        allocated = await key_manager.set_guild_quota(target_guild_id, product, quota)
+    except Exception as e:
+        logger.error(f"❌ Error setting guild quota: {e}")
+        await interaction.followup.send(f"❌ Failed to set quota: {str(e)}", ephemeral=True)
+        return
+    
+    target_guild = bot.get_guild(target_guild_id)
+    embed = create_embed(
+        "📊 Guild Quota Updated",
+        f"**Guild:** {target_guild.name if target_guild else target_guild_id}\n**Product:** {product}",
+        CONFIG['SUCCESS_COLOR'],
+        fields=[
+            ("🎯 Quota", str(quota), True),
+            ("🔑 Allocated Now", f"{allocated} keys", True),
+            ("📦 Guild Can Deliver", f"{await key_manager.get_product_stock(product, target_guild_id)} keys", True)
+        ]
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="archive_keys", description="Move used keys and old purchases to the archive database")
+@app_commands.describe(days="Archive records older than this many days (defaults to the configured age)")
+@app_commands.checks.has_permissions(administrator=True)
+async def archive_keys(interaction: discord.Interaction, days: app_commands.Range[int, 1, 3650] = None):
+    # Archiving moves every guild's keys and purchases, so a guild admin alone is not enough
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("❌ Only the bot owner can archive key records.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    
+    days = days or CONFIG['ARCHIVE_AFTER_DAYS'] or 90
+    try:
+        moved = await key_manager.archive_old_records(days)
+    except Exception as e:
+        logger.error(f"❌ Key archive failed: {e}")
+        await interaction.followup.send(f"❌ Archive failed: {str(e)}", ephemeral=True)
+        return
+    
+    embed = create_embed(
+        "📦 Archive Complete",
+        f"Moved records older than **{days} days** to `{CONFIG['ARCHIVE_DATABASE_PATH']}`",
+        CONFIG['SUCCESS_COLOR'],
+        fields=[
+            ("🔑 Used Keys", str(moved['keys']), True),
+            ("🛒 Purchases", str(moved['purchases']), True)
+        ]
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="purchase_history", description="Show a customer's recent purchases")
+@app_commands.describe(user="Customer to look up", include_archive="Also search archived purchases")
+@app_commands.checks.has_permissions(administrator=True)
+async def purchase_history(interaction: discord.Interaction, user: discord.User, include_archive: bool = False):
+    await interaction.response.defer(ephemeral=True)
+    
+    purchases = await key_manager.get_user_purchase_history(user.id, limit=15, include_archive=include_archive)
+    if purchases:
+        lines = [
+            f"• **{purchase['product_name']}** - ${purchase['amount_spent'] or 0:.2f} ({purchase['purchase_date']})"
+            for purchase in purchases
+        ]
+        description = "\n".join(lines)
+    else:
+        description = "No purchases found"
+        if not include_archive:
+            description += " (archived purchases not included)"
+    
+    embed = create_embed(
+        f"🧾 Purchase History: {user.display_name}",
+        description,
+        CONFIG['MAIN_COLOR']
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="export", description="Export purchases, keys or this server's invoices as a compressed file")
+@app_commands.describe(
+    dataset="What to export",
+    file_format="File format",
+    since="First day to include (YYYY-MM-DD)",
+    until="Last day to include (YYYY-MM-DD)",
+    product="Only this product",
+    include_archive="Also include archived purchases and keys"
+)
+@app_commands.choices(
+    dataset=[
+        app_commands.Choice(name="🛒 Purchases", value="purchases"),
+        app_commands.Choice(name="🔑 Keys", value="keys"),
+        app_commands.Choice(name="📄 Invoices", value="invoices")
+    ],
+    file_format=[
+        app_commands.Choice(name="CSV", value="csv"),
+        app_commands.Choice(name="JSON Lines", value="jsonl")
+    ]
+)
+@app_commands.checks.has_permissions(administrator=True)
+async def export_data(interaction: discord.Interaction, dataset: str, file_format: str = "csv", since: str = None,
+                      until: str = None, product: str = None, include_archive: bool = False):
+    # Purchases and keys span every guild (keys in plaintext), so only invoices are open to guild admins
+    if dataset != "invoices" and not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("❌ Only the bot owner can export purchases and keys.", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True)
+    
+    try:
+        since_bound, until_bound = parse_export_range(since, until)
+    except ValueError:
+        await interaction.followup.send("❌ Dates must be in `YYYY-MM-DD` format.", ephemeral=True)
+        return
+    
+    # Rows are streamed through gzip into the spool, so memory stays flat however big the table is
+    with tempfile.SpooledTemporaryFile(max_size=CONFIG['EXPORT_SPOOL_MAX_BYTES']) as spool:
+        try:
+            if dataset == "invoices":
+                rows = data_manager.iter_invoice_rows(str(interaction.guild.id), since_bound, until_bound, product)
+                count = await write_export(rows, INVOICE_EXPORT_COLUMNS, file_format, spool)
+            else:
+                rows = key_manager.iter_export_rows(dataset, since_bound, until_bound, product, include_archive)
+                count = await write_export(rows, EXPORT_DATASETS[dataset]['columns'], file_format, spool)
+        except Exception as e:
+            logger.error(f"❌ Export of {dataset} failed: {e}")
+            await interaction.followup.send(f"❌ Export failed: {str(e)}", ephemeral=True)
+            return
+        
+        size = spool.tell()
+        if size > interaction.guild.filesize_limit:
+            await interaction.followup.send(
+                f"❌ The export is {size / 1024 / 1024:.1f} MB, over this server's upload limit. "
+                f"Narrow the date range or product, or run `python -m admin_cli export {dataset}` on the host.",
+                ephemeral=True
+            )
+            return
+        
+        spool.seek(0)
+        filename = f"{dataset}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.{file_format}.gz"
+        embed = create_embed(
+            "📤 Export Ready",
+            f"**{count:,}** {dataset} exported as `{filename}`",
+            CONFIG['SUCCESS_COLOR'],
+            fields=[
+                ("📅 Range", f"{since or 'start'} → {until or 'today'}", True),
+                ("📦 Product", product or "All", True),
+                ("🗜️ Size", f"{size / 1024:.1f} KB", True)
+            ]
+        )
+        await interaction.followup.send(embed=embed, file=discord.File(spool, filename=filename), ephemeral=True)
+    logger.info(f"📤 {interaction.user} exported {count} {dataset} rows")
+
+@bot.tree.command(name="add_keys", description="Add license keys to a product")
+@app_commands.describe(
+    product="Product name", 
+    keys="Comma-separated keys", 
+    file="A .txt/.csv file of keys for bulk import",
+    duration_days="License length in days, counted from delivery (leave empty for lifetime keys)"
+)
+@app_commands.checks.has_permissions(administrator=True)
+async def add_keys(interaction: discord.Interaction, product: str, keys: str = None, file: discord.Attachment = None,
+                   duration_days: app_commands.Range[int, 1, 3650] = None):
+    await interaction.response.defer(ephemeral=True)
+    
+    if file:
+        if not file.filename.lower().endswith(KEY_FILE_EXTENSIONS):
+            await interaction.followup.send("❌ Key files must be `.txt` or `.csv`.", ephemeral=True)
+            return
+        
+        last_update = time.monotonic()
+        
+        async def report_progress(added: int, duplicates: int):
+            nonlocal last_update
+            if time.monotonic() - last_update < CONFIG['KEY_IMPORT_PROGRESS_SECONDS']:
+                return
+            last_update = time.monotonic()
+            progress_embed = create_embed(
+                "⏳ Importing Keys...",
+                f"Importing `{file.filename}` into **{product}**",
+                CONFIG['MAIN_COLOR'],
+                fields=[
+                    ("➕ Added", str(added), True),
+                    ("🔄 Duplicates", str(duplicates), True)
+                ]
+            )
+            try:
+                await interaction.edit_original_response(embed=progress_embed)
+            except discord.HTTPException:
+                pass
+        
+        await interaction.edit_original_response(content=f"⏳ Importing `{file.filename}`...")
+        rejected = []
+        result = await key_manager.import_keys(product, iter_attachment_keys(file, rejected), progress=report_progress,
+                                               duration_days=duration_days)
+        if rejected:
+            shown = ", ".join(str(line) for line in rejected[:10]) + (", ..." if len(rejected) > 10 else "")
+            result['message'] += (f"\n⚠️ Skipped {len(rejected)} values that are not valid UTF-8 or longer than "
+                                  f"{KEY_FILE_MAX_KEY_BYTES} bytes (lines {shown})")
+    else:
+        key_list = [key.strip() for key in keys.split(",") if key.strip()] if keys else []
+        
+        if not key_list:
+            await interaction.followup.send("❌ No valid keys provided. Pass comma-separated keys or attach a `.txt`/`.csv` file.", ephemeral=True)
+            return
+        
+        if len(key_list) > 100:
+            await interaction.followup.send("❌ Maximum 100 keys per command. Attach a `.txt`/`.csv` file for bulk imports.", ephemeral=True)
+            return
+        
+        result = await key_manager.add_keys_to_product(product, key_list, duration_days=duration_days)
     
     if result['success']:
         # Get stock count first
@@ -5545,7 +5861,10 @@ async def add_keys(interaction: discord.Interaction, product: str, keys: str):
                 ("📊 New Stock", str(new_stock), True)
             ]
         )
-        await interaction.followup.send(embed=embed, ephemeral=True)
+        if file:
+            await interaction.edit_original_response(content=None, embed=embed)
+        else:
+            await interaction.followup.send(embed=embed, ephemeral=True)
         await log_to_channel(interaction.guild, f"➕ {interaction.user} added {result['added']} keys to **{product}**", CHANNELS['LOG'])
     else:
         await interaction.followup.send(f"❌ Error: {result['message']}", ephemeral=True)
@@ -5644,7 +5963,7 @@ async def giveaway(interaction: discord.Interaction, duration: str, winners: int
         return
 
     end_time = datetime.now(timezone.utc) + delta
-    giveaway_id = f"{interaction.guild.id}-{int(end_time.timestamp())}"
+    giveaway_id = f"{interaction.guild.id}-{id_generator.next_id()}"
     
     embed = create_embed(
         "🎁 GIVEAWAY STARTED! 🎁",
@@ -5667,11 +5986,7 @@ async def giveaway(interaction: discord.Interaction, duration: str, winners: int
     message = await giveaway_channel.send(embed=embed, view=view)
     
     # Store giveaway data
-    guild_id_str = str(interaction.guild.id)
-    if guild_id_str not in data_manager.data['giveaways']:
-        data_manager.data['giveaways'][guild_id_str] = {}
-        
-    data_manager.data['giveaways'][guild_id_str][str(message.id)] = {
+    await data_manager.add_giveaway(interaction.guild.id, {
         "channel_id": giveaway_channel.id,
         "message_id": message.id,
         "prize": prize,
@@ -5680,8 +5995,7 @@ async def giveaway(interaction: discord.Interaction, duration: str, winners: int
         "entries": [],
         "host": interaction.user.id,
         "giveaway_id": giveaway_id
-    }
-    data_manager.save_category_data('giveaways')
+    })
     
     await log_to_channel(interaction.guild, f"🎁 {interaction.user} started giveaway: **{prize}** ({winners} winners, {duration})", CHANNELS['GIVEAWAY_LOGS'])
 
@@ -5689,15 +6003,12 @@ async def giveaway(interaction: discord.Interaction, duration: str, winners: int
 @app_commands.describe(message_id="Giveaway message ID")
 @app_commands.checks.has_permissions(manage_guild=True)
 async def end_giveaway(interaction: discord.Interaction, message_id: str):
-    guild_id_str = str(interaction.guild.id)
-    
-    if (guild_id_str not in data_manager.data['giveaways'] or 
-        message_id not in data_manager.data['giveaways'][guild_id_str]):
+    giveaway_info = await data_manager.get_giveaway(interaction.guild.id, int(message_id)) if message_id.isdigit() else None
+    if not giveaway_info:
         await interaction.response.send_message("❌ Giveaway not found", ephemeral=True)
         return
     
     await interaction.response.defer(ephemeral=True)
-    giveaway_info = data_manager.data['giveaways'][guild_id_str][message_id]
     await end_giveaway_logic(interaction.guild, giveaway_info)
     await interaction.followup.send("✅ Giveaway ended successfully", ephemeral=True)
 
@@ -5753,14 +6064,6 @@ async def reroll_giveaway(interaction: discord.Interaction, message_id: str, new
 @app_commands.describe(user="User to warn", reason="Warning reason")
 @app_commands.checks.has_permissions(kick_members=True)
 async def warn(interaction: discord.Interaction, user: discord.Member, reason: str):
-    guild_id = str(interaction.guild.id)
-    user_id = str(user.id)
-    
-    if guild_id not in data_manager.data['warnings']:
-        data_manager.data['warnings'][guild_id] = {}
-    if user_id not in data_manager.data['warnings'][guild_id]:
-        data_manager.data['warnings'][guild_id][user_id] = []
-    
     warning_data = {
         "reason": reason,
         "moderator": str(interaction.user),
@@ -5768,10 +6071,7 @@ async def warn(interaction: discord.Interaction, user: discord.Member, reason: s
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
     
-    data_manager.data['warnings'][guild_id][user_id].append(warning_data)
-    data_manager.save_category_data('warnings')
-    
-    warning_count = len(data_manager.data['warnings'][guild_id][user_id])
+    warning_count = await data_manager.add_warning(interaction.guild.id, user.id, warning_data)
     
     embed = create_embed(
         "⚠️ User Warned",
@@ -5791,16 +6091,11 @@ async def warn(interaction: discord.Interaction, user: discord.Member, reason: s
 @app_commands.describe(user="User to check warnings for")
 @app_commands.checks.has_permissions(kick_members=True)
 async def warnings(interaction: discord.Interaction, user: discord.Member):
-    guild_id = str(interaction.guild.id)
-    user_id = str(user.id)
-    
-    if (guild_id not in data_manager.data['warnings'] or 
-        user_id not in data_manager.data['warnings'][guild_id] or 
-        not data_manager.data['warnings'][guild_id][user_id]):
+    warnings_list = await data_manager.get_warnings(interaction.guild.id, user.id)
+    if not warnings_list:
         await interaction.response.send_message("✅ This user has no warnings", ephemeral=True)
         return
         
-    warnings_list = data_manager.data['warnings'][guild_id][user_id]
     embed = create_embed(
         f"⚠️ Warnings for {user.display_name}",
         f"**Total Warnings:** {len(warnings_list)}",
@@ -5822,17 +6117,8 @@ async def warnings(interaction: discord.Interaction, user: discord.Member):
 @app_commands.describe(user="User to clear warnings for")
 @app_commands.checks.has_permissions(kick_members=True)
 async def clear_warnings(interaction: discord.Interaction, user: discord.Member):
-    guild_id = str(interaction.guild.id)
-    user_id = str(user.id)
-    
-    if (guild_id in data_manager.data['warnings'] and 
-        user_id in data_manager.data['warnings'][guild_id] and
-        data_manager.data['warnings'][guild_id][user_id]):
-        
-        warning_count = len(data_manager.data['warnings'][guild_id][user_id])
-        data_manager.data['warnings'][guild_id][user_id] = []
-        data_manager.save_category_data('warnings')
-        
+    warning_count = await data_manager.clear_warnings(interaction.guild.id, user.id)
+    if warning_count:
         embed = create_embed(
             "✅ Warnings Cleared",
             f"Cleared **{warning_count}** warnings for {user.mention}",
@@ -5936,7 +6222,6 @@ async def server_stats(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
     
     guild = interaction.guild
-    guild_id = str(guild.id)
     
     # Basic stats
     total_channels = len(guild.channels)
@@ -5953,10 +6238,10 @@ async def server_stats(interaction: discord.Interaction):
     open_tickets = sum(1 for channel in guild.text_channels if channel.name.startswith('ticket-'))
     
     # Vouch stats
-    total_vouches = sum(data.get('count', 0) for user_id, data in data_manager.data.get('vouches', {}).items())
+    total_vouches = await data_manager.count_vouches()
 
     # Giveaway stats
-    active_giveaways = len(data_manager.data['giveaways'].get(guild_id, {}))
+    active_giveaways = await data_manager.count_giveaways(guild.id)
     
     embed = create_embed(
         f"📊 Server Statistics: {guild.name}",
@@ -5978,10 +6263,9 @@ async def server_stats(interaction: discord.Interaction):
 @app_commands.checks.has_permissions(administrator=True)
 async def moderation_panel(interaction: discord.Interaction):
     guild = interaction.guild
-    guild_id = str(guild.id)
 
     # Calculate moderation stats
-    total_warnings = sum(len(warnings) for warnings in data_manager.data['warnings'].get(guild_id, {}).values())
+    total_warnings = await data_manager.count_guild_warnings(guild.id)
     open_tickets = sum(1 for channel in guild.text_channels if channel.name.startswith('ticket-'))
     
     embed = create_embed(
@@ -6032,7 +6316,7 @@ async def moderation_panel(interaction: discord.Interaction):
                      f"Products: {product_count}\n"
                      f"Total Stock: {total_stock}", True),
                     ("🎁 Giveaways", 
-                     f"Active: {len(data_manager.data['giveaways'].get(guild_id, {}))}", True)
+                     f"Active: {await data_manager.count_giveaways(guild.id)}", True)
                 ]
             )
             await btn_interaction.response.send_message(embed=stats_embed, ephemeral=True)
@@ -6278,7 +6562,7 @@ async def setup_stats_channels(interaction: discord.Interaction, member_channel:
         'member_channel': member_channel.id,
         'bot_channel': bot_channel.id
     }
-    data_manager.save_category_data('stats_channels')
+    data_manager.save_category_data('stats_channels', guild_id)
     
     # Update immediately
     try:
@@ -6316,7 +6600,7 @@ async def add_auto_role(interaction: discord.Interaction, role: discord.Role):
         return
         
     data_manager.data['auto_roles'][guild_id].append(role.id)
-    data_manager.save_category_data('auto_roles')
+    data_manager.save_category_data('auto_roles', guild_id)
     
     embed = create_embed(
         "✅ Auto-Role Added",
@@ -6334,7 +6618,7 @@ async def remove_auto_role(interaction: discord.Interaction, role: discord.Role)
     if (guild_id in data_manager.data['auto_roles'] and 
         role.id in data_manager.data['auto_roles'][guild_id]):
         data_manager.data['auto_roles'][guild_id].remove(role.id)
-        data_manager.save_category_data('auto_roles')
+        data_manager.save_category_data('auto_roles', guild_id)
         
         embed = create_embed(
             "✅ Auto-Role Removed",
@@ -6365,7 +6649,7 @@ async def list_auto_roles(interaction: discord.Interaction):
     # Clean up invalid roles
     if len(valid_role_ids) != len(data_manager.data['auto_roles'][guild_id]):
         data_manager.data['auto_roles'][guild_id] = valid_role_ids
-        data_manager.save_category_data('auto_roles')
+        data_manager.save_category_data('auto_roles', guild_id)
     
     embed = create_embed(
         "🤖 Auto-Assigned Roles",
@@ -6399,7 +6683,7 @@ async def setup_welcome(interaction: discord.Interaction, channel: discord.TextC
         'image_url': image_url,
         'enabled': True
     }
-    data_manager.save_category_data('welcome')
+    data_manager.save_category_data('welcome', guild_id)
     
     # Show preview
     preview_title = title.replace("{user}", interaction.user.display_name).replace("{server}", interaction.guild.name).replace("{member_count}", str(interaction.guild.member_count))
@@ -6426,7 +6710,7 @@ async def toggle_welcome(interaction: discord.Interaction, enabled: bool):
         return
     
     data_manager.data['welcome'][guild_id]["enabled"] = enabled
-    data_manager.save_category_data('welcome')
+    data_manager.save_category_data('welcome', guild_id)
     
     status = "enabled" if enabled else "disabled"
     embed = create_embed(
@@ -6544,7 +6828,7 @@ async def configure_ticket_redirect(interaction: discord.Interaction):
                     
                     data_manager.data['ticket_config'][guild_id]['ticket_channel_id'] = channel.id
                     data_manager.data['ticket_config'][guild_id]['ticket_message_id'] = message.id
-                    data_manager.save_category_data('ticket_config')
+                    data_manager.save_category_data('ticket_config', guild_id)
                     
                     ticket_url = f"https://discord.com/channels/{interaction.guild.id}/{channel.id}/{message.id}"
                     
@@ -6849,7 +7133,7 @@ async def find_ticket_panel(interaction: discord.Interaction):
             
             data_manager.data['ticket_config'][guild_id]['ticket_channel_id'] = selected_panel['channel'].id
             data_manager.data['ticket_config'][guild_id]['ticket_message_id'] = selected_panel['message'].id
-            data_manager.save_category_data('ticket_config')
+            data_manager.save_category_data('ticket_config', guild_id)
             
             # Test the URL
             ticket_url = f"https://discord.com/channels/{select_interaction.guild.id}/{selected_panel['channel'].id}/{selected_panel['message'].id}"
@@ -6890,8 +7174,7 @@ async def afk(interaction: discord.Interaction, reason: str = "I am AFK"):
     else:
         await interaction.response.send_message(f"✅ You are now AFK: `{reason}`", ephemeral=True)
     
-    data_manager.data['afk'][user_id] = reason
-    data_manager.save_category_data('afk')
+    data_manager.set_record('afk', [user_id], reason)
 
 @bot.tree.command(name="userinfo", description="Get detailed user information")
 @app_commands.describe(user="User to get info for (optional)")
@@ -7171,11 +7454,24 @@ def get_bot_token():
         print(f"❌ Error getting token: {e}")
         raise
 
+async def run_bot(token: str):
+    """Run the bot and shut the key store down cleanly once the gateway closes"""
+    try:
+        # Records still in invoices/warnings/vouch_data/giveaways.json move into SQLite before any command runs
+        await data_manager.import_json_records()
+        async with bot:
+            await bot.start(token)
+    finally:
+        await stop_key_validation_server()
+        # Write JSON categories still waiting on the debounced flusher
+        await data_manager.flush()
+        await key_manager.close()
+
 if __name__ == "__main__":
     try:
         token = get_bot_token()
         print("🚀 Starting Discord bot...")
-        bot.run(token)
+        asyncio.run(run_bot(token))
     except KeyboardInterrupt:
         print("\n👋 Bot stopped by user")
     except Exception as e:
@@ -0,0 +1,3369 @@
+"""Key inventory and JSON data storage, shared by the bot and the offline admin CLI (admin_cli.py)"""
+from datetime import datetime, timedelta, timezone
+import os
+import io
+import re
+import csv
+import gzip
+import json
+import time
+import asyncio
+import contextlib
+import threading
+import queue
+import uuid
+import weakref
+import hashlib
+import itertools
+import zlib
+import sqlite3
+import aiosqlite
+from aiohttp import web
+try:
+    import orjson
+except ImportError:
+    # Optional: JsonCodec falls back to the stdlib encoder
+    orjson = None
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import logging
+from typing import Optional, Dict, List, Union, AsyncIterator, Callable, Awaitable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Loaded here as well as in bot.py: settings below read the environment at import time
+load_dotenv()
+
+CONFIG = {
+    'DATABASE_PATH': "product_keys.db",
+    'ARCHIVE_DATABASE_PATH': "product_keys_archive.db",  # Used keys and old purchases are moved here
+    'BACKUP_FOLDER': "backups",
+    'MAX_BACKUPS': 5,
+    'KEY_IMPORT_CHUNK_SIZE': 5000,  # Keys per INSERT transaction during bulk imports
+    'KEY_POOL_SIZE': 5,  # Keys pre-reserved in memory per hot product
+    'KEY_POOL_LOW_WATER': 2,  # Refill a product's reserved keys when it drops below this
+    'KEY_POOL_MAX_PRODUCTS': 10,  # Most recently delivered products that keep a reservation pool
+    'KEY_WRITER_MAX_BATCH': 64,  # Most queued write operations committed together in one transaction
+    'KEY_ANALYTICS_POOL_SIZE': 2,  # Read-only connections (and threads) for dashboards, exports and reports
+    'KEY_VALIDATION_CACHE_SIZE': 10000,  # Recent /validate responses kept ready to send
+    'KEY_VALIDATION_BLOOM': True,  # Answer unknown keys from a Bloom filter before the hash index
+    'DATA_FLUSH_DELAY_MS': 500,  # JSON categories changed within this window are written together once
+    'DATA_JOURNAL_CATEGORIES': ('afk',),  # Changes appended to <file>.journal instead of rewriting the file
+    'DATA_JOURNAL_COMPACT_RATIO': 0.5,  # Rewrite a journaled file once its journal passes this fraction of its size
+    'DATA_JOURNAL_MIN_BYTES': 64 * 1024,  # ...but never for journals smaller than this
+    'DATA_JSON_BACKEND': os.environ.get("DATA_JSON_BACKEND", "auto"),  # 'orjson', 'json', or 'auto' (orjson when installed)
+    'DATA_JSON_PRETTY': os.environ.get("DATA_JSON_PRETTY") == "1",  # Indent data files for reading by hand; compact otherwise
+    'DATA_SHARDED_CATEGORIES': ('auto_roles', 'welcome', 'verification', 'stats_channels', 'dashboard',
+                                'ticket_config', 'dm_templates', 'invoice_templates', 'log_config',
+                                'vouch_config'),  # Stored as one file per guild under DATA_SHARD_FOLDER
+    'DATA_SHARD_FOLDER': "guild_data",
+    'DATA_SHARD_MEMORY_BUDGET': 32 * 1024 * 1024,  # Bytes of guild shards (as JSON on disk) kept in memory
+    'DATA_SHARD_IDLE_SECONDS': 1800,  # Guild shards not touched for this long are dropped from memory
+    'DATA_SHARD_PIN_SECONDS': 60,  # Shards touched this recently stay in memory even over the budget
+    'EXPORT_SPOOL_MAX_BYTES': 8 * 1024 * 1024,  # Compressed exports spill from memory to a temp file past this
+    'ID_WORKER_ID': int(os.environ.get("ID_WORKER_ID", 0)),  # 0-1023, unique per process that allocates IDs
+}
+
+KEY_FILE_HEADERS = {'key', 'keys', 'key_value', 'license_key'}
+KEY_FILE_MAX_KEY_BYTES = 4096  # Longer values are rejected rather than buffered
+KEY_FILE_SEPARATORS = re.compile(rb'[,\n]')
+
+async def iter_key_file(chunks: AsyncIterator[bytes], rejected: List[int]) -> AsyncIterator[str]:
+    """Keys from the raw bytes of a .txt/.csv key file, split on newlines and commas as chunks arrive
+    so no line is ever held whole. Values that are not valid UTF-8 or are longer than
+    KEY_FILE_MAX_KEY_BYTES are skipped and their line numbers appended to rejected."""
+    buffer = b""
+    line_number = 1
+    first_value = True
+    oversized = False
+
+    def decode(raw: bytes) -> Optional[str]:
+        nonlocal first_value
+        is_first, first_value = first_value, False
+        if oversized or len(raw) > KEY_FILE_MAX_KEY_BYTES:
+            rejected.append(line_number)
+            return None
+        if is_first and raw.startswith(b'\xef\xbb\xbf'):
+            raw = raw[3:]
+        try:
+            value = raw.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            rejected.append(line_number)
+            return None
+        # Skip a CSV header row such as "key" or "license_key"
+        if is_first and value.lower() in KEY_FILE_HEADERS:
+            return None
+        return value or None
+
+    async for chunk in chunks:
+        buffer += chunk
+        start = 0
+        for separator in KEY_FILE_SEPARATORS.finditer(buffer):
+            value = decode(buffer[start:separator.start()])
+            if value:
+                yield value
+            oversized = False
+            if separator.group() == b'\n':
+                line_number += 1
+            start = separator.end()
+        buffer = buffer[start:]
+        if len(buffer) > KEY_FILE_MAX_KEY_BYTES:
+            # Drop the rest of this value as it streams in; it is reported once its separator arrives
+            oversized, buffer = True, b""
+    value = decode(buffer)
+    if value:
+        yield value
+
+# === SQLite Key Management System ===
+# Ordered schema migrations for the key database. PRAGMA user_version records the
+# last version applied; each entry runs once, inside its own transaction.
+KEY_DB_MIGRATIONS = [
+    (1, "Products, keys and purchase history tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS keys (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_name TEXT NOT NULL,
+            key_value TEXT NOT NULL UNIQUE,
+            used BOOLEAN DEFAULT FALSE,
+            user_tag TEXT DEFAULT NULL,
+            user_id INTEGER DEFAULT NULL,
+            date_used TIMESTAMP DEFAULT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_name) REFERENCES products(name)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_purchases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_tag TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            amount_spent REAL DEFAULT 0.0,
+            purchase_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            transaction_id TEXT UNIQUE
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_keys_product ON keys(product_name)',
+        'CREATE INDEX IF NOT EXISTS idx_keys_used ON keys(used)',
+        'CREATE INDEX IF NOT EXISTS idx_keys_user ON keys(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_purchases_user ON user_purchases(user_id)',
+    ]),
+    (2, "Partial and covering indexes matched to the claim, stock and purchase queries", [
+        # used only ever holds 0/1, so a plain index on it never narrows anything down
+        'DROP INDEX IF EXISTS idx_keys_used',
+        'DROP INDEX IF EXISTS idx_keys_product',
+        # Only unused keys are ever looked up by product; used rows stay out of the index
+        'CREATE INDEX IF NOT EXISTS idx_keys_available ON keys(product_name, id) WHERE used = 0',
+        'DROP INDEX IF EXISTS idx_purchases_user',
+        'CREATE INDEX IF NOT EXISTS idx_purchases_user_product ON user_purchases(user_id, product_name, purchase_date, amount_spent)',
+    ]),
+    (3, "Reservation token for keys pre-reserved by the delivery pool", [
+        'ALTER TABLE keys ADD COLUMN reserved_token TEXT DEFAULT NULL',
+        'DROP INDEX IF EXISTS idx_keys_available',
+        'CREATE INDEX IF NOT EXISTS idx_keys_available ON keys(product_name, reserved_token, id) WHERE used = 0',
+    ]),
+    (4, "Per-user purchase aggregates maintained alongside user_purchases", [
+        '''
+        CREATE TABLE IF NOT EXISTS user_totals (
+            user_id INTEGER PRIMARY KEY,
+            total_purchases INTEGER NOT NULL DEFAULT 0,
+            lifetime_spent REAL NOT NULL DEFAULT 0.0,
+            last_purchase TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_product_totals (
+            user_id INTEGER NOT NULL,
+            product_name TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            total_spent REAL NOT NULL DEFAULT 0.0,
+            last_purchase TIMESTAMP,
+            PRIMARY KEY (user_id, product_name)
+        ) WITHOUT ROWID
+        ''',
+        # Backfill from existing history; from here on _record_purchase keeps both tables current
+        '''
+        INSERT OR REPLACE INTO user_totals (user_id, total_purchases, lifetime_spent, last_purchase)
+        SELECT user_id, COUNT(*), COALESCE(SUM(amount_spent), 0.0), MAX(purchase_date)
+        FROM user_purchases GROUP BY user_id
+        ''',
+        '''
+        INSERT OR REPLACE INTO user_product_totals (user_id, product_name, count, total_spent, last_purchase)
+        SELECT user_id, product_name, COUNT(*), COALESCE(SUM(amount_spent), 0.0), MAX(purchase_date)
+        FROM user_purchases GROUP BY user_id, product_name
+        ''',
+    ]),
+    (5, "Date indexes for archiving used keys and old purchases", [
+        'CREATE INDEX IF NOT EXISTS idx_keys_used_date ON keys(date_used) WHERE used = 1',
+        'CREATE INDEX IF NOT EXISTS idx_purchases_date ON user_purchases(purchase_date)',
+    ]),
+    (6, "Per-guild slices of the shared key inventory", [
+        'ALTER TABLE keys ADD COLUMN guild_id INTEGER DEFAULT NULL',
+        '''
+        CREATE TABLE IF NOT EXISTS guild_quotas (
+            guild_id INTEGER NOT NULL,
+            product_name TEXT NOT NULL,
+            quota INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, product_name)
+        ) WITHOUT ROWID
+        ''',
+        'DROP INDEX IF EXISTS idx_keys_available',
+        'CREATE INDEX IF NOT EXISTS idx_keys_available ON keys(product_name, guild_id, reserved_token, id) WHERE used = 0',
+    ]),
+    (7, "Timed key holds for pending payments", [
+        '''
+        CREATE TABLE IF NOT EXISTS key_holds (
+            key_id INTEGER PRIMARY KEY REFERENCES keys(id),
+            hold_token TEXT NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            product_name TEXT NOT NULL,
+            guild_id INTEGER DEFAULT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_key_holds_expires ON key_holds(expires_at)',
+        'CREATE INDEX IF NOT EXISTS idx_key_holds_user ON key_holds(user_id, product_name)',
+    ]),
+    (8, "Duration-based licenses with an expiry index", [
+        'ALTER TABLE keys ADD COLUMN duration_days INTEGER DEFAULT NULL',
+        'ALTER TABLE keys ADD COLUMN expires_at INTEGER DEFAULT NULL',
+        'ALTER TABLE keys ADD COLUMN license_active INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE keys ADD COLUMN expiry_notified INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE keys ADD COLUMN license_guild_id INTEGER DEFAULT NULL',
+        'CREATE INDEX IF NOT EXISTS idx_keys_license_expiry ON keys(expires_at) WHERE license_active = 1',
+    ]),
+    (9, "Hourly and daily sales rollups per guild and product", [
+        # bucket is the unix time the hour/day (UTC) starts; guild_id 0 means the guild is unknown
+        '''
+        CREATE TABLE IF NOT EXISTS sales_hourly (
+            bucket INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL DEFAULT 0,
+            source TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0.0,
+            PRIMARY KEY (guild_id, source, bucket, product_name)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            bucket INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL DEFAULT 0,
+            source TEXT NOT NULL,
+            product_name TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0.0,
+            PRIMARY KEY (guild_id, source, bucket, product_name)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS sales_customers (
+            guild_id INTEGER NOT NULL DEFAULT 0,
+            source TEXT NOT NULL,
+            customer_id INTEGER NOT NULL,
+            customer_tag TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0.0,
+            PRIMARY KEY (guild_id, source, customer_id)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_sales_hourly_bucket ON sales_hourly(bucket)',
+    ]),
+    (10, "Incrementally maintained leaderboards per guild and time window", [
+        # period is 'all', 'month:YYYY-MM' or 'week:YYYY-MM-DD' (the Monday, UTC); member is a
+        # user ID or product name depending on the board
+        '''
+        CREATE TABLE IF NOT EXISTS leaderboards (
+            guild_id INTEGER NOT NULL DEFAULT 0,
+            source TEXT NOT NULL,
+            board TEXT NOT NULL,
+            period TEXT NOT NULL,
+            member TEXT NOT NULL,
+            label TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0.0,
+            PRIMARY KEY (guild_id, source, board, period, member)
+        ) WITHOUT ROWID
+        ''',
+        # Top-k reads walk this index from the top, so they never sort
+        'CREATE INDEX IF NOT EXISTS idx_leaderboards_rank ON leaderboards(guild_id, source, board, period, revenue DESC)',
+        # The spenders board replaces sales_customers; both are refilled by the rollup rebuild
+        'DROP TABLE IF EXISTS sales_customers',
+    ]),
+    (11, "Invoices, warnings, vouches and giveaways move from JSON files into indexed tables", [
+        # data keeps the invoice dict exactly as the bot built it; the columns beside it are for lookups
+        '''
+        CREATE TABLE IF NOT EXISTS invoices (
+            guild_id INTEGER NOT NULL,
+            invoice_id TEXT NOT NULL,
+            customer_id INTEGER,
+            processor_id INTEGER,
+            product TEXT,
+            amount REAL NOT NULL DEFAULT 0.0,
+            timestamp REAL NOT NULL DEFAULT 0,
+            data TEXT NOT NULL,
+            PRIMARY KEY (guild_id, invoice_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_invoices_customer ON invoices(guild_id, customer_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_invoices_timestamp ON invoices(timestamp)',
+        '''
+        CREATE TABLE IF NOT EXISTS warnings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            reason TEXT,
+            moderator TEXT,
+            moderator_id INTEGER,
+            timestamp TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_warnings_member ON warnings(guild_id, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_warnings_timestamp ON warnings(guild_id, timestamp)',
+        # Imported vouches have no guild; vouch_totals keeps counts that predate the detailed records
+        '''
+        CREATE TABLE IF NOT EXISTS vouches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            guild_id INTEGER,
+            product TEXT,
+            rating INTEGER,
+            experience TEXT,
+            supporter TEXT,
+            timestamp TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_vouches_user ON vouches(user_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_vouches_guild ON vouches(guild_id, timestamp)',
+        '''
+        CREATE TABLE IF NOT EXISTS vouch_totals (
+            user_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        # ends_at is end_time as a unix timestamp, so due giveaways are an index range
+        '''
+        CREATE TABLE IF NOT EXISTS giveaways (
+            guild_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            giveaway_id TEXT,
+            channel_id INTEGER,
+            prize TEXT,
+            winner_count INTEGER NOT NULL DEFAULT 1,
+            end_time TEXT,
+            ends_at REAL NOT NULL DEFAULT 0,
+            host INTEGER,
+            PRIMARY KEY (guild_id, message_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_giveaways_giveaway_id ON giveaways(guild_id, giveaway_id)',
+        'CREATE INDEX IF NOT EXISTS idx_giveaways_ends_at ON giveaways(ends_at)',
+        '''
+        CREATE TABLE IF NOT EXISTS giveaway_entries (
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (message_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+        # Progress of the one-off JSON import, so an interrupted import resumes instead of duplicating
+        '''
+        CREATE TABLE IF NOT EXISTS json_imports (
+            category TEXT PRIMARY KEY,
+            records INTEGER NOT NULL DEFAULT 0,
+            completed_at TEXT
+        )
+        ''',
+    ]),
+    (12, "Purchase history records the guild each purchase was made in", [
+        # Purchases recorded before this carry no guild and stay in guild 0
+        'ALTER TABLE user_purchases ADD COLUMN guild_id INTEGER NOT NULL DEFAULT 0',
+    ]),
+    (13, "Index timed licenses by guild and customer for the tier sync", [
+        # Covers SQL_LAPSED_LICENSE_CUSTOMERS: one range per guild, grouped by user without a table lookup
+        'CREATE INDEX IF NOT EXISTS idx_keys_license_customer ON keys(license_guild_id, user_id, license_active) '
+        'WHERE expires_at IS NOT NULL',
+    ]),
+]
+
+# Cold storage, attached as "archive" on every key database connection. Rows keep their
+# original ids so a move interrupted between copy and delete can be safely repeated.
+ARCHIVE_DB_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS archive.keys (
+        id INTEGER PRIMARY KEY,
+        product_name TEXT NOT NULL,
+        key_value TEXT NOT NULL UNIQUE,
+        user_tag TEXT,
+        user_id INTEGER,
+        date_used TIMESTAMP,
+        created_at TIMESTAMP,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        expires_at INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS archive.user_purchases (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        user_tag TEXT NOT NULL,
+        product_name TEXT NOT NULL,
+        amount_spent REAL,
+        purchase_date TIMESTAMP,
+        transaction_id TEXT UNIQUE,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        guild_id INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS archive.idx_archive_purchases_user ON user_purchases(user_id, purchase_date)',
+]
+# Columns added to the archive after it first shipped; archives created before then get them at startup
+ARCHIVE_DB_COLUMNS = [
+    ("keys", "expires_at", "INTEGER"),  # Set on archived timed licenses, which have all run out
+    ("user_purchases", "guild_id", "INTEGER NOT NULL DEFAULT 0"),
+]
+ARCHIVE_DB_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS archive.idx_archive_keys_user ON keys(user_id)',
+]
+
+# Reservation tokens start with this prefix; anything carrying it at startup belongs to a dead process
+RESERVATION_TOKEN_PREFIX = "pool:"
+# Held keys carry a token with this prefix; they outlive restarts and are freed by the expiry sweep
+HOLD_TOKEN_PREFIX = "hold:"
+
+# Starts the license clock of a key sold with a duration; its one parameter is the guild it was delivered in
+SQL_START_LICENSE = '''
+    expires_at = CASE WHEN duration_days IS NULL THEN NULL 
+                      ELSE CAST(strftime('%s', 'now') AS INTEGER) + duration_days * 86400 END,
+    license_active = duration_days IS NOT NULL,
+    license_guild_id = ?
+'''
+
+# Hot KeyManager queries. Shared with check_key_query_plans so the plans checked at
+# startup are the statements that actually run. Note: the partial index only matches
+# "used = 0"; SQLite does not treat "used = FALSE" as the same term.
+SQL_CLAIM_KEY = f'''
+    UPDATE keys 
+    SET used = 1, user_tag = ?, user_id = ?, date_used = CURRENT_TIMESTAMP, {SQL_START_LICENSE}
+    WHERE id = (
+        SELECT id FROM keys 
+        WHERE product_name = ? AND guild_id IS ? AND used = 0 AND reserved_token IS NULL 
+        LIMIT 1
+    )
+    RETURNING key_value, expires_at
+'''
+SQL_RESERVE_KEYS = '''
+    UPDATE keys 
+    SET reserved_token = ? 
+    WHERE id IN (
+        SELECT id FROM keys 
+        WHERE product_name = ? AND guild_id IS NULL AND used = 0 AND reserved_token IS NULL 
+        LIMIT ?
+    )
+    RETURNING id, key_value
+'''
+SQL_ASSIGN_RESERVED_KEY = f'''
+    UPDATE keys 
+    SET used = 1, user_tag = ?, user_id = ?, date_used = CURRENT_TIMESTAMP, reserved_token = NULL, {SQL_START_LICENSE}
+    WHERE id = ? AND reserved_token = ?
+    RETURNING expires_at
+'''
+SQL_INSERT_PURCHASE = '''
+    INSERT INTO user_purchases (user_id, user_tag, product_name, amount_spent, transaction_id, guild_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+SQL_COUNT_STOCK = '''
+    SELECT product_name, guild_id, COUNT(*) as count FROM keys 
+    WHERE used = 0 
+    GROUP BY product_name, guild_id
+'''
+# Move shared keys into a guild's slice until it holds its quota; LIMIT is clamped at 0
+# because a negative LIMIT means "no limit" in SQLite
+SQL_TOP_UP_GUILD_SLICE = '''
+    UPDATE keys 
+    SET guild_id = ? 
+    WHERE id IN (
+        SELECT id FROM keys 
+        WHERE product_name = ? AND guild_id IS NULL AND used = 0 AND reserved_token IS NULL 
+        LIMIT MAX(0, COALESCE((SELECT quota FROM guild_quotas WHERE guild_id = ? AND product_name = ?), 0)
+                     - (SELECT COUNT(*) FROM keys WHERE product_name = ? AND guild_id = ? AND used = 0))
+    )
+'''
+SQL_RELEASE_GUILD_SLICE = '''
+    UPDATE keys 
+    SET guild_id = NULL 
+    WHERE id IN (
+        SELECT id FROM keys 
+        WHERE product_name = ? AND guild_id = ? AND used = 0 AND reserved_token IS NULL 
+        LIMIT ?
+    )
+'''
+SQL_HOLD_KEY = '''
+    UPDATE keys 
+    SET reserved_token = ? 
+    WHERE id = (
+        SELECT id FROM keys 
+        WHERE product_name = ? AND guild_id IS ? AND used = 0 AND reserved_token IS NULL 
+        LIMIT 1
+    )
+    RETURNING id, guild_id
+'''
+SQL_CLAIM_HELD_KEY = f'''
+    UPDATE keys 
+    SET used = 1, user_tag = ?, user_id = ?, date_used = CURRENT_TIMESTAMP, reserved_token = NULL, {SQL_START_LICENSE}
+    WHERE id = (SELECT key_id FROM key_holds WHERE hold_token = ? AND user_id = ?) AND used = 0
+    RETURNING key_value, product_name, expires_at
+'''
+SQL_EXPIRED_HOLDS = '''
+    SELECT key_id, hold_token, product_name, guild_id FROM key_holds 
+    WHERE expires_at <= ?
+'''
+SQL_COUNT_HOLDS = '''
+    SELECT product_name, guild_id, COUNT(*) as count FROM key_holds 
+    GROUP BY product_name, guild_id
+'''
+SQL_UPSERT_USER_TOTALS = '''
+    INSERT INTO user_totals (user_id, total_purchases, lifetime_spent, last_purchase)
+    VALUES (?, 1, COALESCE(?, 0.0), CURRENT_TIMESTAMP)
+    ON CONFLICT(user_id) DO UPDATE SET 
+        total_purchases = total_purchases + 1,
+        lifetime_spent = lifetime_spent + excluded.lifetime_spent,
+        last_purchase = excluded.last_purchase
+'''
+SQL_UPSERT_USER_PRODUCT_TOTALS = '''
+    INSERT INTO user_product_totals (user_id, product_name, count, total_spent, last_purchase)
+    VALUES (?, ?, 1, COALESCE(?, 0.0), CURRENT_TIMESTAMP)
+    ON CONFLICT(user_id, product_name) DO UPDATE SET 
+        count = count + 1,
+        total_spent = total_spent + excluded.total_spent,
+        last_purchase = excluded.last_purchase
+'''
+SQL_USER_PRODUCT_TOTALS = '''
+    SELECT product_name, count, total_spent, last_purchase
+    FROM user_product_totals 
+    WHERE user_id = ? 
+    ORDER BY last_purchase DESC
+'''
+SQL_USER_TOTALS = '''
+    SELECT total_purchases, lifetime_spent
+    FROM user_totals 
+    WHERE user_id = ?
+'''
+SQL_INSERT_KEY = '''
+    INSERT OR IGNORE INTO keys (product_name, key_value, duration_days)
+    SELECT ?, ?, ? 
+    WHERE NOT EXISTS (SELECT 1 FROM archive.keys WHERE key_value = ?)
+'''
+SQL_NEXT_LICENSE_EXPIRY = '''
+    SELECT MIN(expires_at) FROM keys 
+    WHERE license_active = 1
+'''
+SQL_NEXT_LICENSE_NOTICE = '''
+    SELECT MIN(expires_at) FROM keys 
+    WHERE license_active = 1 AND expiry_notified = 0
+'''
+SQL_DUE_LICENSE_NOTICES = '''
+    SELECT id, user_id, product_name, expires_at FROM keys 
+    WHERE license_active = 1 AND expires_at <= ? AND expiry_notified = 0
+'''
+SQL_DUE_LICENSE_EXPIRIES = '''
+    SELECT id, user_id, key_value, product_name, license_guild_id FROM keys 
+    WHERE license_active = 1 AND expires_at <= ?
+'''
+# Whether a customer ever bought a lifetime key; the tier those purchases earned outlives any license.
+# Archived keys carry expires_at only when they were timed licenses.
+SQL_LIFETIME_CUSTOMER = '''
+    SELECT 1 FROM main.keys WHERE user_id = ? AND used = 1 AND duration_days IS NULL
+    UNION ALL
+    SELECT 1 FROM archive.keys WHERE user_id = ? AND expires_at IS NULL
+    LIMIT 1
+'''
+# Customers whose timed licenses in a guild have all run out and who never bought a lifetime key;
+# end_license took their tier roles away and the tier sync must not give them back
+SQL_LAPSED_LICENSE_CUSTOMERS = '''
+    SELECT user_id FROM keys
+    WHERE license_guild_id = ? AND expires_at IS NOT NULL
+    GROUP BY user_id
+    HAVING MAX(license_active) = 0
+       AND NOT EXISTS (SELECT 1 FROM main.keys AS lifetime
+                       WHERE lifetime.user_id = keys.user_id AND lifetime.used = 1 AND lifetime.duration_days IS NULL)
+       AND NOT EXISTS (SELECT 1 FROM archive.keys AS lifetime
+                       WHERE lifetime.user_id = keys.user_id AND lifetime.expires_at IS NULL)
+'''
+SQL_USER_PURCHASE_HISTORY = '''
+    SELECT product_name, amount_spent, purchase_date, transaction_id
+    FROM main.user_purchases 
+    WHERE user_id = ?
+    ORDER BY purchase_date DESC 
+    LIMIT ?
+'''
+SQL_USER_PURCHASE_HISTORY_WITH_ARCHIVE = '''
+    SELECT product_name, amount_spent, purchase_date, transaction_id
+    FROM main.user_purchases 
+    WHERE user_id = ?
+    UNION
+    SELECT product_name, amount_spent, purchase_date, transaction_id
+    FROM archive.user_purchases 
+    WHERE user_id = ?
+    ORDER BY purchase_date DESC 
+    LIMIT ?
+'''
+# Exportable tables: output columns, the date column filtered on, and the archive's
+# expressions for the same columns (it does not keep delivery or license state)
+EXPORT_DATASETS = {
+    'purchases': {
+        'table': 'user_purchases',
+        'date_column': 'purchase_date',
+        'columns': ['id', 'user_id', 'user_tag', 'product_name', 'amount_spent', 'purchase_date', 'transaction_id',
+                    'guild_id'],
+        'archive_columns': ['id', 'user_id', 'user_tag', 'product_name', 'amount_spent', 'purchase_date',
+                            'transaction_id', 'guild_id'],
+    },
+    'keys': {
+        'table': 'keys',
+        'date_column': 'created_at',
+        'columns': ['id', 'product_name', 'key_value', 'used', 'user_tag', 'user_id', 'date_used', 'created_at',
+                    'guild_id', 'duration_days', 'expires_at'],
+        'archive_columns': ['id', 'product_name', 'key_value', '1', 'user_tag', 'user_id', 'date_used', 'created_at',
+                            'NULL', 'NULL', 'NULL'],
+    },
+}
+INVOICE_EXPORT_COLUMNS = ['invoice_id', 'guild_id', 'customer_id', 'customer_tag', 'processor_id', 'processor_tag',
+                          'product', 'amount', 'timestamp', 'template_used']
+# Recompute the per-user aggregates from every purchase, archived ones included
+PURCHASE_AGGREGATE_REBUILD = [
+    'DELETE FROM user_totals',
+    'DELETE FROM user_product_totals',
+    '''
+    INSERT INTO user_totals (user_id, total_purchases, lifetime_spent, last_purchase)
+    SELECT user_id, COUNT(*), COALESCE(SUM(amount_spent), 0.0), MAX(purchase_date)
+    FROM (SELECT user_id, amount_spent, purchase_date FROM main.user_purchases
+          UNION ALL
+          SELECT user_id, amount_spent, purchase_date FROM archive.user_purchases)
+    GROUP BY user_id
+    ''',
+    '''
+    INSERT INTO user_product_totals (user_id, product_name, count, total_spent, last_purchase)
+    SELECT user_id, product_name, COUNT(*), COALESCE(SUM(amount_spent), 0.0), MAX(purchase_date)
+    FROM (SELECT user_id, product_name, amount_spent, purchase_date FROM main.user_purchases
+          UNION ALL
+          SELECT user_id, product_name, amount_spent, purchase_date FROM archive.user_purchases)
+    GROUP BY user_id, product_name
+    ''',
+]
+# Sales rollups: granularity -> (table, bucket width in seconds). Rows for a sale are
+# upserted into both tables and the leaderboards in the transaction that records it.
+SALES_ROLLUP_SOURCES = ('purchase', 'invoice')
+SALES_ROLLUP_TABLES = {
+    'hourly': ('sales_hourly', 3600),
+    'daily': ('sales_daily', 86400),
+}
+SQL_UPSERT_SALES_ROLLUP = '''
+    INSERT INTO {table} (bucket, guild_id, source, product_name, count, revenue)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(guild_id, source, bucket, product_name) DO UPDATE SET
+        count = count + excluded.count,
+        revenue = revenue + excluded.revenue
+'''
+LEADERBOARD_BOARDS = ('spenders', 'products', 'processors')
+LEADERBOARD_WINDOWS = ('all', 'month', 'week')
+SQL_UPSERT_LEADERBOARD = '''
+    INSERT INTO leaderboards (guild_id, source, board, period, member, label, count, revenue)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(guild_id, source, board, period, member) DO UPDATE SET
+        label = COALESCE(excluded.label, label),
+        count = count + excluded.count,
+        revenue = revenue + excluded.revenue
+'''
+SQL_LEADERBOARD_TOP = '''
+    SELECT member, label, count, revenue
+    FROM leaderboards 
+    WHERE guild_id = ? AND source = ? AND board = ? AND period = ?
+    ORDER BY revenue DESC 
+    LIMIT ?
+'''
+SQL_SALES_TOTALS = '''
+    SELECT COALESCE(SUM(count), 0) AS count, COALESCE(SUM(revenue), 0.0) AS revenue
+    FROM sales_daily 
+    WHERE guild_id = ? AND source = ? AND bucket >= ?
+'''
+SQL_SALES_TREND = '''
+    SELECT bucket, SUM(count) AS count, SUM(revenue) AS revenue
+    FROM {table} 
+    WHERE guild_id = ? AND source = ? AND bucket >= ?
+    GROUP BY bucket 
+    ORDER BY bucket
+'''
+# Backfill of the purchase rollups from live and archived history. Purchases recorded
+# before user_purchases had a guild column carry guild 0.
+SQL_PURCHASE_ROLLUP_BACKFILL = '''
+    INSERT INTO {table} (bucket, guild_id, source, product_name, count, revenue)
+    SELECT CAST(strftime('%s', purchase_date) AS INTEGER) / {width} * {width}, guild_id, 'purchase', 
+           product_name, COUNT(*), COALESCE(SUM(amount_spent), 0.0)
+    FROM (SELECT guild_id, product_name, amount_spent, purchase_date FROM main.user_purchases
+          UNION ALL
+          SELECT guild_id, product_name, amount_spent, purchase_date FROM archive.user_purchases)
+    GROUP BY 1, guild_id, product_name
+'''
+# Same periods as leaderboard_periods(), computed from purchase_date
+PURCHASE_LEADERBOARD_PERIODS = [
+    "'all'",
+    "'month:' || strftime('%Y-%m', purchase_date)",
+    "'week:' || date(purchase_date, '-6 days', 'weekday 1')",
+]
+SQL_PURCHASE_LEADERBOARD_BACKFILL = '''
+    INSERT INTO leaderboards (guild_id, source, board, period, member, label, count, revenue)
+    SELECT guild_id, 'purchase', '{board}', {period}, {member}, MAX({label}), COUNT(*),
+           COALESCE(SUM(amount_spent), 0.0)
+    FROM (SELECT guild_id, user_id, user_tag, product_name, amount_spent, purchase_date FROM main.user_purchases
+          UNION ALL
+          SELECT guild_id, user_id, user_tag, product_name, amount_spent, purchase_date FROM archive.user_purchases)
+    GROUP BY guild_id, 4, 5
+'''
+PURCHASE_LEADERBOARD_MEMBERS = {
+    'spenders': ('CAST(user_id AS TEXT)', 'user_tag'),
+    'products': ('product_name', 'product_name'),
+}
+
+def leaderboard_periods(timestamp: float) -> List[str]:
+    """Every leaderboard period a sale at timestamp counts towards, one per LEADERBOARD_WINDOWS entry"""
+    day = datetime.fromtimestamp(timestamp, timezone.utc)
+    week_start = day - timedelta(days=day.weekday())
+    return ['all', f"month:{day:%Y-%m}", f"week:{week_start:%Y-%m-%d}"]
+
+def record_sale(conn: sqlite3.Connection, source: str, guild_id: Optional[int], product_name: str,
+                customer_id: Optional[int], customer_tag: Optional[str], amount: float,
+                timestamp: float = None, count: int = 1, processor_id: int = None, processor_tag: str = None):
+    """Add a sale to the hourly and daily rollups and the leaderboards (inside the caller's transaction)"""
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    guild_id = guild_id or 0
+    amount = amount or 0.0
+    for table, width in SALES_ROLLUP_TABLES.values():
+        conn.execute(SQL_UPSERT_SALES_ROLLUP.format(table=table),
+                     (timestamp // width * width, guild_id, source, product_name, count, amount))
+    
+    members = [('products', product_name, product_name)]
+    if customer_id:
+        members.append(('spenders', str(customer_id), customer_tag))
+    if processor_id:
+        members.append(('processors', str(processor_id), processor_tag))
+    # One O(log n) upsert per board and window
+    conn.executemany(SQL_UPSERT_LEADERBOARD, [
+        (guild_id, source, board, period, member, label, count, amount)
+        for board, member, label in members
+        for period in leaderboard_periods(timestamp)
+    ])
+
+SQL_INSERT_INVOICE = '''
+INSERT OR REPLACE INTO invoices (guild_id, invoice_id, customer_id, processor_id, product, amount, timestamp, data)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_CUSTOMER_INVOICES = '''
+SELECT data FROM invoices WHERE guild_id = ? AND customer_id = ? ORDER BY timestamp DESC LIMIT ?
+'''
+SQL_COUNT_CUSTOMER_INVOICES = "SELECT COUNT(*) AS count FROM invoices WHERE guild_id = ? AND customer_id = ?"
+SQL_INSERT_WARNING = '''
+INSERT INTO warnings (guild_id, user_id, reason, moderator, moderator_id, timestamp) VALUES (?, ?, ?, ?, ?, ?)
+'''
+SQL_MEMBER_WARNINGS = '''
+SELECT reason, moderator, moderator_id, timestamp FROM warnings WHERE guild_id = ? AND user_id = ? ORDER BY id
+'''
+SQL_COUNT_MEMBER_WARNINGS = "SELECT COUNT(*) AS count FROM warnings WHERE guild_id = ? AND user_id = ?"
+SQL_COUNT_GUILD_WARNINGS = "SELECT COUNT(*) AS count FROM warnings WHERE guild_id = ?"
+SQL_INSERT_VOUCH = '''
+INSERT INTO vouches (user_id, guild_id, product, rating, experience, supporter, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_ADD_VOUCH_TOTAL = '''
+INSERT INTO vouch_totals (user_id, count) VALUES (?, ?)
+ON CONFLICT(user_id) DO UPDATE SET count = count + excluded.count
+RETURNING count
+'''
+SQL_TOTAL_VOUCHES = "SELECT COALESCE(SUM(count), 0) AS total FROM vouch_totals"
+SQL_INSERT_GIVEAWAY = '''
+INSERT OR REPLACE INTO giveaways (guild_id, message_id, giveaway_id, channel_id, prize, winner_count, end_time, ends_at, host)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_GIVEAWAY = "SELECT * FROM giveaways WHERE guild_id = ? AND message_id = ?"
+SQL_GIVEAWAY_BY_ID = "SELECT message_id FROM giveaways WHERE guild_id = ? AND giveaway_id = ?"
+SQL_DUE_GIVEAWAYS = "SELECT * FROM giveaways WHERE ends_at <= ? ORDER BY ends_at"
+SQL_GIVEAWAY_ENTRIES = "SELECT user_id FROM giveaway_entries WHERE message_id = ?"
+SQL_COUNT_GIVEAWAYS = "SELECT COUNT(*) AS count FROM giveaways WHERE guild_id = ?"
+
+# (JSON file, nesting depth of one record) for the categories import_json_records moves into SQLite
+JSON_RECORD_FILES = {
+    'invoices': ('invoices.json', 2),  # {guild_id: {invoice_id: invoice}}
+    'warnings': ('warnings.json', 2),  # {guild_id: {user_id: [warning, ...]}}
+    'vouches': ('vouch_data.json', 1),  # {user_id: {"count": n, "vouches": [vouch, ...]}}
+    'giveaways': ('giveaways.json', 2),  # {guild_id: {message_id: giveaway}}
+}
+
+def giveaway_ends_at(end_time: Optional[str]) -> float:
+    try:
+        return datetime.fromisoformat(end_time).timestamp()
+    except (TypeError, ValueError):
+        # An unreadable end time has always counted as already over
+        return 0.0
+
+def insert_invoice(conn: sqlite3.Connection, guild_id: int, invoice_id: str, invoice: dict):
+    conn.execute(SQL_INSERT_INVOICE, (
+        int(guild_id), str(invoice_id), invoice.get('customer_id'), invoice.get('processor_id'),
+        invoice.get('product'), invoice.get('amount', 0) or 0.0, invoice.get('timestamp', 0) or 0,
+        json.dumps(invoice, ensure_ascii=False)
+    ))
+
+def insert_warning(conn: sqlite3.Connection, guild_id: int, user_id: int, warning: dict):
+    conn.execute(SQL_INSERT_WARNING, (int(guild_id), int(user_id), warning.get('reason'), warning.get('moderator'),
+                                      warning.get('moderator_id'), warning.get('timestamp')))
+
+def insert_vouch(conn: sqlite3.Connection, user_id: int, vouch: dict, guild_id: int = None):
+    conn.execute(SQL_INSERT_VOUCH, (int(user_id), guild_id, vouch.get('product'), vouch.get('rating'),
+                                    vouch.get('experience'), vouch.get('supporter'), vouch.get('timestamp')))
+
+def insert_giveaway(conn: sqlite3.Connection, guild_id: int, giveaway: dict):
+    conn.execute(SQL_INSERT_GIVEAWAY, (
+        int(guild_id), int(giveaway['message_id']), giveaway.get('giveaway_id'), giveaway.get('channel_id'),
+        giveaway.get('prize'), giveaway.get('winner_count', 1), giveaway.get('end_time'),
+        giveaway_ends_at(giveaway.get('end_time')), giveaway.get('host')
+    ))
+    conn.executemany("INSERT OR IGNORE INTO giveaway_entries (message_id, user_id) VALUES (?, ?)",
+                     [(int(giveaway['message_id']), user_id) for user_id in giveaway.get('entries', [])])
+
+def import_json_record(conn: sqlite3.Connection, category: str, path: tuple, value):
+    """Insert one record streamed from a JSON_RECORD_FILES file"""
+    if category == 'invoices':
+        guild_id, invoice_id = path
+        insert_invoice(conn, guild_id, invoice_id, value)
+    elif category == 'warnings':
+        guild_id, user_id = path
+        for warning in value:
+            insert_warning(conn, guild_id, user_id, warning)
+    elif category == 'vouches':
+        user_id, = path
+        vouches = value.get('vouches', [])
+        for vouch in vouches:
+            insert_vouch(conn, user_id, vouch)
+        conn.execute("INSERT OR REPLACE INTO vouch_totals (user_id, count) VALUES (?, ?)",
+                     (int(user_id), max(value.get('count', 0), len(vouches))))
+    elif category == 'giveaways':
+        guild_id, message_id = path
+        insert_giveaway(conn, guild_id, {"message_id": message_id, **value})
+
+# (select ids to move, copy one id into the archive, delete one id from the hot table)
+ARCHIVE_MOVES = {
+    "keys": (
+        "SELECT id FROM main.keys WHERE used = 1 AND license_active = 0 AND date_used < datetime('now', ?) LIMIT ?",
+        '''
+        INSERT OR IGNORE INTO archive.keys (id, product_name, key_value, user_tag, user_id, date_used, created_at,
+                                            expires_at)
+        SELECT id, product_name, key_value, user_tag, user_id, date_used, created_at, expires_at
+        FROM main.keys WHERE id = ?
+        ''',
+        "DELETE FROM main.keys WHERE id = ?",
+    ),
+    "purchases": (
+        "SELECT id FROM main.user_purchases WHERE purchase_date < datetime('now', ?) LIMIT ?",
+        '''
+        INSERT OR IGNORE INTO archive.user_purchases 
+            (id, user_id, user_tag, product_name, amount_spent, purchase_date, transaction_id, guild_id)
+        SELECT id, user_id, user_tag, product_name, amount_spent, purchase_date, transaction_id, guild_id
+        FROM main.user_purchases WHERE id = ?
+        ''',
+        "DELETE FROM main.user_purchases WHERE id = ?",
+    ),
+}
+KEY_DB_HOT_QUERIES = {
+    "claim_key": SQL_CLAIM_KEY,
+    "reserve_keys": SQL_RESERVE_KEYS,
+    "count_stock": SQL_COUNT_STOCK,
+    "top_up_guild_slice": SQL_TOP_UP_GUILD_SLICE,
+    "hold_key": SQL_HOLD_KEY,
+    "claim_held_key": SQL_CLAIM_HELD_KEY,
+    "expired_holds": SQL_EXPIRED_HOLDS,
+    "next_license_expiry": SQL_NEXT_LICENSE_EXPIRY,
+    "next_license_notice": SQL_NEXT_LICENSE_NOTICE,
+    "due_license_notices": SQL_DUE_LICENSE_NOTICES,
+    "due_license_expiries": SQL_DUE_LICENSE_EXPIRIES,
+    "lapsed_license_customers": SQL_LAPSED_LICENSE_CUSTOMERS,
+    "user_product_totals": SQL_USER_PRODUCT_TOTALS,
+    "user_totals": SQL_USER_TOTALS,
+    "sales_totals": SQL_SALES_TOTALS,
+    "leaderboard_top": SQL_LEADERBOARD_TOP,
+    "sales_trend": SQL_SALES_TREND.format(table='sales_daily'),
+    "customer_invoices": SQL_CUSTOMER_INVOICES,
+    "member_warnings": SQL_MEMBER_WARNINGS,
+    "count_guild_warnings": SQL_COUNT_GUILD_WARNINGS,
+    "giveaway_by_id": SQL_GIVEAWAY_BY_ID,
+    "due_giveaways": SQL_DUE_GIVEAWAYS,
+}
+
+def migrate_key_database(conn: sqlite3.Connection) -> int:
+    """Apply every pending migration in order and return the resulting schema version"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for target_version, description, steps in KEY_DB_MIGRATIONS:
+        if target_version <= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            # PRAGMA does not accept bound parameters; target_version is always an int literal above
+            conn.execute(f'PRAGMA user_version = {int(target_version)}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        version = target_version
+        logger.info(f"✅ Key database migrated to v{version}: {description}")
+    return version
+
+def check_key_query_plans(conn: sqlite3.Connection) -> Dict[str, List[str]]:
+    """EXPLAIN QUERY PLAN each hot query and return the ones that scan a table without an index"""
+    full_scans = {}
+    for name, sql in KEY_DB_HOT_QUERIES.items():
+        params = (None,) * sql.count('?')
+        plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        scans = [detail for detail in plan if detail.startswith('SCAN') and 'INDEX' not in detail]
+        if scans:
+            full_scans[name] = scans
+    return full_scans
+
+def attach_key_archive(conn: sqlite3.Connection, archive_path: str):
+    conn.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+
+def init_key_database():
+    conn = sqlite3.connect(CONFIG['DATABASE_PATH'], isolation_level=None)
+    try:
+        # WAL is persistent on the database file, so readers never wait on the KeyWriter thread
+        conn.execute('PRAGMA journal_mode=WAL;')
+        version = migrate_key_database(conn)
+        
+        attach_key_archive(conn, CONFIG['ARCHIVE_DATABASE_PATH'])
+        conn.execute('PRAGMA archive.journal_mode=WAL;')
+        for statement in ARCHIVE_DB_SCHEMA:
+            conn.execute(statement)
+        for table, column, definition in ARCHIVE_DB_COLUMNS:
+            if column not in {row[1] for row in conn.execute(f'PRAGMA archive.table_info({table})')}:
+                conn.execute(f'ALTER TABLE archive.{table} ADD COLUMN {column} {definition}')
+        for statement in ARCHIVE_DB_INDEXES:
+            conn.execute(statement)
+        
+        for name, scans in check_key_query_plans(conn).items():
+            logger.warning(f"⚠️ Hot key query '{name}' is not using an index: {'; '.join(scans)}")
+    finally:
+        conn.close()
+    logger.info(f"✅ SQLite key database initialized (schema v{version})")
+
+def release_stale_key_reservations():
+    """Return keys reserved by a previous bot process to stock; only the bot process should call this"""
+    conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
+    try:
+        cursor = conn.execute(
+            "UPDATE keys SET reserved_token = NULL WHERE used = 0 AND reserved_token LIKE ?",
+            (f"{RESERVATION_TOKEN_PREFIX}%",)
+        )
+        conn.commit()
+        if cursor.rowcount:
+            logger.info(f"♻️ Returned {cursor.rowcount} reserved keys from a previous run to stock")
+    finally:
+        conn.close()
+
+def backup_database(path: str, backup_path: str):
+    """Copy a consistent snapshot of a live SQLite database with the online backup API"""
+    # Both connections are opened here, so this can run in a worker thread
+    source = sqlite3.connect(path)
+    target = sqlite3.connect(backup_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+def prune_backups(prefix: str, suffix: str):
+    """Delete the oldest prefix<timestamp>suffix files in BACKUP_FOLDER beyond MAX_BACKUPS"""
+    backup_files = [os.path.join(CONFIG['BACKUP_FOLDER'], file) for file in os.listdir(CONFIG['BACKUP_FOLDER'])
+                    if file.startswith(prefix) and file.endswith(suffix)
+                    # "product_keys_" must not match "product_keys_archive_..."
+                    and file[len(prefix):-len(suffix)].replace('_', '').isdigit()]
+    backup_files.sort(key=os.path.getctime)
+    while len(backup_files) > CONFIG['MAX_BACKUPS']:
+        os.remove(backup_files.pop(0))
+
+class IdGenerator:
+    """Snowflake-style IDs: milliseconds since ID_EPOCH_MS, worker ID and a per-millisecond sequence"""
+
+    ID_EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id < (1 << self.WORKER_BITS):
+            raise ValueError(f"ID worker must be between 0 and {(1 << self.WORKER_BITS) - 1}, got {worker_id}")
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_id(self) -> int:
+        with self._lock:
+            now_ms = int(time.time() * 1000) - self.ID_EPOCH_MS
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                # Same millisecond, or the wall clock stepped backwards: keep counting from the
+                # last timestamp we issued and borrow the next millisecond once it is used up
+                self._sequence += 1
+                if self._sequence >> self.SEQUENCE_BITS:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return ((self._last_ms << (self.WORKER_BITS + self.SEQUENCE_BITS))
+                    | (self.worker_id << self.SEQUENCE_BITS)
+                    | self._sequence)
+
+id_generator = IdGenerator(CONFIG['ID_WORKER_ID'])
+
+class KeyWriter(threading.Thread):
+    """Owns the only write connection to the key database and commits queued operations in groups"""
+
+    def __init__(self, db_path: str, archive_path: str):
+        super().__init__(name="key-db-writer", daemon=True)
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self._queue = queue.SimpleQueue()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.batches = 0
+        self.operations = 0
+        self.largest_batch = 0
+
+    def submit(self, operation: Callable[[sqlite3.Connection], object]) -> asyncio.Future:
+        """Queue operation(conn) for the next group commit; the future resolves once it is durable"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self.start()
+        future = self._loop.create_future()
+        self._queue.put((operation, future))
+        return future
+
+    def stop(self):
+        if self._loop is not None:
+            self._queue.put(None)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=NORMAL;')
+        conn.execute('PRAGMA busy_timeout=5000;')
+        attach_key_archive(conn, self.archive_path)
+        logger.info(f"✅ Key writer connected to {self.db_path}")
+
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                # Group commit: everything that queued up behind the first operation shares its transaction
+                while len(batch) < CONFIG['KEY_WRITER_MAX_BATCH']:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._commit_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn: sqlite3.Connection, batch: list):
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for operation, future in batch:
+                # A savepoint per operation, so one failure only rolls back its own changes
+                conn.execute('SAVEPOINT operation')
+                try:
+                    result = operation(conn)
+                    conn.execute('RELEASE operation')
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    conn.execute('ROLLBACK TO operation')
+                    conn.execute('RELEASE operation')
+                    outcomes.append((future, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            outcomes = [(future, None, e) for _, future in batch]
+
+        self.batches += 1
+        self.operations += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for future, result, error in outcomes:
+            self._loop.call_soon_threadsafe(self._resolve, future, result, error)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result, error: Optional[Exception]):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+class ReadPool:
+    """Read-only connections for analytics on their own bounded executor, so long reports
+    never queue in front of the delivery reader or the writer thread"""
+
+    def __init__(self, db_path: str, archive_path: str, size: int):
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="key-db-analytics")
+        self._idle: List[sqlite3.Connection] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+        self.active = 0
+        self.completed = 0
+        self.peak_waiting = 0
+        self.total_wait = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        # Handed between executor threads, but only ever used by one of them at a time
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        attach_key_archive(conn, self.archive_path)
+        conn.execute('PRAGMA query_only=ON;')
+        conn.execute('PRAGMA busy_timeout=5000;')
+        return conn
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """Check out a connection; callers past the pool size wait here and count as queue depth"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        started = time.monotonic()
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.total_wait += time.monotonic() - started
+        
+        self.active += 1
+        conn = None
+        try:
+            conn = self._idle.pop() if self._idle else await self._run(self._connect)
+            yield conn
+        finally:
+            if conn is not None:
+                self._idle.append(conn)
+            self.active -= 1
+            self.completed += 1
+            self._slots.release()
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        async with self.connection() as conn:
+            return await self._run(lambda: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        async with self.connection() as conn:
+            return await self._run(lambda: conn.execute(sql, params).fetchall())
+
+    async def run(self, operation: Callable[[sqlite3.Connection], object]):
+        """Run operation(conn) on one checked-out connection, for reads that take several queries"""
+        async with self.connection() as conn:
+            return await self._run(operation, conn)
+
+    async def iter_rows(self, sql: str, params: tuple = ()) -> AsyncIterator[sqlite3.Row]:
+        """Stream a query chunk by chunk, holding one connection until the caller finishes"""
+        async with self.connection() as conn:
+            cursor = await self._run(conn.execute, sql, params)
+            try:
+                while True:
+                    rows = await self._run(cursor.fetchmany, CONFIG['KEY_IMPORT_CHUNK_SIZE'])
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        return {
+            "size": self.size,
+            "active": self.active,
+            "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting,
+            "completed": self.completed,
+            "avg_wait_ms": self.total_wait / max(self.completed, 1) * 1000
+        }
+
+    async def close(self):
+        await asyncio.to_thread(self.executor.shutdown, wait=True)
+        for conn in self._idle:
+            conn.close()
+        self._idle.clear()
+
+class KeyStore:
+    """Key database access: writes go through the KeyWriter thread, delivery-path reads use a
+    read-only aiosqlite connection, and dashboards, exports and reports use the analytics ReadPool"""
+
+    def __init__(self, db_path: str, archive_path: str):
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.writer = KeyWriter(db_path, archive_path)
+        self.analytics = ReadPool(db_path, archive_path, CONFIG['KEY_ANALYTICS_POOL_SIZE'])
+        self._reader: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        self.reader_in_flight = 0
+
+    async def reader(self) -> aiosqlite.Connection:
+        if self._reader is None:
+            async with self._connect_lock:
+                if self._reader is None:
+                    # cached_statements: the hot queries below are compiled once and reused
+                    conn = await aiosqlite.connect(self.db_path, cached_statements=256)
+                    conn.row_factory = sqlite3.Row
+                    await conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+                    await conn.execute('PRAGMA query_only=ON;')
+                    await conn.execute('PRAGMA busy_timeout=5000;')
+                    self._reader = conn
+                    logger.info(f"✅ KeyStore reader connected to {self.db_path}")
+        return self._reader
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        conn = await self.reader()
+        self.reader_in_flight += 1
+        try:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchone()
+        finally:
+            self.reader_in_flight -= 1
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        conn = await self.reader()
+        self.reader_in_flight += 1
+        try:
+            async with conn.execute(sql, params) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self.reader_in_flight -= 1
+
+    async def write(self, operation: Callable[[sqlite3.Connection], object]):
+        """Run operation(conn) on the writer thread and return its result after the commit"""
+        return await self.writer.submit(operation)
+
+    async def close(self):
+        if self.writer.is_alive():
+            self.writer.stop()
+            await asyncio.to_thread(self.writer.join)
+        if self._reader is not None:
+            await self._reader.close()
+            self._reader = None
+        await self.analytics.close()
+
+class StockCache:
+    """In-memory count of unused keys per product and per guild slice, adjusted by claims and imports"""
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+        self.slices: Dict[int, Dict[str, int]] = {}
+        self.allocated: Dict[str, int] = {}
+        self.held: Dict[str, int] = {}
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.reconciles = 0
+        self.drift_corrections = 0
+        self.last_drift = 0
+        self.last_reconciled: Optional[datetime] = None
+
+    def adjust(self, product_name: str, delta: int, guild_id: int = None):
+        if self.loaded:
+            self.counts[product_name] = self.counts.get(product_name, 0) + delta
+            if guild_id is not None:
+                self.allocate(product_name, guild_id, delta)
+
+    def allocate(self, product_name: str, guild_id: int, delta: int):
+        """Record keys moving between the shared pool and a guild's slice (negative to release)"""
+        if self.loaded and delta:
+            guild_slice = self.slices.setdefault(guild_id, {})
+            guild_slice[product_name] = guild_slice.get(product_name, 0) + delta
+            self.allocated[product_name] = self.allocated.get(product_name, 0) + delta
+
+    def hold(self, product_name: str, guild_id: Optional[int], delta: int):
+        """Move keys from available to held (negative delta releases them back)"""
+        if self.loaded:
+            self.adjust(product_name, -delta, guild_id)
+            self.held[product_name] = self.held.get(product_name, 0) + delta
+
+    def available(self, product_name: str, guild_id: int = None) -> int:
+        """Total stock, or for a guild its own slice plus the unallocated shared keys"""
+        total = self.counts.get(product_name, 0)
+        if guild_id is None:
+            return total
+        shared = total - self.allocated.get(product_name, 0)
+        return self.slices.get(guild_id, {}).get(product_name, 0) + shared
+
+    def replace(self, counts: Dict[str, int], slices: Dict[int, Dict[str, int]], held: Dict[str, int]) -> int:
+        """Swap in fresh counts from the database and return the total drift found"""
+        drift = 0
+        if self.loaded:
+            for product_name in set(self.counts) | set(counts):
+                drift += abs(self.counts.get(product_name, 0) - counts.get(product_name, 0))
+        allocated = {}
+        for guild_slice in slices.values():
+            for product_name, count in guild_slice.items():
+                allocated[product_name] = allocated.get(product_name, 0) + count
+        self.counts = counts
+        self.slices = slices
+        self.allocated = allocated
+        self.held = held
+        self.loaded = True
+        return drift
+
+    def metrics(self) -> Dict[str, Union[int, float, str, None]]:
+        lookups = self.hits + self.misses
+        return {
+            "products": len(self.counts),
+            "guild_slices": sum(len(guild_slice) for guild_slice in self.slices.values()),
+            "held": sum(self.held.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "reconciles": self.reconciles,
+            "drift_corrections": self.drift_corrections,
+            "last_drift": self.last_drift,
+            "last_reconciled": self.last_reconciled.isoformat() if self.last_reconciled else None
+        }
+
+class ReservationPool:
+    """Keys reserved in SQLite ahead of time for hot products, handed out from memory"""
+
+    def __init__(self):
+        # A fresh token per process; release_stale_key_reservations frees whatever a crashed run held
+        self.token = f"{RESERVATION_TOKEN_PREFIX}{uuid.uuid4().hex}"
+        # Most recently delivered product last, so the least recent one is evicted first
+        self.queues: OrderedDict = OrderedDict()
+        # Keys popped from memory whose final assignment has not been committed yet
+        self.pending: Dict[str, int] = {}
+        self.refilling = set()
+        self.hits = 0
+        self.misses = 0
+
+    def pop(self, product_name: str) -> Optional[tuple]:
+        queue = self.queues.get(product_name)
+        if not queue:
+            self.misses += 1
+            return None
+        self.queues.move_to_end(product_name)
+        self.hits += 1
+        self.pending[product_name] = self.pending.get(product_name, 0) + 1
+        return queue.popleft()
+
+    def needs_refill(self, product_name: str) -> bool:
+        if product_name in self.refilling:
+            return False
+        queue = self.queues.get(product_name)
+        return queue is None or len(queue) < CONFIG['KEY_POOL_LOW_WATER']
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        lookups = self.hits + self.misses
+        return {
+            "products": len(self.queues),
+            "reserved": sum(len(queue) for queue in self.queues.values()),
+            "pending": sum(self.pending.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+class BloomFilter:
+    """Fixed-size Bloom filter over 16-byte digests (about 1% false positives at capacity)"""
+
+    BITS_PER_ITEM = 10
+    HASHES = 7
+
+    def __init__(self, capacity: int):
+        self.capacity = max(capacity, 1024)
+        self.size = self.capacity * self.BITS_PER_ITEM
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, digest: bytes):
+        # Double hashing: two 64-bit halves of the digest stand in for k independent hashes
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.HASHES))
+
+    def add(self, digest: bytes):
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+class UsedKeyIndex:
+    """Hashes of every assigned key, so key validation never has to touch SQLite"""
+
+    def __init__(self):
+        self.products: Dict[bytes, str] = {}
+        # Digests of timed licenses that have run out; still known, no longer valid
+        self.expired: set = set()
+        self.bloom: Optional[BloomFilter] = None
+        self.responses: OrderedDict = OrderedDict()
+        self.loaded = False
+        self.lookups = 0
+        self.cache_hits = 0
+        self.bloom_negatives = 0
+
+    @staticmethod
+    def digest(key_value: str) -> bytes:
+        return hashlib.blake2b(key_value.encode(), digest_size=16).digest()
+
+    def add(self, key_value: str, product_name: str, expired: bool = False):
+        digest = self.digest(key_value)
+        self.products[digest] = product_name
+        if expired:
+            self.expired.add(digest)
+        if self.bloom is not None:
+            if len(self.products) > self.bloom.capacity:
+                self.rebuild_bloom()
+            else:
+                self.bloom.add(digest)
+        # A cached "not found" for this key is stale now
+        self.responses.pop(digest, None)
+
+    def expire(self, key_value: str):
+        digest = self.digest(key_value)
+        if digest in self.products:
+            self.expired.add(digest)
+            self.responses.pop(digest, None)
+
+    def rebuild_bloom(self):
+        if not CONFIG['KEY_VALIDATION_BLOOM']:
+            self.bloom = None
+            return
+        bloom = BloomFilter(len(self.products) * 2)
+        for digest in self.products:
+            bloom.add(digest)
+        self.bloom = bloom
+
+    def lookup(self, key_value: str) -> Optional[str]:
+        return self._lookup_digest(self.digest(key_value))
+
+    def _lookup_digest(self, digest: bytes) -> Optional[str]:
+        if self.bloom is not None and digest not in self.bloom:
+            self.bloom_negatives += 1
+            return None
+        return self.products.get(digest)
+
+    def validate(self, key_value: str) -> bytes:
+        """JSON response body for a key, served from the LRU of recent lookups when possible"""
+        self.lookups += 1
+        # Cached by digest too, so no plaintext key is held once its request is answered
+        digest = self.digest(key_value)
+        cached = self.responses.get(digest)
+        if cached is not None:
+            self.responses.move_to_end(digest)
+            self.cache_hits += 1
+            return cached
+        
+        product_name = self._lookup_digest(digest)
+        if product_name is not None and digest in self.expired:
+            body = json.dumps({"valid": False, "product": product_name, "expired": True}).encode()
+        else:
+            body = json.dumps({"valid": product_name is not None, "product": product_name}).encode()
+        self.responses[digest] = body
+        if len(self.responses) > CONFIG['KEY_VALIDATION_CACHE_SIZE']:
+            self.responses.popitem(last=False)
+        return body
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        return {
+            "keys": len(self.products),
+            "expired": len(self.expired),
+            "lookups": self.lookups,
+            "cache_hit_rate": self.cache_hits / self.lookups if self.lookups else 0.0,
+            "bloom_negatives": self.bloom_negatives
+        }
+
+def key_validation_app(index: UsedKeyIndex, token: Optional[str] = None) -> web.Application:
+    """aiohttp app serving GET /validate?key=... and POST {"key": ...} from index, never from SQLite"""
+    async def handle_validate_key(request: web.Request) -> web.Response:
+        if token and request.headers.get('Authorization') != f"Bearer {token}":
+            return web.json_response({"error": "unauthorized"}, status=401)
+        if not index.loaded:
+            return web.json_response({"error": "index loading"}, status=503)
+        
+        if request.method == 'POST':
+            try:
+                key_value = (await request.json()).get('key')
+            except (json.JSONDecodeError, AttributeError):
+                key_value = None
+        else:
+            key_value = request.query.get('key')
+        if not key_value or not isinstance(key_value, str):
+            return web.json_response({"error": "missing key"}, status=400)
+        
+        return web.Response(body=index.validate(key_value.strip()), content_type='application/json')
+    
+    app = web.Application()
+    app.router.add_get('/validate', handle_validate_key)
+    app.router.add_post('/validate', handle_validate_key)
+    return app
+
+class KeyManager:
+    def __init__(self, store: KeyStore):
+        self.store = store
+        self.stock = StockCache()
+        self.pool = ReservationPool()
+        self.guild_quotas: Dict[int, Dict[str, int]] = {}
+        self.used_keys = UsedKeyIndex()
+        # Set whenever a claim starts a timed license, so the expiry scheduler can re-plan its sleep
+        self.license_started = asyncio.Event()
+        self._stock_loading: Optional[asyncio.Task] = None
+        self._background_tasks = set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def reconcile_stock(self) -> int:
+        """Recount stock from SQLite and correct the cache; returns the drift that was found"""
+        # Counting on the writer thread orders the count after every write queued before it
+        def count_stock(conn: sqlite3.Connection) -> tuple:
+            counts, slices, held, quotas = {}, {}, {}, {}
+            for row in conn.execute(SQL_COUNT_STOCK):
+                product_name = row['product_name']
+                counts[product_name] = counts.get(product_name, 0) + row['count']
+                if row['guild_id'] is not None:
+                    slices.setdefault(row['guild_id'], {})[product_name] = row['count']
+            # Held keys are still unused in the keys table; report them separately
+            for row in conn.execute(SQL_COUNT_HOLDS):
+                product_name = row['product_name']
+                counts[product_name] = counts.get(product_name, 0) - row['count']
+                held[product_name] = held.get(product_name, 0) + row['count']
+                if row['guild_id'] is not None:
+                    guild_slice = slices.setdefault(row['guild_id'], {})
+                    guild_slice[product_name] = guild_slice.get(product_name, 0) - row['count']
+            for row in conn.execute("SELECT guild_id, product_name, quota FROM guild_quotas"):
+                quotas.setdefault(row['guild_id'], {})[row['product_name']] = row['quota']
+            return counts, slices, held, quotas
+        
+        counts, slices, held, self.guild_quotas = await self.store.write(count_stock)
+        # Keys already handed out from the pool are still unused in SQLite until their assignment commits
+        for product_name, pending in self.pool.pending.items():
+            if product_name in counts:
+                counts[product_name] -= pending
+        was_loaded = self.stock.loaded
+        drift = self.stock.replace(counts, slices, held)
+        
+        if was_loaded:
+            self.stock.reconciles += 1
+            self.stock.last_drift = drift
+            self.stock.last_reconciled = datetime.now()
+            if drift:
+                self.stock.drift_corrections += 1
+                logger.warning(f"⚠️ Stock cache drifted by {drift} keys; corrected from database")
+        return drift
+
+    async def load_stock(self):
+        """Load the stock cache if needed; callers arriving while it loads share the same count"""
+        if self.stock.loaded:
+            return
+        if self._stock_loading is None or self._stock_loading.done():
+            self._stock_loading = asyncio.ensure_future(self.reconcile_stock())
+        # Shielded: one caller being cancelled must not cancel the count the others wait on
+        await asyncio.shield(self._stock_loading)
+
+    async def add_product(self, product_name: str, description: str = "") -> bool:
+        def insert_product(conn: sqlite3.Connection) -> bool:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO products (name, description) VALUES (?, ?)",
+                (product_name.strip(), description)
+            )
+            return cursor.rowcount > 0
+        
+        try:
+            return await self.store.write(insert_product)
+        except Exception as e:
+            logger.error(f"❌ Error creating product '{product_name}': {e}")
+            return False
+
+    async def _insert_key_chunk(self, product_name: str, chunk: List[str], duration_days: int = None) -> int:
+        """Insert one chunk of keys in a single write operation and return how many were new"""
+        def insert_chunk(conn: sqlite3.Connection) -> int:
+            conn.execute("INSERT OR IGNORE INTO products (name, description) VALUES (?, ?)",
+                         (product_name, ""))
+            # Archived keys were already sold, so they count as duplicates too
+            cursor = conn.executemany(SQL_INSERT_KEY, [(product_name, key, duration_days, key) for key in chunk])
+            return cursor.rowcount
+        
+        added = await self.store.write(insert_chunk)
+        self.stock.adjust(product_name, added)
+        return added
+
+    async def import_keys(self, product_name: str, keys: AsyncIterator[str],
+                          progress: Callable[[int, int], Awaitable[None]] = None,
+                          duration_days: int = None) -> Dict[str, Union[bool, str, int]]:
+        """Stream keys into a product chunk by chunk; duplicates are skipped by INSERT OR IGNORE.
+        Keys imported with duration_days become licenses that expire that many days after delivery."""
+        product_name = product_name.strip()
+        chunk_size = CONFIG['KEY_IMPORT_CHUNK_SIZE']
+        added_count = 0
+        duplicate_count = 0
+        chunk = []
+        
+        try:
+            async for key in keys:
+                key = key.strip()
+                if not key:
+                    continue
+                chunk.append(key)
+                if len(chunk) < chunk_size:
+                    continue
+                
+                added = await self._insert_key_chunk(product_name, chunk, duration_days)
+                added_count += added
+                duplicate_count += len(chunk) - added
+                chunk = []
+                if progress:
+                    await progress(added_count, duplicate_count)
+            
+            if chunk:
+                added = await self._insert_key_chunk(product_name, chunk, duration_days)
+                added_count += added
+                duplicate_count += len(chunk) - added
+        except Exception as e:
+            logger.error(f"❌ Error importing keys to {product_name} after {added_count} added: {e}")
+            return {"success": False, "message": f"Import stopped after {added_count} keys: {str(e)}",
+                    "added": added_count, "duplicates": duplicate_count}
+        
+        if added_count == 0 and duplicate_count == 0:
+            return {"success": False, "message": "No keys provided", "added": 0, "duplicates": 0}
+        
+        if added_count:
+            await self._top_up_guild_slices(product_name)
+        result_msg = f"Added {added_count} keys to {product_name}"
+        if duplicate_count > 0:
+            result_msg += f" ({duplicate_count} duplicates skipped)"
+        logger.info(f"✅ {result_msg}")
+        return {"success": True, "message": result_msg, "added": added_count, "duplicates": duplicate_count}
+
+    async def add_keys_to_product(self, product_name: str, keys: List[str],
+                                  duration_days: int = None) -> Dict[str, Union[bool, str, int]]:
+        async def iter_keys():
+            for key in keys:
+                yield key
+        
+        return await self.import_keys(product_name, iter_keys(), duration_days=duration_days)
+
+    async def _top_up_guild_slices(self, product_name: str):
+        """Refill every guild slice of a product up to its quota from the shared pool"""
+        def top_up(conn: sqlite3.Connection) -> Dict[int, int]:
+            guild_ids = [row[0] for row in conn.execute(
+                "SELECT guild_id FROM guild_quotas WHERE product_name = ?", (product_name,)
+            ).fetchall()]
+            return {
+                guild_id: conn.execute(SQL_TOP_UP_GUILD_SLICE, (guild_id, product_name, guild_id, product_name,
+                                                                product_name, guild_id)).rowcount
+                for guild_id in guild_ids
+            }
+        
+        try:
+            for guild_id, moved in (await self.store.write(top_up)).items():
+                self.stock.allocate(product_name, guild_id, moved)
+        except Exception as e:
+            logger.error(f"❌ Error topping up guild slices for {product_name}: {e}")
+
+    async def set_guild_quota(self, guild_id: int, product_name: str, quota: int) -> int:
+        """Give a guild a fixed slice of a product's keys (0 returns the slice to the shared pool); returns the slice size"""
+        product_name = product_name.strip()
+        
+        def apply_quota(conn: sqlite3.Connection) -> tuple:
+            before = conn.execute(
+                "SELECT COUNT(*) FROM keys WHERE product_name = ? AND guild_id = ? AND used = 0",
+                (product_name, guild_id)
+            ).fetchone()[0]
+            if quota > 0:
+                conn.execute(
+                    "INSERT INTO guild_quotas (guild_id, product_name, quota) VALUES (?, ?, ?) "
+                    "ON CONFLICT(guild_id, product_name) DO UPDATE SET quota = excluded.quota",
+                    (guild_id, product_name, quota)
+                )
+            else:
+                conn.execute("DELETE FROM guild_quotas WHERE guild_id = ? AND product_name = ?", (guild_id, product_name))
+            if before > quota:
+                conn.execute(SQL_RELEASE_GUILD_SLICE, (product_name, guild_id, before - quota))
+            conn.execute(SQL_TOP_UP_GUILD_SLICE, (guild_id, product_name, guild_id, product_name, product_name, guild_id))
+            after = conn.execute(
+                "SELECT COUNT(*) FROM keys WHERE product_name = ? AND guild_id = ? AND used = 0",
+                (product_name, guild_id)
+            ).fetchone()[0]
+            return before, after
+        
+        before, after = await self.store.write(apply_quota)
+        guild_quotas = self.guild_quotas.setdefault(guild_id, {})
+        if quota > 0:
+            guild_quotas[product_name] = quota
+        else:
+            guild_quotas.pop(product_name, None)
+        self.stock.allocate(product_name, guild_id, after - before)
+        logger.info(f"✅ Guild {guild_id} quota for {product_name} set to {quota} ({after} keys allocated)")
+        return after
+
+    @staticmethod
+    def _record_purchase(conn: sqlite3.Connection, product_name: str, user_tag: str,
+                         user_id: int, amount_spent: float, guild_id: int = None):
+        transaction_id = f"txn_{id_generator.next_id()}"
+        conn.execute(SQL_INSERT_PURCHASE, (user_id, user_tag, product_name, amount_spent, transaction_id, guild_id or 0))
+        conn.execute(SQL_UPSERT_USER_TOTALS, (user_id, amount_spent))
+        conn.execute(SQL_UPSERT_USER_PRODUCT_TOTALS, (user_id, product_name, amount_spent))
+        record_sale(conn, 'purchase', guild_id, product_name.strip(), user_id, user_tag, amount_spent)
+
+    def _schedule_refill(self, product_name: str):
+        if self.pool.needs_refill(product_name):
+            # Marked before the task runs, so claims finishing in the same tick do not each start a refill
+            self.pool.refilling.add(product_name)
+            self._spawn(self._refill_pool(product_name))
+
+    async def _refill_pool(self, product_name: str):
+        try:
+            key_queue = self.pool.queues.get(product_name)
+            if key_queue is None:
+                key_queue = self.pool.queues[product_name] = deque()
+                while len(self.pool.queues) > CONFIG['KEY_POOL_MAX_PRODUCTS']:
+                    _, evicted = self.pool.queues.popitem(last=False)
+                    await self._release_reserved([key_id for key_id, _ in evicted])
+            
+            wanted = CONFIG['KEY_POOL_SIZE'] - len(key_queue)
+            if wanted <= 0:
+                return
+            
+            def reserve_keys(conn: sqlite3.Connection) -> List[tuple]:
+                rows = conn.execute(SQL_RESERVE_KEYS, (self.pool.token, product_name, wanted)).fetchall()
+                return [(row['id'], row['key_value']) for row in rows]
+            
+            reserved = await self.store.write(reserve_keys)
+            if self.pool.queues.get(product_name) is key_queue:
+                key_queue.extend(reserved)
+            else:
+                # Evicted while we were reserving
+                await self._release_reserved([key_id for key_id, _ in reserved])
+        except Exception as e:
+            logger.error(f"❌ Error refilling key pool for {product_name}: {e}")
+        finally:
+            self.pool.refilling.discard(product_name)
+
+    async def _release_reserved(self, key_ids: List[int]):
+        if not key_ids:
+            return
+        
+        def release(conn: sqlite3.Connection):
+            conn.executemany(
+                "UPDATE keys SET reserved_token = NULL WHERE id = ? AND reserved_token = ?",
+                [(key_id, self.pool.token) for key_id in key_ids]
+            )
+        
+        await self.store.write(release)
+
+    async def _assign_reserved_key(self, product_name: str, key_id: int, user_tag: str,
+                                   user_id: int, amount_spent: float, guild_id: int = None):
+        def assign_key(conn: sqlite3.Connection) -> Optional[int]:
+            result = conn.execute(SQL_ASSIGN_RESERVED_KEY, (user_tag, user_id, guild_id, key_id, self.pool.token)).fetchone()
+            return result['expires_at'] if result else None
+        
+        def assign_and_record(conn: sqlite3.Connection) -> Optional[int]:
+            expires_at = assign_key(conn)
+            self._record_purchase(conn, product_name, user_tag, user_id, amount_spent, guild_id)
+            return expires_at
+        
+        try:
+            expires_at = await self.store.write(assign_and_record)
+        except Exception as e:
+            logger.error(f"❌ Error recording delivery of reserved key #{key_id} ({product_name}) to {user_id}: {e}")
+            # The key is already in the customer's hands; never let it go back to stock
+            try:
+                expires_at = await self.store.write(assign_key)
+            except Exception as e:
+                expires_at = None
+                logger.error(f"❌ Reserved key #{key_id} ({product_name}) could not be marked used: {e}")
+        finally:
+            self.pool.pending[product_name.strip()] -= 1
+        if expires_at is not None:
+            self.license_started.set()
+
+    def _deliver_reserved(self, product_name: str, reserved: tuple, user_tag: str, user_id: int,
+                          amount_spent: float, guild_id: Optional[int]) -> str:
+        """Hand out a key popped from the pool; its assignment is persisted in the background"""
+        product = product_name.strip()
+        key_id, key_value = reserved
+        self.stock.adjust(product, -1)
+        self.used_keys.add(key_value, product)
+        self._spawn(self._assign_reserved_key(product_name, key_id, user_tag, user_id, amount_spent, guild_id))
+        self._schedule_refill(product)
+        return key_value
+
+    async def use_product_key(self, product_name: str, user_tag: str, user_id: int, amount_spent: float = 0.0,
+                              guild_id: int = None) -> Optional[str]:
+        product = product_name.strip()
+        try:
+            await self.load_stock()
+        except Exception as e:
+            logger.error(f"❌ Error using key for {product_name}: {e}")
+            return None
+        
+        # Guilds with a quota claim from their own slice first, then fall back to the shared pool
+        has_quota = guild_id is not None and product in self.guild_quotas.get(guild_id, {})
+        
+        # Hot path: the key is already reserved for us, persist the assignment in the background
+        reserved = None if has_quota else self.pool.pop(product)
+        if reserved:
+            return self._deliver_reserved(product_name, reserved, user_tag, user_id, amount_spent, guild_id)
+        
+        def claim_key(conn: sqlite3.Connection) -> Optional[tuple]:
+            # Reserve and return the key in one statement; the writer's BEGIN IMMEDIATE keeps
+            # other processes from claiming the same row between the subquery and the UPDATE
+            for claim_guild_id in ((guild_id, None) if has_quota else (None,)):
+                result = conn.execute(SQL_CLAIM_KEY, (user_tag, user_id, guild_id, product, claim_guild_id)).fetchone()
+                if result:
+                    break
+            else:
+                return None
+            # Add to purchase history in the same transaction as the claim
+            self._record_purchase(conn, product_name, user_tag, user_id, amount_spent, guild_id)
+            topped_up = 0
+            if has_quota:
+                topped_up = conn.execute(SQL_TOP_UP_GUILD_SLICE, (guild_id, product, guild_id, product,
+                                                                  product, guild_id)).rowcount
+            return result['key_value'], result['expires_at'], claim_guild_id, topped_up
+        
+        try:
+            claimed = await self.store.write(claim_key)
+        except Exception as e:
+            logger.error(f"❌ Error using key for {product_name}: {e}")
+            return None
+        if not claimed:
+            # A refill that was in flight may have reserved the last keys while we were claiming
+            reserved = None if has_quota else self.pool.pop(product)
+            if reserved:
+                return self._deliver_reserved(product_name, reserved, user_tag, user_id, amount_spent, guild_id)
+            return None
+        
+        key_value, expires_at, claim_guild_id, topped_up = claimed
+        self.stock.adjust(product, -1, claim_guild_id)
+        self.used_keys.add(key_value, product)
+        if expires_at is not None:
+            self.license_started.set()
+        if topped_up:
+            self.stock.allocate(product, guild_id, topped_up)
+        self._schedule_refill(product)
+        return key_value
+
+    async def hold_key(self, product_name: str, user_id: int, minutes: int, guild_id: int = None) -> Optional[tuple]:
+        """Hold one key for a user for `minutes`; returns (hold_token, expires_at, is_new) or None when out
+        of stock. is_new is False when the user's existing hold on the product was extended instead"""
+        product = product_name.strip()
+        expires_at = time.time() + minutes * 60
+        has_quota = guild_id is not None and product in self.guild_quotas.get(guild_id, {})
+        
+        def place_hold(conn: sqlite3.Connection) -> Optional[tuple]:
+            # A repeated confirmation for the same customer extends their hold instead of taking another key
+            existing = conn.execute(
+                "SELECT hold_token FROM key_holds WHERE user_id = ? AND product_name = ? LIMIT 1",
+                (user_id, product)
+            ).fetchone()
+            if existing:
+                conn.execute("UPDATE key_holds SET expires_at = ? WHERE hold_token = ?",
+                             (expires_at, existing['hold_token']))
+                return existing['hold_token'], None, False
+            
+            hold_token = f"{HOLD_TOKEN_PREFIX}{uuid.uuid4().hex}"
+            for hold_guild_id in ((guild_id, None) if has_quota else (None,)):
+                held = conn.execute(SQL_HOLD_KEY, (hold_token, product, hold_guild_id)).fetchone()
+                if held:
+                    break
+            else:
+                return None
+            conn.execute(
+                "INSERT INTO key_holds (key_id, hold_token, user_id, product_name, guild_id, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (held['id'], hold_token, user_id, product, held['guild_id'], expires_at)
+            )
+            return hold_token, held['guild_id'], True
+        
+        try:
+            await self.load_stock()
+            placed = await self.store.write(place_hold)
+            if placed is None:
+                # Every free key may be sitting in the reservation pool; hold one of those instead
+                placed = await self._hold_pooled_key(product, user_id, expires_at)
+        except Exception as e:
+            logger.error(f"❌ Error holding key for {product_name}: {e}")
+            return None
+        if placed is None:
+            return None
+        
+        hold_token, hold_guild_id, is_new = placed
+        if is_new:
+            self.stock.hold(product, hold_guild_id, 1)
+        return hold_token, expires_at, is_new
+
+    async def _hold_pooled_key(self, product: str, user_id: int, expires_at: float) -> Optional[tuple]:
+        reserved = self.pool.pop(product)
+        if not reserved:
+            return None
+        self._schedule_refill(product)
+        key_id, _ = reserved
+        hold_token = f"{HOLD_TOKEN_PREFIX}{uuid.uuid4().hex}"
+        
+        def convert_reservation(conn: sqlite3.Connection) -> bool:
+            cursor = conn.execute("UPDATE keys SET reserved_token = ? WHERE id = ? AND reserved_token = ?",
+                                  (hold_token, key_id, self.pool.token))
+            if not cursor.rowcount:
+                return False
+            conn.execute(
+                "INSERT INTO key_holds (key_id, hold_token, user_id, product_name, guild_id, expires_at) "
+                "VALUES (?, ?, ?, ?, NULL, ?)",
+                (key_id, hold_token, user_id, product, expires_at)
+            )
+            return True
+        
+        try:
+            converted = await self.store.write(convert_reservation)
+        finally:
+            self.pool.pending[product] -= 1
+        return (hold_token, None, True) if converted else None
+
+    async def claim_held_key(self, hold_token: str, user_tag: str, user_id: int,
+                             amount_spent: float = 0.0, guild_id: int = None) -> Optional[str]:
+        """Deliver the key behind a hold to the user it was placed for; None if the hold has already
+        expired or belongs to someone else"""
+        def claim_held(conn: sqlite3.Connection) -> Optional[tuple]:
+            result = conn.execute(SQL_CLAIM_HELD_KEY, (user_tag, user_id, guild_id, hold_token, user_id)).fetchone()
+            hold = conn.execute("SELECT guild_id FROM key_holds WHERE hold_token = ?", (hold_token,)).fetchone()
+            # Another customer's hold stays in place for them
+            conn.execute("DELETE FROM key_holds WHERE hold_token = ? AND user_id = ?", (hold_token, user_id))
+            if not result:
+                return None
+            product = result['product_name']
+            self._record_purchase(conn, product, user_tag, user_id, amount_spent,
+                                  guild_id if guild_id is not None else hold['guild_id'])
+            topped_up = 0
+            if hold['guild_id'] is not None:
+                topped_up = conn.execute(SQL_TOP_UP_GUILD_SLICE, (hold['guild_id'], product, hold['guild_id'], product,
+                                                                  product, hold['guild_id'])).rowcount
+            return result['key_value'], result['expires_at'], product, hold['guild_id'], topped_up
+        
+        try:
+            claimed = await self.store.write(claim_held)
+        except Exception as e:
+            logger.error(f"❌ Error delivering held key {hold_token}: {e}")
+            return None
+        if not claimed:
+            return None
+        
+        key_value, expires_at, product, hold_guild_id, topped_up = claimed
+        self.stock.held[product] = self.stock.held.get(product, 0) - 1
+        self.used_keys.add(key_value, product)
+        if expires_at is not None:
+            self.license_started.set()
+        if topped_up:
+            self.stock.allocate(product, hold_guild_id, topped_up)
+        return key_value
+
+    async def _release_holds(self, select_sql: str, params: tuple) -> int:
+        def release(conn: sqlite3.Connection) -> List[tuple]:
+            holds = conn.execute(select_sql, params).fetchall()
+            for hold in holds:
+                conn.execute("UPDATE keys SET reserved_token = NULL WHERE id = ? AND reserved_token = ?",
+                             (hold['key_id'], hold['hold_token']))
+                conn.execute("DELETE FROM key_holds WHERE key_id = ?", (hold['key_id'],))
+            return [(hold['product_name'], hold['guild_id']) for hold in holds]
+        
+        released = await self.store.write(release)
+        for product, hold_guild_id in released:
+            self.stock.hold(product, hold_guild_id, -1)
+        return len(released)
+
+    async def release_hold(self, hold_token: str, only_expired: bool = False) -> bool:
+        """Return a held key to stock; with only_expired, leave it if a later confirmation extended the hold"""
+        sql = "SELECT key_id, hold_token, product_name, guild_id FROM key_holds WHERE hold_token = ?"
+        params = (hold_token,)
+        if only_expired:
+            sql += " AND expires_at <= ?"
+            params += (time.time(),)
+        try:
+            return await self._release_holds(sql, params) > 0
+        except Exception as e:
+            logger.error(f"❌ Error releasing hold {hold_token}: {e}")
+            return False
+
+    async def release_expired_holds(self) -> int:
+        """Return expired holds to stock; an index range on expires_at, never a scan of the keys table"""
+        released = await self._release_holds(SQL_EXPIRED_HOLDS, (time.time(),))
+        if released:
+            logger.info(f"♻️ Released {released} expired key holds")
+        return released
+
+    async def get_held_stock(self, product_name: str = None) -> Union[int, Dict[str, int]]:
+        """Cached count of keys held for pending payments"""
+        await self.load_stock()
+        if product_name:
+            return max(self.stock.held.get(product_name.strip(), 0), 0)
+        return {name: count for name, count in sorted(self.stock.held.items()) if count > 0}
+
+    async def get_product_stock(self, product_name: str = None, guild_id: int = None) -> Union[int, Dict[str, int]]:
+        """Cached stock excluding held keys; with a guild_id, what that guild can deliver (its slice plus shared keys)"""
+        try:
+            if self.stock.loaded:
+                self.stock.hits += 1
+            else:
+                self.stock.misses += 1
+                await self.load_stock()
+            
+            if product_name:
+                return max(self.stock.available(product_name.strip(), guild_id), 0)
+            all_stock = {name: self.stock.available(name, guild_id) for name in sorted(self.stock.counts)}
+            return {name: count for name, count in all_stock.items() if count > 0}
+        except Exception as e:
+            logger.error(f"❌ Error getting stock: {e}")
+            return {} if not product_name else 0
+
+    async def next_license_event(self, notice_seconds: int) -> Optional[float]:
+        """Unix time of the next expiry notice or expiry, from two MIN() lookups on the expiry index"""
+        next_expiry = await self.store.fetchone(SQL_NEXT_LICENSE_EXPIRY)
+        next_notice = await self.store.fetchone(SQL_NEXT_LICENSE_NOTICE)
+        events = []
+        if next_expiry and next_expiry[0] is not None:
+            events.append(next_expiry[0])
+        if next_notice and next_notice[0] is not None:
+            events.append(next_notice[0] - notice_seconds)
+        return min(events) if events else None
+
+    async def get_due_license_notices(self, notice_seconds: int) -> List[Dict]:
+        """Licenses in the notice window whose customer has not been told yet; see mark_license_notified"""
+        rows = await self.store.fetchall(SQL_DUE_LICENSE_NOTICES, (time.time() + notice_seconds,))
+        return [dict(row) for row in rows]
+
+    async def mark_license_notified(self, key_id: int):
+        """Record that a license's expiry notice went out, once it has"""
+        await self.store.write(lambda conn: conn.execute("UPDATE keys SET expiry_notified = 1 WHERE id = ?", (key_id,)))
+
+    async def expire_licenses(self) -> List[Dict]:
+        """Deactivate every license past its expiry; each row says whether the user still holds another
+        one in that guild and whether they ever bought a lifetime key"""
+        def expire(conn: sqlite3.Connection) -> List[Dict]:
+            rows = [dict(row) for row in conn.execute(SQL_DUE_LICENSE_EXPIRIES, (time.time(),))]
+            conn.executemany("UPDATE keys SET license_active = 0 WHERE id = ?", [(row['id'],) for row in rows])
+            for row in rows:
+                row['still_licensed'] = conn.execute(
+                    "SELECT 1 FROM keys WHERE license_active = 1 AND user_id = ? AND license_guild_id IS ? LIMIT 1",
+                    (row['user_id'], row['license_guild_id'])
+                ).fetchone() is not None
+                row['lifetime_customer'] = conn.execute(
+                    SQL_LIFETIME_CUSTOMER, (row['user_id'], row['user_id'])
+                ).fetchone() is not None
+            return rows
+        
+        rows = await self.store.write(expire)
+        for row in rows:
+            self.used_keys.expire(row['key_value'])
+        return rows
+
+    async def load_used_key_index(self):
+        """Fill the validation index with every assigned key, archived ones included"""
+        async for row in self.store.analytics.iter_rows(
+            "SELECT key_value, product_name, license_active = 0 AND expires_at IS NOT NULL AS expired "
+            "FROM main.keys WHERE used = 1 "
+            "UNION ALL SELECT key_value, product_name, expires_at IS NOT NULL FROM archive.keys"
+        ):
+            self.used_keys.add(row['key_value'], row['product_name'], expired=bool(row['expired']))
+        self.used_keys.rebuild_bloom()
+        self.used_keys.loaded = True
+        logger.info(f"✅ Key validation index loaded ({len(self.used_keys.products)} assigned keys)")
+
+    async def get_user_totals(self, user_id: int) -> Dict[str, Union[int, float]]:
+        """Lifetime purchase count and spend for tier lookups, a single primary-key read"""
+        try:
+            totals = await self.store.fetchone(SQL_USER_TOTALS, (user_id,))
+            if not totals:
+                return {"total_purchases": 0, "lifetime_spent": 0.0}
+            return {"total_purchases": totals['total_purchases'], "lifetime_spent": totals['lifetime_spent']}
+        except Exception as e:
+            logger.error(f"❌ Error getting purchase totals for user {user_id}: {e}")
+            return {"total_purchases": 0, "lifetime_spent": 0.0}
+    
+    async def iter_lifetime_spend(self) -> AsyncIterator[tuple]:
+        """(user_id, lifetime_spent) for every customer, from the per-user purchase aggregate"""
+        async for row in self.store.analytics.iter_rows("SELECT user_id, lifetime_spent FROM user_totals"):
+            yield row['user_id'], row['lifetime_spent']
+
+    async def get_lapsed_customers(self, guild_id: int) -> set:
+        rows = await self.store.analytics.fetchall(SQL_LAPSED_LICENSE_CUSTOMERS, (guild_id,))
+        return {row['user_id'] for row in rows}
+
+    async def get_user_purchases_detailed(self, user_id: int) -> Dict:
+        try:
+            purchases = await self.store.analytics.fetchall(SQL_USER_PRODUCT_TOTALS, (user_id,))
+            totals = await self.get_user_totals(user_id)
+            
+            return {
+                "purchases": [dict(row) for row in purchases],
+                "total_purchases": totals['total_purchases'],
+                "lifetime_spent": totals['lifetime_spent']
+            }
+        except Exception as e:
+            logger.error(f"❌ Error getting purchases for user {user_id}: {e}")
+            return {"purchases": [], "total_purchases": 0, "lifetime_spent": 0.0}
+
+    async def get_user_purchase_history(self, user_id: int, limit: int = 10,
+                                        include_archive: bool = False) -> List[Dict]:
+        """Most recent purchases first; include_archive also searches the archive database"""
+        try:
+            if include_archive:
+                rows = await self.store.analytics.fetchall(SQL_USER_PURCHASE_HISTORY_WITH_ARCHIVE, (user_id, user_id, limit))
+            else:
+                rows = await self.store.analytics.fetchall(SQL_USER_PURCHASE_HISTORY, (user_id, limit))
+            return [dict(row) for row in rows]
+        except Exception as e:
+            logger.error(f"❌ Error getting purchase history for user {user_id}: {e}")
+            return []
+
+    async def iter_export_rows(self, dataset: str, since: str = None, until: str = None, product_name: str = None,
+                               include_archive: bool = False) -> AsyncIterator[sqlite3.Row]:
+        """Stream rows of an EXPORT_DATASETS table a chunk at a time (archived ones first).
+
+        since/until are 'YYYY-MM-DD HH:MM:SS' bounds from parse_export_range; until is exclusive.
+        """
+        spec = EXPORT_DATASETS[dataset]
+        conditions, params = [], []
+        if since:
+            conditions.append(f"{spec['date_column']} >= ?")
+            params.append(since)
+        if until:
+            conditions.append(f"{spec['date_column']} < ?")
+            params.append(until)
+        if product_name:
+            conditions.append("product_name = ?")
+            params.append(product_name.strip())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        sources = [('archive', spec['archive_columns'])] if include_archive else []
+        sources.append(('main', spec['columns']))
+        for schema, columns in sources:
+            sql = f"SELECT {', '.join(columns)} FROM {schema}.{spec['table']} {where} ORDER BY id"
+            async for row in self.store.analytics.iter_rows(sql, params):
+                yield row
+
+    async def rebuild_purchase_aggregates(self) -> Dict[str, int]:
+        """Recompute user_totals and user_product_totals from scratch; returns the rows written"""
+        def rebuild(conn: sqlite3.Connection) -> Dict[str, int]:
+            for statement in PURCHASE_AGGREGATE_REBUILD:
+                conn.execute(statement)
+            return {
+                "user_totals": conn.execute("SELECT COUNT(*) FROM user_totals").fetchone()[0],
+                "user_product_totals": conn.execute("SELECT COUNT(*) FROM user_product_totals").fetchone()[0]
+            }
+        
+        return await self.store.write(rebuild)
+
+    async def rebuild_sales_rollups(self) -> Dict[str, int]:
+        """Recompute every sales rollup from purchase history and the invoices table"""
+        def rebuild(conn: sqlite3.Connection) -> Dict[str, int]:
+            for table, width in SALES_ROLLUP_TABLES.values():
+                conn.execute(f"DELETE FROM {table}")
+                conn.execute(SQL_PURCHASE_ROLLUP_BACKFILL.format(table=table, width=width))
+            conn.execute("DELETE FROM leaderboards")
+            for board, (member, label) in PURCHASE_LEADERBOARD_MEMBERS.items():
+                for period in PURCHASE_LEADERBOARD_PERIODS:
+                    conn.execute(SQL_PURCHASE_LEADERBOARD_BACKFILL.format(board=board, period=period,
+                                                                          member=member, label=label))
+            invoices = 0
+            for row in conn.execute("SELECT guild_id, data FROM invoices"):
+                invoice = json.loads(row['data'])
+                record_sale(conn, 'invoice', row['guild_id'], invoice.get('product') or "Unknown",
+                            invoice.get('customer_id'), invoice.get('customer_tag'), invoice.get('amount', 0),
+                            invoice.get('timestamp', 0) or 0, processor_id=invoice.get('processor_id'),
+                            processor_tag=invoice.get('processor_tag'))
+                invoices += 1
+            counts = {
+                table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ('sales_hourly', 'sales_daily', 'leaderboards')
+            }
+            counts['invoices'] = invoices
+            return counts
+        
+        counts = await self.store.write(rebuild)
+        logger.info(f"♻️ Rebuilt sales rollups: {counts}")
+        return counts
+
+    async def has_sales_rollups(self) -> bool:
+        for table in ('sales_daily', 'leaderboards'):
+            if await self.store.analytics.fetchone(f"SELECT 1 FROM {table} LIMIT 1") is None:
+                return False
+        return True
+
+    async def get_sales_summary(self, guild_id: int, source: str, since: float, top: int = 5) -> Dict:
+        """Totals, totals since a time and top products/customers, read only from the rollups"""
+        day_start = int(since) // 86400 * 86400
+        totals = await self.store.analytics.fetchone(SQL_SALES_TOTALS, (guild_id, source, 0))
+        recent = await self.store.analytics.fetchone(SQL_SALES_TOTALS, (guild_id, source, day_start))
+        return {
+            "count": totals['count'],
+            "revenue": totals['revenue'],
+            "recent_count": recent['count'],
+            "recent_revenue": recent['revenue'],
+            "top_products": await self.get_leaderboard(guild_id, source, 'products', 'all', top),
+            "top_customers": await self.get_leaderboard(guild_id, source, 'spenders', 'all', top)
+        }
+
+    async def get_leaderboard(self, guild_id: int, source: str, board: str, window: str = 'all',
+                              top: int = 10) -> List[Dict]:
+        """Top members of a board for the current window; an index walk, independent of history size"""
+        period = leaderboard_periods(time.time())[LEADERBOARD_WINDOWS.index(window)]
+        rows = await self.store.analytics.fetchall(SQL_LEADERBOARD_TOP, (guild_id, source, board, period, top))
+        return [dict(row) for row in rows]
+
+    async def get_sales_trend(self, guild_id: int, source: str, granularity: str = 'daily',
+                              periods: int = 14) -> List[tuple]:
+        """(bucket start, count, revenue) for the last periods buckets, with empty buckets filled in"""
+        table, width = SALES_ROLLUP_TABLES[granularity]
+        first_bucket = int(time.time()) // width * width - (periods - 1) * width
+        rows = await self.store.analytics.fetchall(SQL_SALES_TREND.format(table=table), (guild_id, source, first_bucket))
+        by_bucket = {row['bucket']: (row['count'], row['revenue']) for row in rows}
+        return [
+            (bucket, *by_bucket.get(bucket, (0, 0.0)))
+            for bucket in range(first_bucket, first_bucket + periods * width, width)
+        ]
+
+    async def prune_hourly_rollups(self, days: int) -> int:
+        """Drop hourly buckets and weekly leaderboards older than days; daily and monthly ones are kept"""
+        cutoff = int(time.time()) - days * 86400
+        # 'week:YYYY-MM-DD' periods sort by date, so a string comparison finds the old ones
+        week_cutoff = leaderboard_periods(cutoff)[LEADERBOARD_WINDOWS.index('week')]
+        
+        def prune(conn: sqlite3.Connection) -> int:
+            pruned = conn.execute("DELETE FROM sales_hourly WHERE bucket < ?", (cutoff,)).rowcount
+            return pruned + conn.execute("DELETE FROM leaderboards WHERE period LIKE 'week:%' AND period < ?",
+                                         (week_cutoff,)).rowcount
+        
+        return await self.store.write(prune)
+
+    async def archive_old_records(self, days: int) -> Dict[str, int]:
+        """Move used keys and purchases older than `days` to the archive database; returns rows moved per table"""
+        age = f"-{days} days"
+        chunk_size = CONFIG['KEY_IMPORT_CHUNK_SIZE']
+        moved = {}
+        
+        for table, (select_sql, copy_sql, delete_sql) in ARCHIVE_MOVES.items():
+            moved[table] = 0
+            while True:
+                def copy_chunk(conn: sqlite3.Connection) -> List[int]:
+                    ids = [row[0] for row in conn.execute(select_sql, (age, chunk_size))]
+                    conn.executemany(copy_sql, [(row_id,) for row_id in ids])
+                    return ids
+                
+                def delete_chunk(conn: sqlite3.Connection):
+                    conn.executemany(delete_sql, [(row_id,) for row_id in ids])
+                
+                ids = await self.store.write(copy_chunk)
+                if not ids:
+                    break
+                # Delete only once the copy has committed: a commit spanning two WAL databases
+                # is atomic per file, not across both
+                await self.store.write(delete_chunk)
+                moved[table] += len(ids)
+                if len(ids) < chunk_size:
+                    break
+        
+        if any(moved.values()):
+            logger.info(f"📦 Archived {moved['keys']} used keys and {moved['purchases']} purchases older than {days} days")
+        return moved
+
+    async def close(self):
+        """Finish pending deliveries, hand reserved keys back to stock and close the store"""
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        reserved = [key_id for key_queue in self.pool.queues.values() for key_id, _ in key_queue]
+        if reserved:
+            self.pool.queues.clear()
+            await self._release_reserved(reserved)
+        await self.store.close()
+
+def parse_export_range(since: str = None, until: str = None) -> tuple:
+    """Turn inclusive YYYY-MM-DD dates into SQLite timestamp bounds (since inclusive, until exclusive)"""
+    bounds = []
+    for value, extra_days in ((since, 0), (until, 1)):
+        if not value:
+            bounds.append(None)
+            continue
+        day = datetime.strptime(value.strip(), "%Y-%m-%d") + timedelta(days=extra_days)
+        bounds.append(day.strftime("%Y-%m-%d %H:%M:%S"))
+    return tuple(bounds)
+
+EXPORT_BATCH_ROWS = 2000
+
+async def write_export(rows, columns: List[str], fmt: str, fileobj) -> int:
+    """Gzip rows as CSV or JSONL into a binary file object; returns the row count.
+
+    Rows are read on the event loop a batch at a time; encoding, compression and the writes to
+    fileobj (which may roll a spool over to disk) run in a worker thread while the next batch is read.
+    """
+    compressed = gzip.GzipFile(fileobj=fileobj, mode='wb')
+    text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+    if fmt == 'csv':
+        writer = csv.writer(text)
+        write_rows = writer.writerows
+    else:
+        def write_rows(batch: List[tuple]):
+            text.write("".join(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in batch))
+    
+    def finish():
+        text.flush()
+        # Leave fileobj open for the caller; closing compressed writes the gzip trailer
+        text.detach()
+        compressed.close()
+    
+    # At most one batch is in the worker at a time, so the gzip stream is never written concurrently
+    writing = asyncio.ensure_future(asyncio.to_thread(writer.writerow, columns)) if fmt == 'csv' else None
+    
+    async def hand_off(batch: List[tuple]):
+        nonlocal writing
+        if writing is not None:
+            await writing
+        writing = asyncio.ensure_future(asyncio.to_thread(write_rows, batch))
+    
+    count = 0
+    batch = []
+    try:
+        if hasattr(rows, '__aiter__'):
+            async for row in rows:
+                batch.append(tuple(row))
+                if len(batch) >= EXPORT_BATCH_ROWS:
+                    await hand_off(batch)
+                    count, batch = count + len(batch), []
+        else:
+            for row in rows:
+                batch.append(tuple(row))
+                if len(batch) >= EXPORT_BATCH_ROWS:
+                    await hand_off(batch)
+                    count, batch = count + len(batch), []
+        await hand_off(batch)
+        count += len(batch)
+        await writing
+    finally:
+        if writing is not None and not writing.done():
+            # Let the batch in flight finish before the stream is closed under it
+            await asyncio.wait([writing])
+        await asyncio.to_thread(finish)
+    return count
+
+class JsonCodec:
+    """Encoding for the JSON data files: orjson when installed, stdlib json otherwise. Output is
+    compact unless pretty; loads() reads both layouts"""
+
+    def __init__(self, backend: str = 'auto', pretty: bool = False):
+        if backend == 'auto':
+            backend = 'orjson' if orjson is not None else 'json'
+        if backend not in ('orjson', 'json'):
+            raise ValueError(f"unknown JSON backend {backend!r}")
+        if backend == 'orjson' and orjson is None:
+            raise ValueError("orjson is not installed")
+        self.backend = backend
+        self.pretty = pretty
+
+    def dumps(self, value, pretty: Optional[bool] = None) -> bytes:
+        """UTF-8 encoded JSON; pretty overrides the codec's layout for this call"""
+        if pretty is None:
+            pretty = self.pretty
+        if self.backend == 'orjson':
+            try:
+                # Non-str keys are converted like the stdlib encoder does (int -> "123")
+                return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0))
+            except TypeError:
+                # orjson rejects integers past 64 bits (and reads them back as floats); Discord IDs
+                # are well inside that, but an odd value should still save through the stdlib encoder
+                pass
+        if pretty:
+            return json.dumps(value, indent=2, ensure_ascii=False).encode('utf-8')
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, raw: Union[bytes, str]):
+        if self.backend == 'orjson':
+            return orjson.loads(raw)
+        return json.loads(raw)
+
+def iter_json_items(path: str, depth: int = 1, chunk_size: int = 1 << 20) -> Iterator[tuple]:
+    """Yield (key path, value) for every value `depth` objects deep in a JSON file, reading the
+    file a chunk at a time so it is never held in memory whole"""
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding='utf-8') as f:
+        buffer, pos, eof = "", 0, False
+        
+        def fill() -> bool:
+            nonlocal buffer, pos, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+                return False
+            buffer, pos = buffer[pos:] + chunk, 0
+            return True
+        
+        def next_char() -> str:
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                if not fill():
+                    raise ValueError(f"{path}: unexpected end of file")
+        
+        def expect(char: str):
+            nonlocal pos
+            if next_char() != char:
+                raise ValueError(f"{path}: expected {char!r}, found {buffer[pos]!r}")
+            pos += 1
+        
+        def read_value():
+            nonlocal pos
+            next_char()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # Most likely cut off by the chunk boundary
+                    if not fill():
+                        raise
+                    continue
+                # A number that ends the buffer may continue in the next chunk
+                if end == len(buffer) and not eof and fill():
+                    continue
+                pos = end
+                return value
+        
+        def walk(prefix: tuple, levels: int):
+            nonlocal pos
+            expect('{')
+            if next_char() == '}':
+                pos += 1
+                return
+            while True:
+                key = read_value()
+                expect(':')
+                if levels > 1:
+                    yield from walk((*prefix, key), levels - 1)
+                else:
+                    yield (*prefix, key), read_value()
+                separator = next_char()
+                pos += 1
+                if separator == '}':
+                    return
+                if separator != ',':
+                    raise ValueError(f"{path}: expected ',' or '}}', found {separator!r}")
+        
+        yield from walk((), depth)
+
+class ShardDict(dict):
+    """A guild shard read from disk; unlike a plain dict it can be weakly referenced (see GuildShards.detached)"""
+
+class ShardList(list):
+    """ShardDict for categories whose shards are lists"""
+
+class GuildShards(MutableMapping):
+    """One guild-keyed JSON category stored as a file per guild; each guild's shard is read on first access"""
+
+    def __init__(self, manager: 'DataManager', category: str, folder: str):
+        self.manager = manager
+        self.category = category
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        # Every guild that has a shard, whether or not it is in memory right now
+        self.guilds = {name[:-5] for name in os.listdir(folder) if name.endswith('.json')}
+        self.resident: Dict[str, object] = {}
+        # Evicted shards that a handler may still hold; they are put back rather than re-read, so a
+        # change made through such a reference is the one that gets saved
+        self.detached = weakref.WeakValueDictionary()
+
+    def reattach(self, guild_id: str) -> bool:
+        shard = self.detached.pop(guild_id, None)
+        if shard is None:
+            return False
+        self.resident[guild_id] = shard
+        return True
+
+    def path(self, guild_id: str) -> str:
+        return os.path.join(self.folder, f"{guild_id}.json")
+
+    def __getitem__(self, guild_id: str):
+        if guild_id not in self.resident:
+            if guild_id not in self.guilds:
+                raise KeyError(guild_id)
+            if not self.reattach(guild_id):
+                self.resident[guild_id] = self.manager._load_shard(self.category, guild_id)
+        self.manager._touch_shard(self.category, guild_id)
+        return self.resident[guild_id]
+
+    def __setitem__(self, guild_id: str, shard):
+        # The ID becomes a file name
+        if not (isinstance(guild_id, str) and guild_id.isdigit()):
+            raise KeyError(f"not a guild ID: {guild_id!r}")
+        # Stored as the weakly referenceable types, so eviction can detach it like a loaded shard;
+        # callers keep using the returned shard, not the value they assigned
+        if isinstance(shard, dict) and not isinstance(shard, ShardDict):
+            shard = ShardDict(shard)
+        elif isinstance(shard, list) and not isinstance(shard, ShardList):
+            shard = ShardList(shard)
+        self.guilds.add(guild_id)
+        self.resident[guild_id] = shard
+        self.manager._touch_shard(self.category, guild_id)
+        self.manager.save_category_data(self.category, guild_id)
+
+    def __delitem__(self, guild_id: str):
+        if guild_id not in self.guilds:
+            raise KeyError(guild_id)
+        self.guilds.discard(guild_id)
+        self.resident.pop(guild_id, None)
+        self.detached.pop(guild_id, None)
+        self.manager._forget_shard(self.category, guild_id)
+        self.manager.save_category_data(self.category, guild_id)
+
+    def setdefault(self, guild_id: str, default=None):
+        # MutableMapping's version returns default itself, which __setitem__ has copied
+        if guild_id not in self:
+            self[guild_id] = default
+        return self[guild_id]
+
+    def __contains__(self, guild_id) -> bool:
+        return guild_id in self.guilds
+
+    def __iter__(self):
+        return iter(sorted(self.guilds))
+
+    def __len__(self) -> int:
+        return len(self.guilds)
+
+class DataManager:
+    def __init__(self, store: KeyStore, default_color: int = 0x028DF3, read_only: bool = False):
+        self.default_color = default_color
+        # Another process (the running bot) owns the data files: changes stay in memory, and journals
+        # are never compacted, appended to or removed
+        self.read_only = read_only
+        # Invoices, warnings, vouches and giveaways live in the key database (see JSON_RECORD_FILES)
+        self.store = store
+        self.data_files = {
+            'auto_roles': 'auto_roles.json',
+            'afk': 'afk_status.json',
+            'templates': 'templates.json',
+            'welcome': 'welcome_config.json',
+            'verification': 'verification_config.json',
+            'stats_channels': 'stats_channels.json',
+            'dashboard': 'dashboard_config.json',
+            'user_profiles': 'user_profiles.json',
+            'ticket_config': 'ticket_config.json',
+            'dm_templates': 'dm_templates.json',
+            'invoice_templates': 'invoice_templates.json',
+            'branding': 'branding.json',
+            'log_config': 'log_config.json',
+            'vouch_config': 'vouch_config.json'
+        }
+        self.data = {}
+        self.codec = JsonCodec(CONFIG['DATA_JSON_BACKEND'], CONFIG['DATA_JSON_PRETTY'])
+        # Categories changed since their last write; the flusher coalesces them into one write each
+        self.dirty = set()
+        self.flush_delay = CONFIG['DATA_FLUSH_DELAY_MS'] / 1000
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self.mutations = 0
+        self.writes = 0
+        # Journaled categories log each change as one JSONL op; the JSON file is only rewritten on compaction
+        self.sharded = set(CONFIG['DATA_SHARDED_CATEGORIES']) & set(self.data_files)
+        self.journaled = set(CONFIG['DATA_JOURNAL_CATEGORIES']) & set(self.data_files) - self.sharded
+        self.journal_ops: Dict[str, list] = {category: [] for category in self.journaled}
+        self.journal_bytes: Dict[str, int] = {}
+        self.snapshot_bytes: Dict[str, int] = {}
+        self.snapshot_ids: Dict[str, Optional[str]] = {}
+        self.journal_appends = 0
+        self.compactions = 0
+        # Guild shards changed since their last write, and every shard in memory, least recently used first
+        self.dirty_shards = set()
+        self.shard_lru: OrderedDict = OrderedDict()
+        self.shard_bytes = 0
+        self.shard_loads = 0
+        self.shard_evictions = 0
+        self.load_all_data()
+
+        # FIX: Better branding initialization
+        self.initialize_branding()
+
+    def initialize_branding(self):
+        """Ensure branding data has all required keys"""
+        default_branding = {
+            'logo_url': "https://media.discordapp.net/attachments/1162388547211370526/1403113823837225082/Copilot_20250805_220724.png?ex=68b7fd54&is=68b6abd4&hm=697f9370d16228dce734cea688dc39c3301bdcd4435bd4e15093b573a18f84b8&=&format=webp&quality=lossless&width=525&height=350",
+            'banner_url': "https://media.discordapp.net/attachments/1162388547211370526/1403113823837225082/Copilot_20250805_220724.png?ex=68b7fd54&is=68b6abd4&hm=697f9370d16228dce734cea688dc39c3301bdcd4435bd4e15093b573a18f84b8&=&format=webp&quality=lossless&width=525&height=350",
+            'primary_color': self.default_color,
+            'company_name': "NorthernHub",
+            'footer_text': "NorthernHub • Premium Trusted Service"
+        }
+        
+        # Initialize branding if it doesn't exist or is missing keys
+        if 'branding' not in self.data or not isinstance(self.data['branding'], dict):
+            self.data['branding'] = default_branding.copy()
+            self.save_category_data('branding')
+        else:
+            # Check if all required keys exist, add missing ones
+            updated = False
+            for key, default_value in default_branding.items():
+                if key not in self.data['branding']:
+                    self.data['branding'][key] = default_value
+                    updated = True
+            
+            if updated:
+                self.save_category_data('branding')
+
+    async def add_invoice(self, invoice: dict) -> bool:
+        """Store an invoice and add it to the sales rollups in the same transaction"""
+        def add(conn: sqlite3.Connection):
+            insert_invoice(conn, invoice['guild_id'], invoice['invoice_id'], invoice)
+            record_sale(conn, 'invoice', invoice['guild_id'], invoice.get('product') or "Unknown",
+                        invoice.get('customer_id'), invoice.get('customer_tag'), invoice.get('amount', 0),
+                        invoice.get('timestamp'), processor_id=invoice.get('processor_id'),
+                        processor_tag=invoice.get('processor_tag'))
+        
+        try:
+            await self.store.write(add)
+            return True
+        except Exception as e:
+            logger.error(f"❌ Error saving invoice {invoice.get('invoice_id')}: {e}")
+            return False
+
+    async def get_customer_invoices(self, guild_id: int, customer_id: int, limit: int = 10) -> tuple:
+        """(total invoices, newest `limit` invoice dicts) for one customer in a guild"""
+        def read(conn: sqlite3.Connection) -> tuple:
+            total = conn.execute(SQL_COUNT_CUSTOMER_INVOICES, (guild_id, customer_id)).fetchone()['count']
+            rows = conn.execute(SQL_CUSTOMER_INVOICES, (guild_id, customer_id, limit)).fetchall()
+            return total, [json.loads(row['data']) for row in rows]
+        
+        return await self.store.analytics.run(read)
+
+    async def iter_invoice_rows(self, guild_id: str = None, since: str = None, until: str = None,
+                                product_name: str = None) -> AsyncIterator[list]:
+        """Invoices as INVOICE_EXPORT_COLUMNS rows, filtered like KeyManager.iter_export_rows"""
+        conditions, params = [], []
+        if guild_id:
+            conditions.append("guild_id = ?")
+            params.append(int(guild_id))
+        for bound, operator in ((since, ">="), (until, "<")):
+            if bound:
+                conditions.append(f"timestamp {operator} ?")
+                params.append(datetime.strptime(bound, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp())
+        if product_name:
+            conditions.append("product = ?")
+            params.append(product_name.strip())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        async for row in self.store.analytics.iter_rows(f"SELECT data FROM invoices {where} ORDER BY timestamp", params):
+            invoice = json.loads(row['data'])
+            timestamp = invoice.get('timestamp')
+            issued = (datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+                      if timestamp else None)
+            yield [issued if column == 'timestamp' else invoice.get(column) for column in INVOICE_EXPORT_COLUMNS]
+
+    async def add_warning(self, guild_id: int, user_id: int, warning: dict) -> int:
+        """Store a warning and return the member's warning count"""
+        def add(conn: sqlite3.Connection) -> int:
+            insert_warning(conn, guild_id, user_id, warning)
+            return conn.execute(SQL_COUNT_MEMBER_WARNINGS, (guild_id, user_id)).fetchone()['count']
+        
+        return await self.store.write(add)
+
+    async def get_warnings(self, guild_id: int, user_id: int) -> List[dict]:
+        """A member's warnings, oldest first"""
+        rows = await self.store.analytics.fetchall(SQL_MEMBER_WARNINGS, (guild_id, user_id))
+        return [dict(row) for row in rows]
+
+    async def clear_warnings(self, guild_id: int, user_id: int) -> int:
+        def clear(conn: sqlite3.Connection) -> int:
+            return conn.execute("DELETE FROM warnings WHERE guild_id = ? AND user_id = ?", (guild_id, user_id)).rowcount
+        
+        return await self.store.write(clear)
+
+    async def count_guild_warnings(self, guild_id: int) -> int:
+        row = await self.store.analytics.fetchone(SQL_COUNT_GUILD_WARNINGS, (guild_id,))
+        return row['count']
+
+    async def add_vouch(self, user_id: int, vouch: dict, guild_id: int = None) -> int:
+        """Store a vouch and return the user's vouch count"""
+        def add(conn: sqlite3.Connection) -> int:
+            insert_vouch(conn, user_id, vouch, guild_id)
+            return conn.execute(SQL_ADD_VOUCH_TOTAL, (user_id, 1)).fetchone()['count']
+        
+        return await self.store.write(add)
+
+    async def count_vouches(self) -> int:
+        row = await self.store.analytics.fetchone(SQL_TOTAL_VOUCHES)
+        return row['total']
+
+    @staticmethod
+    def _giveaway_from_row(conn: sqlite3.Connection, row: sqlite3.Row) -> dict:
+        """The giveaway dict the bot has always used, entries included"""
+        entries = [entry['user_id'] for entry in conn.execute(SQL_GIVEAWAY_ENTRIES, (row['message_id'],))]
+        return {
+            "guild_id": row['guild_id'],
+            "channel_id": row['channel_id'],
+            "message_id": row['message_id'],
+            "prize": row['prize'],
+            "winner_count": row['winner_count'],
+            "end_time": row['end_time'],
+            "entries": entries,
+            "host": row['host'],
+            "giveaway_id": row['giveaway_id']
+        }
+
+    async def add_giveaway(self, guild_id: int, giveaway: dict):
+        def add(conn: sqlite3.Connection):
+            insert_giveaway(conn, guild_id, giveaway)
+        
+        await self.store.write(add)
+
+    async def get_giveaway(self, guild_id: int, message_id: int) -> Optional[dict]:
+        def read(conn: sqlite3.Connection) -> Optional[dict]:
+            row = conn.execute(SQL_GIVEAWAY, (guild_id, message_id)).fetchone()
+            return self._giveaway_from_row(conn, row) if row else None
+        
+        return await self.store.analytics.run(read)
+
+    async def get_due_giveaways(self, now: float) -> List[dict]:
+        """Giveaways whose end time has passed, from the ends_at index"""
+        def read(conn: sqlite3.Connection) -> List[dict]:
+            return [self._giveaway_from_row(conn, row) for row in conn.execute(SQL_DUE_GIVEAWAYS, (now,)).fetchall()]
+        
+        return await self.store.analytics.run(read)
+
+    async def get_giveaway_ids(self) -> List[str]:
+        rows = await self.store.analytics.fetchall("SELECT giveaway_id FROM giveaways")
+        return [row['giveaway_id'] for row in rows]
+
+    async def count_giveaways(self, guild_id: int) -> int:
+        row = await self.store.analytics.fetchone(SQL_COUNT_GIVEAWAYS, (guild_id,))
+        return row['count']
+
+    async def enter_giveaway(self, guild_id: int, giveaway_id: str, user_id: int) -> Optional[tuple]:
+        """(whether the user was newly entered, entry count), or None if the giveaway is gone"""
+        def enter(conn: sqlite3.Connection) -> Optional[tuple]:
+            row = conn.execute(SQL_GIVEAWAY_BY_ID, (guild_id, giveaway_id)).fetchone()
+            if not row:
+                return None
+            entered = conn.execute("INSERT OR IGNORE INTO giveaway_entries (message_id, user_id) VALUES (?, ?)",
+                                   (row['message_id'], user_id)).rowcount > 0
+            entries = conn.execute("SELECT COUNT(*) FROM giveaway_entries WHERE message_id = ?",
+                                   (row['message_id'],)).fetchone()[0]
+            return entered, entries
+        
+        return await self.store.write(enter)
+
+    async def delete_giveaway(self, guild_id: int, message_id: int):
+        def delete(conn: sqlite3.Connection):
+            if conn.execute("DELETE FROM giveaways WHERE guild_id = ? AND message_id = ?",
+                            (guild_id, message_id)).rowcount:
+                conn.execute("DELETE FROM giveaway_entries WHERE message_id = ?", (message_id,))
+        
+        await self.store.write(delete)
+
+    def _fold_journal(self, filename: str):
+        """Apply a journal left by the JSON store to its file, so the import sees every change"""
+        journal = self.journal_path(filename)
+        if not os.path.exists(journal):
+            return
+        with open(filename, "rb") as f:
+            raw = f.read()
+        data = self.codec.loads(raw)
+        if self._replay_journal(journal, self._snapshot_id(raw), data) != (0, 0):
+            self._write_file(filename, self.codec.dumps(data))
+        os.remove(journal)
+
+    async def import_json_records(self) -> Dict[str, int]:
+        """Stream records left in JSON_RECORD_FILES into their tables; each file is renamed to
+        <file>.imported when done, and an interrupted import resumes where it stopped"""
+        imported = {}
+        for category, (filename, depth) in JSON_RECORD_FILES.items():
+            if not os.path.exists(filename):
+                continue
+            
+            def read_progress(conn: sqlite3.Connection) -> Optional[sqlite3.Row]:
+                return conn.execute("SELECT records, completed_at FROM json_imports WHERE category = ?",
+                                    (category,)).fetchone()
+            
+            progress = await self.store.write(read_progress)
+            done = progress['records'] if progress else 0
+            if not (progress and progress['completed_at']):
+                try:
+                    await asyncio.to_thread(self._fold_journal, filename)
+                    items = itertools.islice(iter_json_items(filename, depth), done, None)
+                    chunk_size = CONFIG['KEY_IMPORT_CHUNK_SIZE']
+                    while True:
+                        chunk = await asyncio.to_thread(lambda: list(itertools.islice(items, chunk_size)))
+                        
+                        def import_chunk(conn: sqlite3.Connection, chunk=chunk, records=done + len(chunk)):
+                            for path, value in chunk:
+                                import_json_record(conn, category, path, value)
+                            conn.execute(
+                                "INSERT OR REPLACE INTO json_imports (category, records, completed_at) VALUES (?, ?, ?)",
+                                (category, records, None if len(chunk) == chunk_size else datetime.now(timezone.utc).isoformat())
+                            )
+                        
+                        await self.store.write(import_chunk)
+                        done += len(chunk)
+                        if len(chunk) < chunk_size:
+                            break
+                except Exception as e:
+                    # Left in place: the import picks up from the last committed chunk next time
+                    logger.error(f"❌ Error importing {filename} after {done:,} records: {e}")
+                    continue
+                imported[category] = done
+                logger.info(f"✅ Imported {done:,} {category} records from {filename} into SQLite")
+            os.replace(filename, f"{filename}.imported")
+        return imported
+
+    def load_all_data(self):
+        for key, filename in self.data_files.items():
+            if key in self.sharded:
+                self.data[key] = self._load_sharded(key)
+            elif key in self.journaled:
+                self.data[key] = self._load_journaled(key)
+            else:
+                self.data[key] = self.load_data(filename, {})
+
+    def load_data(self, filename: str, default_value=None) -> dict:
+        if default_value is None:
+            default_value = {}
+            
+        if not os.path.exists(filename):
+            if self.read_only:
+                return default_value
+            logger.info(f"Creating new data file: {filename}")
+            self.save_data(filename, default_value)
+            return default_value
+            
+        try:
+            # Either layout: compact, or indented by older versions and DATA_JSON_PRETTY
+            with open(filename, "rb") as f:
+                data = self.codec.loads(f.read())
+                logger.info(f"Successfully loaded {filename}")
+                return data
+        except (ValueError, FileNotFoundError) as e:
+            logger.error(f"Error loading {filename}: {e}. Using default value.")
+            if os.path.exists(filename) and not self.read_only:
+                backup_name = f"{filename}.corrupted.{int(datetime.now().timestamp())}"
+                os.rename(filename, backup_name)
+                logger.info(f"Backed up corrupted file to {backup_name}")
+            return default_value
+
+    def _load_sharded(self, category: str) -> GuildShards:
+        folder = os.path.join(CONFIG['DATA_SHARD_FOLDER'], category)
+        filename = self.data_files[category]
+        if os.path.exists(filename):
+            self._split_into_shards(filename, folder)
+        return GuildShards(self, category, folder)
+
+    def _split_into_shards(self, filename: str, folder: str):
+        """Write each guild of a whole-category file to its own shard, then retire the file"""
+        os.makedirs(folder, exist_ok=True)
+        written = 0
+        try:
+            for (guild_id,), shard in iter_json_items(filename, 1):
+                if not guild_id.isdigit():
+                    logger.warning(f"⚠️ Dropping non-guild key {guild_id!r} from {filename}")
+                    continue
+                path = os.path.join(folder, f"{guild_id}.json")
+                # A shard that already exists came from an interrupted split and may have changed since
+                if os.path.exists(path):
+                    continue
+                if not self._write_file(path, self.codec.dumps(shard)):
+                    return
+                written += 1
+        except (OSError, ValueError) as e:
+            # Left in place: the split resumes at the next start
+            logger.error(f"❌ Error splitting {filename} into guild shards: {e}")
+            return
+        os.replace(filename, f"{filename}.sharded")
+        logger.info(f"✅ Split {filename} into {written} guild shards under {folder}")
+
+    def _shard_file_size(self, category: str, guild_id: str) -> int:
+        try:
+            return os.path.getsize(self.data[category].path(guild_id))
+        except OSError:
+            return 0
+
+    def _load_shard(self, category: str, guild_id: str):
+        path = self.data[category].path(guild_id)
+        size = self._shard_file_size(category, guild_id)
+        shard = self.load_data(path, {})
+        if isinstance(shard, dict):
+            shard = ShardDict(shard)
+        elif isinstance(shard, list):
+            shard = ShardList(shard)
+        self.shard_loads += 1
+        self.shard_lru[(category, guild_id)] = [size, time.monotonic()]
+        self.shard_bytes += size
+        return shard
+
+    def _touch_shard(self, category: str, guild_id: str):
+        key = (category, guild_id)
+        entry = self.shard_lru.get(key)
+        if entry is None:
+            # New, or put back from GuildShards.detached: counted at its size on disk until written
+            entry = self.shard_lru[key] = [self._shard_file_size(category, guild_id), 0.0]
+            self.shard_bytes += entry[0]
+        else:
+            self.shard_lru.move_to_end(key)
+        entry[1] = time.monotonic()
+        self._evict_shards(keep=key)
+
+    def _forget_shard(self, category: str, guild_id: str):
+        entry = self.shard_lru.pop((category, guild_id), None)
+        if entry:
+            self.shard_bytes -= entry[0]
+
+    def _evict_shards(self, keep: tuple = None):
+        """Drop idle shards, and least recently used ones while over DATA_SHARD_MEMORY_BUDGET.
+        Shards touched in the last DATA_SHARD_PIN_SECONDS are kept even over the budget, since a
+        handler may be part-way through changing them"""
+        over = self.shard_bytes - CONFIG['DATA_SHARD_MEMORY_BUDGET']
+        now = time.monotonic()
+        idle_before = now - CONFIG['DATA_SHARD_IDLE_SECONDS']
+        pinned_after = now - CONFIG['DATA_SHARD_PIN_SECONDS']
+        evicted = []
+        for key, (size, last_used) in self.shard_lru.items():
+            # Oldest first, so everything from here on was used at least as recently
+            if last_used > idle_before and (over <= 0 or last_used > pinned_after):
+                break
+            # Unwritten changes only exist in memory; those shards go once the flusher has written them
+            if key == keep or key in self.dirty_shards:
+                continue
+            evicted.append(key)
+            over -= size
+        for category, guild_id in evicted:
+            self._forget_shard(category, guild_id)
+            shards = self.data[category]
+            shard = shards.resident.pop(guild_id, None)
+            if isinstance(shard, (ShardDict, ShardList)):
+                shards.detached[guild_id] = shard
+        self.shard_evictions += len(evicted)
+
+    def _write_shard(self, category: str, guild_id: str, raw: Optional[bytes]) -> bool:
+        """Write one guild's shard, or remove its file when raw is None"""
+        path = self.data[category].path(guild_id)
+        if raw is not None:
+            return self._write_file(path, raw)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error removing {path}: {e}")
+            return False
+        return True
+
+    async def snapshot_data(self) -> dict:
+        """Every category as plain dicts, reading guild shards that are not in memory from disk"""
+        data = {}
+        for category, value in self.data.items():
+            if not isinstance(value, GuildShards):
+                data[category] = value
+                continue
+            resident = dict(value.resident)
+            missing = [guild_id for guild_id in value if guild_id not in resident]
+            
+            def read_shards(missing=missing, value=value) -> dict:
+                shards = {}
+                for guild_id in missing:
+                    try:
+                        with open(value.path(guild_id), "rb") as f:
+                            shards[guild_id] = self.codec.loads(f.read())
+                    except (OSError, ValueError) as e:
+                        logger.error(f"Error reading {value.path(guild_id)}: {e}")
+                return shards
+            
+            shards = await asyncio.to_thread(read_shards)
+            shards.update(resident)
+            data[category] = dict(sorted(shards.items()))
+        return data
+
+    @staticmethod
+    def journal_path(filename: str) -> str:
+        return f"{filename}.journal"
+
+    @staticmethod
+    def _snapshot_id(raw: bytes) -> str:
+        return f"{zlib.crc32(raw):08x}:{len(raw)}"
+
+    def _load_journaled(self, category: str) -> dict:
+        filename = self.data_files[category]
+        data = self.load_data(filename, {})
+        try:
+            with open(filename, "rb") as f:
+                raw = f.read()
+            self.snapshot_ids[category] = self._snapshot_id(raw)
+            self.snapshot_bytes[category] = len(raw)
+        except OSError:
+            self.snapshot_ids[category] = None
+        
+        replayed, skipped = self._replay_journal(self.journal_path(filename), self.snapshot_ids[category], data)
+        self.journal_bytes[category] = 0
+        if (replayed or skipped) and not self.read_only:
+            # Fold the journal into the file now, so new appends never follow a torn last line
+            self._write_snapshot(category, self.codec.dumps(data))
+        return data
+
+    def _replay_journal(self, path: str, snapshot_id: Optional[str], data: dict) -> tuple:
+        """Apply the ops logged against snapshot_id to data; returns (replayed, skipped)"""
+        if snapshot_id is None or not os.path.exists(path):
+            return 0, 0
+        replayed = skipped = 0
+        with open(path, "r", encoding='utf-8', errors='replace', newline='') as f:
+            try:
+                current = self.codec.loads(f.readline()).get('snapshot') == snapshot_id
+            except (ValueError, AttributeError):
+                current = False
+            if not current:
+                # Logged against an older file, which was rewritten with these changes included
+                logger.info(f"♻️ Ignoring stale journal {path}")
+                return 0, 0
+            for line_number, line in enumerate(f, 2):
+                if not line.strip():
+                    continue
+                try:
+                    self._apply_op(data, self.codec.loads(line))
+                    replayed += 1
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    # Usually the last line, torn by a crash mid-append: skip it and keep everything else
+                    skipped += 1
+                    logger.warning(f"⚠️ Skipped unreadable record on line {line_number} of {path}: {e}")
+        logger.info(f"✅ Replayed {replayed} changes from {path}" + (f" ({skipped} skipped)" if skipped else ""))
+        return replayed, skipped
+
+    @staticmethod
+    def _apply_op(root: dict, op: dict):
+        """Apply one journal op; replaying an op the file already includes changes nothing. Raises
+        ValueError for an op that cannot apply, which a live change must not log and a replay skips"""
+        *parents, last = op['path']
+        node = root
+        for key in parents:
+            if isinstance(node, list):
+                if key >= len(node):
+                    if op['op'] == 'del':
+                        return
+                    raise ValueError(f"list index {key} in {op['path']} is past the end")
+                node = node[key]
+            elif op['op'] == 'del' and key not in node:
+                return
+            else:
+                node = node.setdefault(key, {})
+        
+        if op['op'] == 'set':
+            if not isinstance(node, list):
+                node[last] = op['value']
+            elif last < len(node):
+                node[last] = op['value']
+            elif last == len(node):
+                node.append(op['value'])
+            else:
+                raise ValueError(f"list index {last} in {op['path']} is past the end")
+        elif op['op'] == 'del':
+            if isinstance(node, list):
+                # Removing by index shifts the items after it, so a replayed del would remove a second item
+                raise ValueError(f"cannot del list item {op['path']}; set the whole list instead")
+            node.pop(last, None)
+        else:
+            raise ValueError(f"unknown op {op['op']!r}")
+
+    def set_record(self, category: str, path: list, value):
+        """data[category][path[0]][path[1]]... = value, creating missing dicts on the way"""
+        self._record_change(category, {"op": "set", "path": list(path), "value": value})
+
+    def append_record(self, category: str, path: list, value):
+        """Append value to the list at path, creating the list if it is missing"""
+        node = self.data[category]
+        for key in path:
+            node = node.get(key) if isinstance(node, MutableMapping) else None
+        if isinstance(node, list):
+            # Logged as a set at the new index, so replaying it twice cannot duplicate the item
+            self.set_record(category, [*path, len(node)], value)
+        else:
+            self.set_record(category, path, [value])
+
+    def delete_record(self, category: str, path: list):
+        """Remove the dict key at path if present; raises ValueError, before logging anything, when
+        path ends inside a list"""
+        self._record_change(category, {"op": "del", "path": list(path)})
+
+    def _record_change(self, category: str, op: dict):
+        self._apply_op(self.data[category], op)
+        if self.read_only:
+            return
+        if category in self.sharded:
+            self.save_category_data(category, op['path'][0])
+            return
+        if category not in self.journaled:
+            self.save_category_data(category)
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save_category_data(category)
+            return
+        
+        self.mutations += 1
+        self.journal_ops[category].append(op)
+        self._schedule_flush(loop)
+
+    @staticmethod
+    def _write_file(filename: str, raw: bytes) -> bool:
+        temp_filename = f"{filename}.temp"
+        try:
+            with open(temp_filename, "wb") as f:
+                f.write(raw)
+            os.replace(temp_filename, filename)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving {filename}: {e}")
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            return False
+
+    def save_data(self, filename: str, data: dict) -> bool:
+        try:
+            raw = self.codec.dumps(data)
+        except Exception as e:
+            logger.error(f"Error saving {filename}: {e}")
+            return False
+        return self._write_file(filename, raw)
+
+    def _write_snapshot(self, category: str, raw: bytes) -> bool:
+        """Rewrite a category's file; for journaled categories this is also the compaction"""
+        filename = self.data_files[category]
+        if category not in self.journaled:
+            return self._write_file(filename, raw)
+        
+        snapshot_id = self._snapshot_id(raw)
+        journal = self.journal_path(filename)
+        if snapshot_id == self.snapshot_ids.get(category):
+            # The file on disk already has these exact bytes, so only the journal has to go; it must go
+            # first, since a journal left next to an identical file would still match and replay
+            try:
+                os.remove(journal)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error removing {journal}: {e}")
+                return False
+        elif not self._write_file(filename, raw):
+            return False
+        else:
+            # If this fails, the journal no longer matches the new file and is ignored at load
+            with contextlib.suppress(OSError):
+                os.remove(journal)
+        
+        self.snapshot_ids[category] = snapshot_id
+        self.snapshot_bytes[category] = len(raw)
+        # The next append starts a fresh journal
+        self.journal_bytes[category] = 0
+        return True
+
+    def _append_journal(self, category: str, lines: bytes) -> bool:
+        path = self.journal_path(self.data_files[category])
+        if not self.journal_bytes.get(category):
+            lines = self.codec.dumps({"snapshot": self.snapshot_ids[category]}, pretty=False) + b"\n" + lines
+        try:
+            with open(path, "ab" if self.journal_bytes.get(category) else "wb") as f:
+                f.write(lines)
+        except Exception as e:
+            logger.error(f"Error appending to {path}: {e}")
+            return False
+        self.journal_bytes[category] = self.journal_bytes.get(category, 0) + len(lines)
+        return True
+
+    def _needs_compaction(self, category: str) -> bool:
+        limit = max(CONFIG['DATA_JOURNAL_MIN_BYTES'],
+                    CONFIG['DATA_JOURNAL_COMPACT_RATIO'] * self.snapshot_bytes.get(category, 0))
+        return self.journal_bytes.get(category, 0) > limit
+
+    def save_category_data(self, category: str, guild_id: Union[int, str] = None) -> bool:
+        """Mark a category changed; it is written by the flusher within DATA_FLUSH_DELAY_MS.
+        For guild-sharded categories only guild_id's shard is written (every shard in memory without it).
+        Returns False, writing nothing, for a read-only manager"""
+        if category not in self.data_files or self.read_only:
+            return False
+        if category in self.sharded:
+            return self._save_shards(category, guild_id)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop yet (start-up): write straight away
+            try:
+                raw = self.codec.dumps(self.data[category])
+            except Exception as e:
+                logger.error(f"Error saving {self.data_files[category]}: {e}")
+                return False
+            return self._write_snapshot(category, raw)
+        
+        self.mutations += 1
+        self.dirty.add(category)
+        self._schedule_flush(loop)
+        return True
+
+    def _save_shards(self, category: str, guild_id: Union[int, str, None]) -> bool:
+        shards = self.data[category]
+        guild_ids = [str(guild_id)] if guild_id is not None else list(shards.resident)
+        for guild_id in guild_ids:
+            # Evicted while the caller still held it: that copy has the change, so it goes back in memory
+            if guild_id not in shards.resident and shards.reattach(guild_id):
+                self._touch_shard(category, guild_id)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            written = True
+            for guild_id in guild_ids:
+                if guild_id in shards.resident:
+                    try:
+                        raw = self.codec.dumps(shards.resident[guild_id])
+                    except Exception as e:
+                        logger.error(f"Error saving {shards.path(guild_id)}: {e}")
+                        written = False
+                        continue
+                elif guild_id in shards:
+                    # Not in memory, so its file is already current
+                    continue
+                else:
+                    raw = None
+                written = self._write_shard(category, guild_id, raw) and written
+            return written
+        
+        self.mutations += 1
+        self.dirty_shards.update((category, guild_id) for guild_id in guild_ids)
+        self._schedule_flush(loop)
+        return True
+
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_after_delay())
+
+    def has_pending_changes(self) -> bool:
+        return bool(self.dirty) or bool(self.dirty_shards) or any(self.journal_ops.values())
+
+    async def _flush_after_delay(self):
+        # Changes made while a write is in progress wait for the next window, not an immediate rewrite
+        while True:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+            if not self.has_pending_changes():
+                break
+
+    async def _serialize(self, category: str, guild_id: str = None) -> bytes:
+        value = self.data[category] if guild_id is None else self.data[category].resident[guild_id]
+        for attempt in range(2):
+            try:
+                return await asyncio.to_thread(self.codec.dumps, value)
+            except RuntimeError:
+                # A handler changed the category mid-dump (only the stdlib's indented encoder runs
+                # Python code part-way through); it is marked dirty again, so just retry
+                await asyncio.sleep(0)
+        # Still racing with mutations: take a compact snapshot, which never yields to the loop
+        # mid-dump, and do the slower indented encoding in the thread
+        snapshot = self.codec.dumps(value, pretty=False)
+        return await asyncio.to_thread(lambda: self.codec.dumps(self.codec.loads(snapshot)))
+
+    async def flush(self) -> bool:
+        """Write every category that is dirty now, off the event loop"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            categories, self.dirty = self.dirty, set()
+            for category, ops in self.journal_ops.items():
+                if not ops:
+                    continue
+                self.journal_ops[category] = []
+                if category in categories:
+                    # The full rewrite below already includes these changes
+                    continue
+                lines = b"".join(self.codec.dumps(op, pretty=False) + b"\n" for op in ops)
+                if not await asyncio.to_thread(self._append_journal, category, lines):
+                    # The failed append may have left a torn line behind; rewriting the file drops the journal
+                    categories.add(category)
+                    continue
+                self.journal_appends += 1
+                if self._needs_compaction(category):
+                    categories.add(category)
+            
+            failed = set()
+            for category in categories:
+                try:
+                    raw = await self._serialize(category)
+                    written = await asyncio.to_thread(self._write_snapshot, category, raw)
+                except Exception as e:
+                    logger.error(f"Error saving {self.data_files[category]}: {e}")
+                    written = False
+                if written:
+                    self.writes += 1
+                    if category in self.journaled:
+                        self.compactions += 1
+                else:
+                    failed.add(category)
+            
+            shards, self.dirty_shards = self.dirty_shards, set()
+            failed_shards = set()
+            for category, guild_id in shards:
+                guild_shards = self.data[category]
+                try:
+                    if guild_id in guild_shards.resident:
+                        raw = await self._serialize(category, guild_id)
+                    elif guild_id in guild_shards:
+                        # Not in memory, so its file is already current
+                        continue
+                    else:
+                        raw = None
+                    written = await asyncio.to_thread(self._write_shard, category, guild_id, raw)
+                except Exception as e:
+                    logger.error(f"Error saving {guild_shards.path(guild_id)}: {e}")
+                    written = False
+                if not written:
+                    failed_shards.add((category, guild_id))
+                    continue
+                self.writes += 1
+                entry = self.shard_lru.get((category, guild_id))
+                if entry and raw is not None:
+                    self.shard_bytes += len(raw) - entry[0]
+                    entry[0] = len(raw)
+            
+            # Retried on the next window
+            self.dirty |= failed
+            self.dirty_shards |= failed_shards
+            # Shards that were dirty, or went idle since the last access, can be dropped now
+            self._evict_shards()
+            return not failed and not failed_shards
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import CONFIG, init_key_database  # noqa: E402
+
+
+@pytest.fixture
+def key_database(tmp_path, monkeypatch):
+    """A freshly migrated key database (and archive) in tmp_path, with CONFIG pointed at it"""
+    monkeypatch.setitem(CONFIG, 'DATABASE_PATH', str(tmp_path / "product_keys.db"))
+    monkeypatch.setitem(CONFIG, 'ARCHIVE_DATABASE_PATH', str(tmp_path / "product_keys_archive.db"))
+    init_key_database()
+    return CONFIG['DATABASE_PATH']
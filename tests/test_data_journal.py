@@ -0,0 +1,70 @@
+"""Replaying the JSON data journal"""
+import asyncio
+import types
+
+import pytest
+
+from storage import CONFIG, DataManager, JsonCodec, KeyStore
+
+
+def test_del_under_a_list_is_rejected_before_anything_changes():
+    data = {"123": {"items": ["a", "b", "c"]}}
+    with pytest.raises(ValueError):
+        DataManager._apply_op(data, {"op": "del", "path": ["123", "items", 1]})
+    assert data == {"123": {"items": ["a", "b", "c"]}}
+
+
+def test_replay_skips_a_bad_op_and_applies_the_rest(tmp_path):
+    codec = JsonCodec('json')
+    journal = tmp_path / "data.json.journal"
+    ops = [
+        {"snapshot": "abc"},
+        {"op": "set", "path": ["1", "items", 0], "value": "x"},
+        {"op": "del", "path": ["1", "items", 0]},
+        {"op": "del", "path": ["2"]},
+        {"op": "set", "path": ["1", "items", 4], "value": "y"},
+        {"op": "set", "path": ["3"], "value": {"ok": True}},
+    ]
+    journal.write_bytes(b"\n".join(codec.dumps(op) for op in ops) + b"\n")
+    manager = types.SimpleNamespace(codec=codec, _apply_op=DataManager._apply_op)
+    data = {"1": {"items": []}, "2": {}}
+
+    assert DataManager._replay_journal(manager, str(journal), "abc", data) == (3, 2)
+    assert data == {"1": {"items": ["x"]}, "3": {"ok": True}}
+
+
+def test_set_past_the_end_of_a_list_is_rejected():
+    data = {"123": {"items": ["a"]}}
+    with pytest.raises(ValueError):
+        DataManager._apply_op(data, {"op": "set", "path": ["123", "items", 5], "value": "z"})
+    with pytest.raises(ValueError):
+        DataManager._apply_op(data, {"op": "set", "path": ["123", "items", 3, "name"], "value": "z"})
+    assert data == {"123": {"items": ["a"]}}
+
+
+def test_read_only_manager_leaves_the_running_journal_alone(key_database, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def main():
+        store = KeyStore(CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH'])
+        try:
+            bot = DataManager(store)
+            bot.set_record('afk', ["1"], {"reason": "lunch"})
+            await bot.flush()
+            journal = tmp_path / DataManager.journal_path(bot.data_files['afk'])
+            before = journal.read_bytes()
+
+            cli = DataManager(store, read_only=True)
+            assert cli.data['afk'] == {"1": {"reason": "lunch"}}
+            cli.set_record('afk', ["9"], {"reason": "cli"})
+            await cli.flush()
+            assert journal.read_bytes() == before
+
+            # The bot keeps appending to the same journal, and a restart still replays all of it
+            bot.set_record('afk', ["2"], {"reason": "away"})
+            await bot.flush()
+            return DataManager(store).data['afk']
+        finally:
+            await store.close()
+
+    assert asyncio.run(main()) == {"1": {"reason": "lunch"}, "2": {"reason": "away"}}
@@ -0,0 +1,45 @@
+"""Gzipped CSV/JSONL exports"""
+import asyncio
+import csv
+import gzip
+import io
+import json
+import tempfile
+
+import pytest
+
+from storage import EXPORT_BATCH_ROWS, write_export
+
+COLUMNS = ["id", "product_name", "amount_spent"]
+ROWS = [(number, f"Product {number % 7}", number * 1.5) for number in range(EXPORT_BATCH_ROWS * 3 + 17)]
+
+
+async def iter_rows():
+    for row in ROWS:
+        yield row
+
+
+@pytest.mark.parametrize("source", [iter_rows, lambda: iter(ROWS)], ids=["async", "sync"])
+def test_csv_export_round_trips_through_a_spool_that_rolls_to_disk(source):
+    with tempfile.SpooledTemporaryFile(max_size=4096) as spool:
+        count = asyncio.run(write_export(source(), COLUMNS, 'csv', spool))
+        assert spool._rolled
+        spool.seek(0)
+        lines = list(csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=spool), encoding='utf-8', newline='')))
+    assert count == len(ROWS)
+    assert lines[0] == COLUMNS
+    assert lines[1:] == [[str(value) for value in row] for row in ROWS]
+
+
+def test_jsonl_export_writes_one_object_per_row():
+    spool = io.BytesIO()
+    count = asyncio.run(write_export(iter_rows(), COLUMNS, 'jsonl', spool))
+    records = [json.loads(line) for line in gzip.decompress(spool.getvalue()).splitlines()]
+    assert count == len(records) == len(ROWS)
+    assert records[-1] == dict(zip(COLUMNS, ROWS[-1]))
+
+
+def test_empty_export_is_a_valid_gzip_file():
+    spool = io.BytesIO()
+    assert asyncio.run(write_export(iter([]), COLUMNS, 'jsonl', spool)) == 0
+    assert gzip.decompress(spool.getvalue()) == b""
@@ -0,0 +1,101 @@
+"""Guild-sharded data categories under memory pressure"""
+import asyncio
+import gc
+import json
+
+import pytest
+
+from storage import CONFIG, DataManager, KeyStore
+
+
+@pytest.fixture
+def shard_config(key_database, tmp_path, monkeypatch):
+    """Data files under tmp_path, with a shard budget so small that every shard is over it"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(CONFIG, 'DATA_SHARD_MEMORY_BUDGET', 0)
+    monkeypatch.setitem(CONFIG, 'DATA_SHARD_PIN_SECONDS', 0)
+    return tmp_path
+
+
+def run_with_data_manager(scenario):
+    async def main():
+        store = KeyStore(CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH'])
+        try:
+            writer = DataManager(store)
+            writer.data['welcome']['1'] = {"enabled": False}
+            writer.data['welcome']['2'] = {"enabled": False}
+            await writer.flush()
+            # A fresh manager reads the shards back from disk, as after a restart
+            return await scenario(DataManager(store))
+        finally:
+            await store.close()
+    return asyncio.run(main())
+
+
+def read_shard(folder, guild_id: str) -> dict:
+    return json.loads((folder / CONFIG['DATA_SHARD_FOLDER'] / 'welcome' / f"{guild_id}.json").read_bytes())
+
+
+def test_change_through_an_evicted_shard_is_saved(shard_config):
+    async def scenario(manager: DataManager):
+        held = manager.data['welcome']['1']
+        manager.data['welcome']['2']  # Over budget: guild 1 is evicted while the handler holds it
+        assert '1' not in manager.data['welcome'].resident
+        
+        held["enabled"] = True
+        manager.save_category_data('welcome', '1')
+        await manager.flush()
+        assert manager.data['welcome']['1'] is held
+    
+    run_with_data_manager(scenario)
+    assert read_shard(shard_config, '1') == {"enabled": True}
+
+
+def test_evicted_shard_nobody_holds_is_freed(shard_config):
+    async def scenario(manager: DataManager):
+        manager.data['welcome']['1']
+        manager.data['welcome']['2']
+        gc.collect()
+        assert '1' not in manager.data['welcome'].detached
+        assert manager.data['welcome']['1'] == {"enabled": False}
+    
+    run_with_data_manager(scenario)
+
+
+def test_recently_used_shards_are_pinned_over_budget(shard_config, monkeypatch):
+    monkeypatch.setitem(CONFIG, 'DATA_SHARD_PIN_SECONDS', 60)
+    
+    async def scenario(manager: DataManager):
+        manager.data['welcome']['1']
+        manager.data['welcome']['2']
+        assert set(manager.data['welcome'].resident) == {'1', '2'}
+    
+    run_with_data_manager(scenario)
+
+
+def test_change_through_an_assigned_and_evicted_shard_is_saved(shard_config):
+    async def scenario(manager: DataManager):
+        shards = manager.data['welcome']
+        shards['3'] = {"enabled": False}
+        held = shards['3']  # Handlers keep the stored shard, as `data[category][guild_id]` returns it
+        await manager.flush()  # Written, so no longer dirty: evictable by the next touch
+        shards['1']
+        assert '3' not in shards.resident
+        
+        held["enabled"] = True
+        manager.save_category_data('welcome', '3')
+        await manager.flush()
+        assert shards['3'] is held
+    
+    run_with_data_manager(scenario)
+    assert read_shard(shard_config, '3') == {"enabled": True}
+
+
+def test_record_ops_on_a_new_guild_land_in_the_stored_shard(shard_config):
+    async def scenario(manager: DataManager):
+        manager.set_record('welcome', ['4', 'enabled'], True)
+        await manager.flush()
+        assert manager.data['welcome']['4'] == {"enabled": True}
+    
+    run_with_data_manager(scenario)
+    assert read_shard(shard_config, '4') == {"enabled": True}
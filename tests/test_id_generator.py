@@ -0,0 +1,53 @@
+"""Snowflake IDs must stay unique and ordered under concurrency and clock trouble"""
+import threading
+
+import pytest
+
+import storage
+from storage import IdGenerator
+
+THREADS = 8
+IDS_PER_THREAD = 125_000  # One million IDs in total
+
+
+def test_million_concurrent_ids_are_unique_and_ordered():
+    generator = IdGenerator(worker_id=7)
+    issued = [None] * THREADS
+    start = threading.Barrier(THREADS)
+
+    def allocate(slot: int):
+        start.wait()
+        issued[slot] = [generator.next_id() for _ in range(IDS_PER_THREAD)]
+
+    threads = [threading.Thread(target=allocate, args=(slot,)) for slot in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    every_id = [value for ids in issued for value in ids]
+    assert len(every_id) == THREADS * IDS_PER_THREAD
+    assert len(set(every_id)) == len(every_id)
+    for ids in issued:
+        # Each caller sees strictly increasing IDs, so later records always sort after earlier ones
+        assert all(earlier < later for earlier, later in zip(ids, ids[1:]))
+    worker_mask = ((1 << IdGenerator.WORKER_BITS) - 1) << IdGenerator.SEQUENCE_BITS
+    assert {value & worker_mask for value in every_id} == {7 << IdGenerator.SEQUENCE_BITS}
+
+
+def test_ids_keep_increasing_when_the_clock_stalls_or_steps_back(monkeypatch):
+    generator = IdGenerator(worker_id=0)
+    clock = [1_800_000_000.0]
+    monkeypatch.setattr(storage.time, 'time', lambda: clock[0])
+
+    ids = [generator.next_id() for _ in range(3 * (1 << IdGenerator.SEQUENCE_BITS))]  # Overflows the sequence
+    clock[0] -= 5  # NTP steps the wall clock back
+    ids += [generator.next_id() for _ in range(1000)]
+
+    assert all(earlier < later for earlier, later in zip(ids, ids[1:]))
+
+
+@pytest.mark.parametrize("worker_id", [-1, 1 << IdGenerator.WORKER_BITS])
+def test_worker_id_out_of_range_is_rejected(worker_id):
+    with pytest.raises(ValueError):
+        IdGenerator(worker_id)
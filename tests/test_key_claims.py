@@ -0,0 +1,71 @@
+"""Concurrent key claims must never hand the same key to two customers"""
+import asyncio
+import sqlite3
+
+from storage import CONFIG, KeyManager, KeyStore
+
+PRODUCT = "Stress Product"
+CLAIMS = 10_000
+
+
+def open_key_manager() -> KeyManager:
+    return KeyManager(KeyStore(CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH']))
+
+
+def stock_keys(count: int):
+    conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
+    with conn:
+        conn.execute("INSERT INTO products (name, description) VALUES (?, '')", (PRODUCT,))
+        conn.executemany("INSERT INTO keys (product_name, key_value) VALUES (?, ?)",
+                         ((PRODUCT, f"KEY-{number:06d}") for number in range(count)))
+    conn.close()
+
+
+def assigned_keys() -> dict:
+    """key_value -> user_id for every used key, plus the number of purchase rows"""
+    conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
+    try:
+        keys = dict(conn.execute("SELECT key_value, user_id FROM keys WHERE used = 1"))
+        purchases = conn.execute("SELECT COUNT(*) FROM user_purchases").fetchone()[0]
+        reserved = conn.execute("SELECT COUNT(*) FROM keys WHERE reserved_token IS NOT NULL").fetchone()[0]
+    finally:
+        conn.close()
+    return keys, purchases, reserved
+
+
+async def claim_all(managers: list, count: int) -> dict:
+    """Start every claim at once, spread over the managers; returns user_id -> delivered key"""
+    results = await asyncio.gather(*(
+        managers[user_id % len(managers)].use_product_key(PRODUCT, f"user{user_id}#0", user_id)
+        for user_id in range(count)
+    ))
+    for manager in managers:
+        await manager.close()
+    return {user_id: key_value for user_id, key_value in enumerate(results) if key_value is not None}
+
+
+def test_parallel_claims_never_deliver_a_key_twice(key_database):
+    stock_keys(CLAIMS)
+    delivered = asyncio.run(claim_all([open_key_manager()], CLAIMS))
+    
+    assert len(delivered) == CLAIMS
+    assert len(set(delivered.values())) == CLAIMS
+    keys, purchases, reserved = assigned_keys()
+    # Every delivered key is recorded against the customer it was handed to, once
+    assert keys == {key_value: user_id for user_id, key_value in delivered.items()}
+    assert purchases == CLAIMS
+    assert reserved == 0
+
+
+def test_two_processes_claiming_never_share_a_key(key_database):
+    # Two KeyStores are two writer connections, like the bot and the admin CLI on the same file
+    stock_keys(CLAIMS)
+    delivered = asyncio.run(claim_all([open_key_manager(), open_key_manager()], CLAIMS + 100))
+    
+    assert len(set(delivered.values())) == len(delivered)
+    keys, purchases, reserved = assigned_keys()
+    assert keys == {key_value: user_id for user_id, key_value in delivered.items()}
+    assert purchases == len(delivered)
+    # Closing both managers hands their pools back, so nothing is lost: delivered or still in stock
+    assert reserved == 0
+    assert len(delivered) >= CLAIMS - 2 * CONFIG['KEY_POOL_SIZE']
@@ -0,0 +1,42 @@
+"""Parsing of uploaded .txt/.csv key files"""
+import asyncio
+
+from storage import KEY_FILE_MAX_KEY_BYTES, iter_key_file
+
+
+def parse(raw: bytes, chunk_size: int = 7):
+    async def chunks():
+        for start in range(0, len(raw), chunk_size):
+            yield raw[start:start + chunk_size]
+
+    async def collect():
+        return [key async for key in iter_key_file(chunks(), rejected)]
+
+    rejected = []
+    return asyncio.run(collect()), rejected
+
+
+def test_keys_split_on_newlines_and_commas_across_chunks():
+    keys, rejected = parse(b"\xef\xbb\xbfkey\r\nAAAA-1111,BBBB-2222\r\n\r\nCCCC-3333")
+    assert keys == ["AAAA-1111", "BBBB-2222", "CCCC-3333"]
+    assert rejected == []
+
+
+def test_line_longer_than_a_chunk_is_kept_whole():
+    keys = [f"KEY-{index:06d}" for index in range(20000)]
+    parsed, rejected = parse(",".join(keys).encode(), chunk_size=64 * 1024)
+    assert parsed == keys
+    assert rejected == []
+
+
+def test_invalid_utf8_is_reported_not_altered():
+    keys, rejected = parse(b"GOOD-1\nBAD-\xff\xfe\nGOOD-2,BAD-\xc3\n")
+    assert keys == ["GOOD-1", "GOOD-2"]
+    assert rejected == [2, 3]
+
+
+def test_oversized_value_is_rejected_without_buffering_it():
+    raw = b"GOOD-1\n" + b"X" * (KEY_FILE_MAX_KEY_BYTES * 5) + b"\nGOOD-2"
+    keys, rejected = parse(raw, chunk_size=1024)
+    assert keys == ["GOOD-1", "GOOD-2"]
+    assert rejected == [2]
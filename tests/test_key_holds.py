@@ -0,0 +1,55 @@
+"""Keys held for a pending payment by /confirm_payment"""
+import asyncio
+
+from storage import CONFIG, KeyManager, KeyStore
+
+PRODUCT = "Held Product"
+
+
+def run(scenario):
+    async def main():
+        km = KeyManager(KeyStore(CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH']))
+        try:
+            await km.add_keys_to_product(PRODUCT, ["HELD-1", "HELD-2"])
+            return await scenario(km)
+        finally:
+            await km.close()
+    return asyncio.run(main())
+
+
+def test_held_key_is_only_delivered_to_the_customer_it_was_held_for(key_database):
+    async def scenario(km: KeyManager):
+        hold_token, _, is_new = await km.hold_key(PRODUCT, 1, minutes=10)
+        assert is_new
+        assert await km.claim_held_key(hold_token, "intruder#0", 2) is None
+        assert await km.claim_held_key(hold_token, "customer#0", 1) is not None
+    
+    run(scenario)
+
+
+def test_repeat_confirmation_shares_the_hold_and_an_early_timeout_keeps_it(key_database):
+    async def scenario(km: KeyManager):
+        first_token, _, first_is_new = await km.hold_key(PRODUCT, 1, minutes=10)
+        second_token, _, second_is_new = await km.hold_key(PRODUCT, 1, minutes=10)
+        assert (second_token, first_is_new, second_is_new) == (first_token, True, False)
+        # The first view timing out must not free a hold that has not run out
+        assert await km.release_hold(first_token, only_expired=True) is False
+        assert await km.claim_held_key(second_token, "customer#0", 1) is not None
+    
+    run(scenario)
+
+
+def test_hold_taken_from_the_pool_refills_it(key_database):
+    async def scenario(km: KeyManager):
+        await km.add_keys_to_product(PRODUCT, [f"POOLED-{n}" for n in range(CONFIG['KEY_POOL_SIZE'] - 1)])
+        # The first delivery reserves every remaining key, so the hold can only come from the pool
+        assert await km.use_product_key(PRODUCT, "buyer#0", 1) is not None
+        while km.pool.refilling:
+            await asyncio.sleep(0.01)
+        refills = []
+        km._schedule_refill = refills.append
+        assert await km.hold_key(PRODUCT, 2, minutes=10) is not None
+        assert km.pool.hits == 1
+        return refills
+    
+    assert run(scenario) == [PRODUCT]
@@ -0,0 +1,74 @@
+"""Timed licenses: expiry notices, expiry, and what a customer keeps afterwards"""
+import asyncio
+import json
+import sqlite3
+
+from storage import CONFIG, KeyManager, KeyStore
+
+GUILD_ID = 42
+
+
+def open_key_manager() -> KeyManager:
+    return KeyManager(KeyStore(CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH']))
+
+
+def run_out_licenses(expires_at: int = 1):
+    """Move every running license's expiry into the past"""
+    conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
+    with conn:
+        conn.execute("UPDATE keys SET expires_at = ? WHERE license_active = 1", (expires_at,))
+    conn.close()
+
+
+async def sell(km: KeyManager, product_name: str, key_value: str, user_id: int, duration_days: int = None) -> str:
+    await km.add_keys_to_product(product_name, [key_value], duration_days=duration_days)
+    delivered = await km.use_product_key(product_name, f"user{user_id}#0", user_id, 10.0, guild_id=GUILD_ID)
+    assert delivered == key_value
+    await km.store.write(lambda conn: None)  # The pool records its assignment in the background
+    return delivered
+
+
+def test_expired_license_is_reported_invalid_and_lifetime_buyers_are_flagged(key_database):
+    async def scenario():
+        km = open_key_manager()
+        try:
+            await sell(km, "Monthly", "TIMED-1", user_id=1, duration_days=30)
+            await sell(km, "Monthly", "TIMED-2", user_id=2, duration_days=30)
+            await sell(km, "Lifetime", "LIFE-2", user_id=2)
+            await km.load_used_key_index()
+            assert json.loads(km.used_keys.validate("TIMED-1"))["valid"] is True
+            
+            run_out_licenses()
+            expired = {row['user_id']: row for row in await km.expire_licenses()}
+            assert {user_id: row['lifetime_customer'] for user_id, row in expired.items()} == {1: False, 2: True}
+            assert not any(row['still_licensed'] for row in expired.values())
+            assert json.loads(km.used_keys.validate("TIMED-1")) == {"valid": False, "product": "Monthly", "expired": True}
+            assert json.loads(km.used_keys.validate("LIFE-2"))["valid"] is True
+            # Only the customer without a lifetime key has lapsed
+            assert await km.get_lapsed_customers(GUILD_ID) == {1}
+            
+            # A restart rebuilds the index with the expiry intact
+            km.used_keys = type(km.used_keys)()
+            await km.load_used_key_index()
+            assert json.loads(km.used_keys.validate("TIMED-2"))["valid"] is False
+        finally:
+            await km.close()
+    
+    asyncio.run(scenario())
+
+
+def test_expiry_notice_is_only_marked_once_sent(key_database):
+    async def scenario():
+        km = open_key_manager()
+        try:
+            await sell(km, "Monthly", "TIMED-1", user_id=1, duration_days=1)
+            due = await km.get_due_license_notices(notice_seconds=2 * 86400)
+            assert [row['user_id'] for row in due] == [1]
+            # Nothing was sent yet, so the notice is still due
+            assert len(await km.get_due_license_notices(notice_seconds=2 * 86400)) == 1
+            await km.mark_license_notified(due[0]['id'])
+            assert await km.get_due_license_notices(notice_seconds=2 * 86400) == []
+        finally:
+            await km.close()
+    
+    asyncio.run(scenario())
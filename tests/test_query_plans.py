@@ -0,0 +1,39 @@
+"""Every hot key-database query must be answered from an index, not a table scan"""
+import sqlite3
+
+import pytest
+
+from storage import CONFIG, KEY_DB_HOT_QUERIES, attach_key_archive, check_key_query_plans
+
+# Queries that legitimately walk a whole (partial) index rather than seeking into it
+INDEX_SCANS_ALLOWED = {
+    "count_stock": "SCAN keys USING INDEX idx_keys_available",  # COUNT(*) GROUP BY over unused keys only
+}
+
+
+def query_plan(conn: sqlite3.Connection, sql: str):
+    return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', (None,) * sql.count('?'))]
+
+
+@pytest.fixture
+def conn(key_database):
+    conn = sqlite3.connect(key_database)
+    attach_key_archive(conn, CONFIG['ARCHIVE_DATABASE_PATH'])
+    yield conn
+    conn.close()
+
+
+def test_no_hot_query_scans_a_table(conn):
+    assert check_key_query_plans(conn) == {}
+
+
+@pytest.mark.parametrize("name", sorted(KEY_DB_HOT_QUERIES))
+def test_hot_query_seeks_an_index(conn, name):
+    scans = [step for step in query_plan(conn, KEY_DB_HOT_QUERIES[name]) if step.startswith('SCAN')]
+    allowed = [INDEX_SCANS_ALLOWED[name]] if name in INDEX_SCANS_ALLOWED else []
+    assert scans == allowed
+
+
+def test_plan_check_reports_a_full_scan(conn, monkeypatch):
+    monkeypatch.setitem(KEY_DB_HOT_QUERIES, "unindexed", "SELECT id FROM keys WHERE user_tag = ?")
+    assert check_key_query_plans(conn) == {"unindexed": ["SCAN keys"]}
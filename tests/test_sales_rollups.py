@@ -0,0 +1,47 @@
+"""Rebuilding the sales rollups from purchase history must keep each guild's numbers"""
+import asyncio
+import sqlite3
+
+from storage import CONFIG, KeyManager, KeyStore
+
+SALES = [(1001, "Monthly", 10.0), (1001, "Lifetime", 50.0), (2002, "Monthly", 10.0), (None, "Monthly", 5.0)]
+
+
+def guild_totals() -> dict:
+    conn = sqlite3.connect(CONFIG['DATABASE_PATH'])
+    try:
+        return {
+            "daily": conn.execute("SELECT guild_id, SUM(count), SUM(revenue) FROM sales_daily "
+                                  "WHERE source = 'purchase' GROUP BY guild_id").fetchall(),
+            "spenders": conn.execute("SELECT guild_id, member, count, revenue FROM leaderboards "
+                                     "WHERE source = 'purchase' AND board = 'spenders' AND period = 'all' "
+                                     "ORDER BY guild_id, member").fetchall(),
+        }
+    finally:
+        conn.close()
+
+
+def test_rebuild_keeps_purchases_in_their_guilds(key_database):
+    async def scenario():
+        km = KeyManager(KeyStore(CONFIG['DATABASE_PATH'], CONFIG['ARCHIVE_DATABASE_PATH']))
+        try:
+            for user_id, (guild_id, product_name, amount) in enumerate(SALES, start=1):
+                await km.add_keys_to_product(product_name, [f"KEY-{user_id}"])
+                assert await km.use_product_key(product_name, f"user{user_id}#0", user_id, amount, guild_id=guild_id)
+            await km.store.write(lambda conn: None)  # Pool deliveries are recorded in the background
+            recorded = guild_totals()
+            
+            # Half the history moves to the archive first; the rebuild reads both
+            await km.store.write(lambda conn: conn.execute(
+                "UPDATE user_purchases SET purchase_date = datetime('now', '-30 days') WHERE user_id % 2 = 0"))
+            moved = await km.archive_old_records(7)
+            assert moved['purchases'] == 2
+            
+            await km.rebuild_sales_rollups()
+            return recorded, guild_totals()
+        finally:
+            await km.close()
+    
+    recorded, rebuilt = asyncio.run(scenario())
+    assert [guild_id for guild_id, _, _ in recorded["daily"]] == [0, 1001, 2002]
+    assert rebuilt == recorded
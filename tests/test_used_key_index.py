@@ -0,0 +1,25 @@
+"""The in-memory index behind /validate"""
+import json
+
+from storage import UsedKeyIndex
+
+
+def test_responses_are_cached_by_digest_not_plaintext_key():
+    index = UsedKeyIndex()
+    index.add("AAAA-1111", "Premium")
+    index.rebuild_bloom()
+
+    assert json.loads(index.validate("AAAA-1111")) == {"valid": True, "product": "Premium"}
+    assert json.loads(index.validate("AAAA-1111")) == {"valid": True, "product": "Premium"}
+    assert index.cache_hits == 1
+    assert "AAAA-1111" not in index.responses
+    assert list(index.responses) == [UsedKeyIndex.digest("AAAA-1111")]
+
+
+def test_claiming_a_key_replaces_its_cached_negative_answer():
+    index = UsedKeyIndex()
+    index.rebuild_bloom()
+    assert json.loads(index.validate("BBBB-2222"))["valid"] is False
+
+    index.add("BBBB-2222", "Monthly")
+    assert json.loads(index.validate("BBBB-2222")) == {"valid": True, "product": "Monthly"}